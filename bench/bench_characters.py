@@ -0,0 +1,81 @@
+"""
+Micro-benchmark for the SAX pass of the indexer (`WikiXMLHandler`).
+
+It parses dumps made of a single synthetic article of growing size and
+prints the time taken per MB of article text, which should stay roughly
+the same for every size when the text is accumulated in linear time.
+
+    $ python3 bench/bench_characters.py --sizes 1 2 5
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+import xml.sax
+import xml.sax.handler
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+)
+
+import indexer  # noqa: E402
+
+
+def make_dump(size_mb):
+
+    rng = random.Random(size_mb)
+    words = [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10)))
+        for _ in range(5_000)
+    ]
+    lines = [" ".join(rng.choices(words, k=12)) for _ in range(1_000)]
+
+    text = []
+    text_size = 0
+    while text_size < size_mb * (1 << 20):
+        line = lines[len(text) % len(lines)]
+        text.append(line)
+        text_size += len(line) + 1
+
+    return (
+        "<mediawiki><page><title>Synthetic article</title><revision>"
+        f"<text>{chr(10).join(text)}</text>"
+        "</revision></page></mediawiki>"
+    ).encode()
+
+
+def time_sax_pass(dump):
+
+    wiki_xml_handler = indexer.WikiXMLHandler()
+
+    xml_parser = xml.sax.make_parser()
+    xml_parser.setFeature(xml.sax.handler.feature_namespaces, 0)
+    xml_parser.setContentHandler(wiki_xml_handler)
+
+    start_time = time.perf_counter()
+    for offset in range(0, len(dump), indexer.XML_READ_CHUNK_SIZE):
+        xml_parser.feed(dump[offset : offset + indexer.XML_READ_CHUNK_SIZE])
+    xml_parser.close()
+    wiki_xml_handler.end_batch()
+    elapsed_time = time.perf_counter() - start_time
+
+    assert wiki_xml_handler.article_count == 1
+    return elapsed_time
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--sizes", type=float, nargs="+", default=[1, 2, 5])
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    print(f"{'size (MB)':>10} {'time (s)':>10} {'time/MB (s)':>12}")
+    for size_mb in args.sizes:
+        dump = make_dump(size_mb)
+        elapsed_time = min(time_sax_pass(dump) for _ in range(args.repeat))
+        print(f"{size_mb:>10} {elapsed_time:>10.4f} {elapsed_time / size_mb:>12.4f}")
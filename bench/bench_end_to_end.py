@@ -0,0 +1,255 @@
+"""
+Generates a synthetic dump (with bench/generate_dump.py), indexes it and
+searches it, and appends the results of the run to a JSON results file:
+the indexing throughput (pages/s and MB/s of the dump), the time taken
+by the merging and by every stage of the indexer, the size of the index,
+and the latencies of the queries (mean, p50, p95, p99) and their
+throughput. A run records the commit and the options it was made with,
+so the runs of different commits with the same options can be compared,
+and the last such run is printed next to the new one.
+
+    $ python3 bench/bench_end_to_end.py [--results-file bench/results.json]
+        [--pages 10000] [--seed 1] [--indexer-args="--workers 2"]
+        [--searcher-args="--mmap"]
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(REPO_DIR, "src"))
+
+from generate_dump import DumpGenerator, add_config_arguments, get_config  # noqa: E402
+from searcher import get_percentile  # noqa: E402
+
+INDEXER = os.path.join(REPO_DIR, "src", "indexer.py")
+SEARCHER = os.path.join(REPO_DIR, "src", "searcher.py")
+
+REGEX_INDEXING_TIME = re.compile(r"^Indexing took (?P<time>[0-9.]+) seconds", re.M)
+REGEX_MERGING_TIME = re.compile(r"^Merging took (?P<time>[0-9.]+) seconds", re.M)
+REGEX_THROUGHPUT = re.compile(r"\((?P<throughput>[0-9.]+) queries/s\)")
+# The time of a query, on its own line after its results
+REGEX_QUERY_TIME = re.compile(r"^(?P<time>[0-9.]+(?:e-?[0-9]+)?)$", re.M)
+
+# Lower is better for all of them but the throughputs
+COMPARED_RESULTS = [
+    ("pages_per_second", True),
+    ("mb_per_second", True),
+    ("merge_seconds", False),
+    ("index_bytes", False),
+    ("query_p50_ms", False),
+    ("query_p95_ms", False),
+    ("query_p99_ms", False),
+    ("queries_per_second", True),
+]
+
+
+def get_git_commit():
+
+    try:
+        return subprocess.check_output(
+            ["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"],
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_dir_size(dir_path):
+
+    size, files_count = 0, 0
+    for root, _, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            size += os.path.getsize(os.path.join(root, file_name))
+            files_count += 1
+    return size, files_count
+
+
+def run_indexer(dump_file, index_dir, stat_file, stages_file, indexer_args):
+
+    command = [sys.executable, INDEXER, dump_file, index_dir, stat_file]
+    command += ["--stats-json", stages_file]
+    start_time = time.perf_counter()
+    stdout = subprocess.run(
+        command + indexer_args, check=True, capture_output=True, text=True
+    ).stdout
+    wall_time = time.perf_counter() - start_time
+
+    # Every shard merges its own index
+    merge_times = [float(m.group("time")) for m in REGEX_MERGING_TIME.finditer(stdout)]
+    indexing_time = REGEX_INDEXING_TIME.search(stdout)
+    with open(stages_file, "r") as f:
+        stages = json.load(f)["stages"]
+    return {
+        "wall_seconds": wall_time,
+        "indexing_seconds": (
+            float(indexing_time.group("time"))
+            if indexing_time is not None
+            else wall_time
+        ),
+        "merge_seconds": max(merge_times) if len(merge_times) > 0 else None,
+        "indexer_stage_seconds": {
+            stage: stage_stats["seconds"] for stage, stage_stats in stages.items()
+        },
+    }
+
+
+def run_searcher(queries_file, index_dir, output_file, searcher_args):
+
+    command = [sys.executable, SEARCHER, queries_file, index_dir, output_file]
+    stdout = subprocess.run(
+        command + searcher_args, check=True, capture_output=True, text=True
+    ).stdout
+
+    with open(output_file, "r") as f:
+        latencies = sorted(
+            float(m.group("time")) for m in REGEX_QUERY_TIME.finditer(f.read())
+        )
+    throughput = REGEX_THROUGHPUT.search(stdout)
+
+    return {
+        "query_count": len(latencies),
+        "query_mean_ms": statistics.mean(latencies) * 1000,
+        "query_p50_ms": get_percentile(latencies, 50) * 1000,
+        "query_p95_ms": get_percentile(latencies, 95) * 1000,
+        "query_p99_ms": get_percentile(latencies, 99) * 1000,
+        "query_max_ms": latencies[-1] * 1000,
+        "queries_per_second": (
+            float(throughput.group("throughput")) if throughput is not None else None
+        ),
+    }
+
+
+def run_benchmark(work_dir, config, indexer_args, searcher_args):
+
+    dump_file = os.path.join(work_dir, "dump.xml")
+    queries_file = os.path.join(work_dir, "queries.txt")
+    index_dir = os.path.join(work_dir, "index")
+    stat_file = os.path.join(work_dir, "stat.txt")
+    stages_file = os.path.join(work_dir, "stages.json")
+    output_file = os.path.join(work_dir, "output.txt")
+
+    generator = DumpGenerator(config)
+    with open(dump_file, "w") as f:
+        generator.write_dump(f)
+    with open(queries_file, "w") as f:
+        generator.write_queries(f)
+    dump_size = os.path.getsize(dump_file)
+
+    results = {"dump_bytes": dump_size}
+    results.update(
+        run_indexer(dump_file, index_dir, stat_file, stages_file, indexer_args)
+    )
+    results["pages_per_second"] = config["pages"] / results["indexing_seconds"]
+    results["mb_per_second"] = dump_size / 2**20 / results["indexing_seconds"]
+    results["index_bytes"], results["index_files"] = get_dir_size(index_dir)
+    results.update(run_searcher(queries_file, index_dir, output_file, searcher_args))
+
+    return results
+
+
+def load_runs(results_file):
+
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file, "r") as f:
+        return json.load(f)
+
+
+def get_run_key(run):
+    return run["config"], run["indexer_args"], run["searcher_args"]
+
+
+def print_comparison(run, previous_run):
+
+    if previous_run is None:
+        print(f"results of {run['commit']}:")
+    else:
+        print(f"results of {run['commit']}, and change since {previous_run['commit']}:")
+
+    for name, higher_is_better in COMPARED_RESULTS:
+        value = run["results"][name]
+        if value is None:
+            continue
+
+        if isinstance(value, int):
+            line = f"  {name:<20} {value:>14}"
+        else:
+            line = f"  {name:<20} {value:>14.2f}"
+        previous_value = None
+        if previous_run is not None:
+            previous_value = previous_run["results"].get(name)
+        if previous_value:
+            change = (value - previous_value) / previous_value * 100
+            if value == previous_value:
+                verdict = "same"
+            elif (value > previous_value) == higher_is_better:
+                verdict = "better"
+            else:
+                verdict = "worse"
+            line += f"  {change:+6.1f}% {verdict}"
+        print(line)
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "--results-file",
+        default=os.path.join(REPO_DIR, "bench", "results.json"),
+        help="JSON file the run is appended to",
+    )
+    arg_parser.add_argument(
+        "--indexer-args", default="", help="arguments of the indexer, quoted"
+    )
+    arg_parser.add_argument(
+        "--searcher-args", default="", help="arguments of the searcher, quoted"
+    )
+    arg_parser.add_argument(
+        "--work-dir",
+        help="directory to keep the dump, the index and the output in,"
+        " instead of a temporary one",
+    )
+    add_config_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    config = get_config(args)
+    indexer_args = shlex.split(args.indexer_args)
+    searcher_args = shlex.split(args.searcher_args)
+
+    if args.work_dir is not None:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = run_benchmark(args.work_dir, config, indexer_args, searcher_args)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_benchmark(work_dir, config, indexer_args, searcher_args)
+
+    run = {
+        "commit": get_git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": config,
+        "indexer_args": indexer_args,
+        "searcher_args": searcher_args,
+        "results": results,
+    }
+
+    runs = load_runs(args.results_file)
+    previous_runs = [r for r in runs if get_run_key(r) == get_run_key(run)]
+    print_comparison(run, previous_runs[-1] if len(previous_runs) > 0 else None)
+
+    runs.append(run)
+    with open(args.results_file, "w") as f:
+        json.dump(runs, f, indent=2)
+        f.write("\n")
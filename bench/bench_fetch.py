@@ -0,0 +1,93 @@
+"""
+Times every query of a queries file on a cold cache, with the posting
+lists of the fields of a query read one after the other, and in
+parallel with `--fetch-threads`. Before every query, the files of the
+index are dropped from the page cache (with `posix_fadvise`) and the
+caches of the searcher are emptied, and the latencies are printed.
+
+    $ python3 bench/bench_fetch.py <path_to_queries_file> <path_of_index_directory> [--fetch-threads 6]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+)
+
+import searcher  # noqa: E402
+
+
+def drop_page_cache(index_dir):
+
+    for dir_path, _, file_names in os.walk(index_dir):
+        for file_name in file_names:
+            fd = os.open(os.path.join(dir_path, file_name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def clear_caches():
+
+    for cache in searcher.ALL_CACHES:
+        cache.entries.clear()
+        cache.size = 0
+
+
+def get_cold_latencies(queries, index_dir):
+
+    results, latencies = [], []
+    for query in queries:
+        drop_page_cache(index_dir)
+        clear_caches()
+
+        start_time = time.perf_counter()
+        results.append(searcher.get_search_results(query))
+        latencies.append(time.perf_counter() - start_time)
+
+    return results, latencies
+
+
+def get_latency_stats(latencies):
+
+    latencies = sorted(latencies)
+    return (
+        f"mean {statistics.mean(latencies) * 1000:.1f} ms,"
+        f" p50 {latencies[len(latencies) // 2] * 1000:.1f} ms,"
+        f" p95 {latencies[len(latencies) * 95 // 100] * 1000:.1f} ms,"
+        f" max {latencies[-1] * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("queries_file")
+    arg_parser.add_argument("index_dir")
+    arg_parser.add_argument("--fetch-threads", type=int, default=6)
+    args = arg_parser.parse_args()
+
+    searcher.index_dir = args.index_dir
+    searcher.load_pre_indexes()
+
+    with open(args.queries_file, "r") as f:
+        queries = [query.strip() for query in f if len(query.strip()) > 0]
+
+    searcher.start_fetch_executor(1)
+    serial_results, serial_latencies = get_cold_latencies(queries, args.index_dir)
+
+    searcher.start_fetch_executor(args.fetch_threads)
+    results, latencies = get_cold_latencies(queries, args.index_dir)
+
+    print(f"{len(queries)} queries, cold cache")
+    print(f"serial:     {get_latency_stats(serial_latencies)}")
+    print(f"{args.fetch_threads} threads:  {get_latency_stats(latencies)}")
+
+    if results != serial_results:
+        print("Mismatch between the serial and the parallel results")
+        exit(1)
@@ -0,0 +1,80 @@
+"""
+Runs the searcher on a queries file with `--jobs N` for several N, checks
+that the results are the same as with a single job, and prints the
+throughput (queries/s) for every N, which is the time taken by all the
+queries after the jobs have loaded the index.
+
+    $ python3 bench/bench_jobs.py <path_to_queries_file> <path_of_index_directory> [--jobs 1 2 4 8] [--batch]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+SEARCHER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "searcher.py"
+)
+
+REGEX_THROUGHPUT = re.compile(r"\((?P<throughput>[0-9.]+) queries/s\)")
+REGEX_TIME = re.compile(r"^[0-9.e-]+$", flags=re.M)
+
+
+def run_searcher(queries_file, index_dir, jobs, batch):
+    """
+    Returns the results written by the searcher, without the times
+    of the queries, and its throughput
+    """
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_file = os.path.join(output_dir, "output.txt")
+        command = [
+            sys.executable,
+            SEARCHER,
+            queries_file,
+            index_dir,
+            output_file,
+            "--jobs",
+            str(jobs),
+        ]
+        if batch:
+            command.append("--batch")
+        stdout = subprocess.run(
+            command, check=True, capture_output=True, text=True
+        ).stdout
+
+        with open(output_file, "r") as f:
+            results = REGEX_TIME.sub("", f.read())
+
+    return results, float(REGEX_THROUGHPUT.search(stdout).group("throughput"))
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("queries_file")
+    arg_parser.add_argument("index_dir")
+    arg_parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8])
+    arg_parser.add_argument("--batch", action="store_true")
+    args = arg_parser.parse_args()
+
+    print(f"{os.cpu_count()} cpus")
+    print(f"{'jobs':>4}  {'queries/s':>9}  speedup")
+
+    expected, base_throughput, mismatches = None, None, 0
+    for jobs in args.jobs:
+        results, throughput = run_searcher(
+            args.queries_file, args.index_dir, jobs, args.batch
+        )
+        if expected is None:
+            expected, base_throughput = results, throughput
+        elif results != expected:
+            mismatches += 1
+            print(f"Mismatch with {jobs} jobs")
+
+        print(f"{jobs:>4}  {throughput:>9.1f}  {throughput / base_throughput:.2f}x")
+
+    if mismatches > 0:
+        exit(1)
@@ -0,0 +1,53 @@
+"""
+Measures the memory held by the in-memory index maps of the indexer: the
+first pages of a dump are parsed and added to the maps without writing
+any temp index file, and the peak traced memory and the number of blocks
+still allocated are printed.
+
+    $ python3 bench/bench_pre_index.py <path_to_xml_dump_file> [--pages 100000]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+)
+
+import indexer  # noqa: E402
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("dump_file")
+    arg_parser.add_argument("--pages", type=int, default=100_000)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        indexer.index_dir = index_dir
+        indexer.memory_budget = None
+        indexer.NUMBER_OF_PAGES_PER_PREINDEX_FILE = args.pages + 1
+
+        start_blocks = sys.getallocatedblocks()
+        tracemalloc.start()
+        start_time = time.perf_counter()
+
+        dump_chunks = indexer.read_dump_chunks(args.dump_file)
+        for batch in indexer.read_article_batches(dump_chunks):
+            *parsed_batch, _ = indexer.parse_articles(batch)
+            indexer.create_pre_index(*parsed_batch)
+            if indexer.PAGE_COUNT >= args.pages:
+                break
+
+        elapsed_time = time.perf_counter() - start_time
+        current_size, peak_size = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        allocated_blocks = sys.getallocatedblocks() - start_blocks
+
+    print(f"{indexer.PAGE_COUNT} pages in {elapsed_time:.1f} s")
+    print(f"held: {current_size / (1 << 20):.1f} MB in {allocated_blocks} blocks")
+    print(f"peak: {peak_size / (1 << 20):.1f} MB")
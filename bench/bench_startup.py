@@ -0,0 +1,108 @@
+"""
+Times the startup of the searcher on an index, from its snapshot and
+from its text pre index and offsets files: the loading of the pre
+indexes, and the first query after it (which maps and reads the offsets
+of its index files with --mmap). The files of the index are dropped from
+the page cache before every run. The time taken by a whole searcher
+process on no query, and by the interpreter and the imports alone, are
+printed too.
+
+    $ python3 bench/bench_startup.py <path_of_index_directory> [--query "..."] [--runs 5]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+sys.path.insert(0, SRC_DIR)
+
+import searcher  # noqa: E402
+
+from bench_fetch import clear_caches, drop_page_cache  # noqa: E402
+
+
+def get_startup_times(index_dir, query, use_snapshot, use_mmap):
+
+    searcher.USE_SNAPSHOT = use_snapshot
+    searcher.USE_MMAP = use_mmap
+    drop_page_cache(index_dir)
+    clear_caches()
+
+    start_time = time.perf_counter()
+    searcher.load_pre_indexes()
+    load_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    searcher.get_search_results(query)
+    query_time = time.perf_counter() - start_time
+
+    return load_time, query_time
+
+
+def get_process_time(command, index_dir):
+
+    drop_page_cache(index_dir)
+    start_time = time.perf_counter()
+    subprocess.run(command, check=True, capture_output=True)
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("index_dir")
+    arg_parser.add_argument("--query", default="the capture 1950")
+    arg_parser.add_argument("--runs", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    searcher.index_dir = args.index_dir
+
+    print(f"median of {args.runs} runs, cold cache")
+    for use_mmap in [False, True]:
+        for use_snapshot in [False, True]:
+            times = [
+                get_startup_times(args.index_dir, args.query, use_snapshot, use_mmap)
+                for _ in range(args.runs)
+            ]
+            load_time, query_time = map(statistics.median, zip(*times))
+            print(
+                f"{'snapshot' if use_snapshot else 'text':<8}"
+                f" {'--mmap' if use_mmap else '':<6}:"
+                f" load {load_time * 1000:.1f} ms,"
+                f" first query {query_time * 1000:.1f} ms"
+            )
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        queries_file = os.path.join(temp_dir, "queries.txt")
+        open(queries_file, "w").close()
+        output_file = os.path.join(temp_dir, "output.txt")
+
+        searcher_command = [
+            sys.executable,
+            os.path.join(SRC_DIR, "searcher.py"),
+            queries_file,
+            args.index_dir,
+            output_file,
+            "--mmap",
+        ]
+        imports_command = [
+            sys.executable,
+            "-c",
+            f"import sys; sys.path.insert(0, {SRC_DIR!r}); import searcher",
+        ]
+        process_time = statistics.median(
+            get_process_time(searcher_command, args.index_dir) for _ in range(args.runs)
+        )
+        imports_time = statistics.median(
+            get_process_time(imports_command, args.index_dir) for _ in range(args.runs)
+        )
+
+    print(
+        f"searcher process: {process_time * 1000:.1f} ms,"
+        f" of which interpreter and imports: {imports_time * 1000:.1f} ms"
+    )
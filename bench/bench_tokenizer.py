@@ -0,0 +1,108 @@
+"""
+Checks that `tokenize` splits the pages of a dump into the same tokens as
+the former one `str.replace` per symbol tokenizer (with the character
+entities replaced before the symbols), and measures both in MB/s.
+
+    $ python3 bench/bench_tokenizer.py <path_to_xml_dump_file> [--pages 5000]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+)
+
+import indexer  # noqa: E402
+
+from tokenizer import ENTITIES, tokenize  # noqa: E402
+
+REPLACED_SYMBOLS = [
+    *ENTITIES,
+    "—",
+    "%",
+    "$",
+    "'",
+    "~",
+    "|",
+    ".",
+    "*",
+    "[",
+    "]",
+    ":",
+    ";",
+    ",",
+    "{",
+    "}",
+    "(",
+    ")",
+    "=",
+    "+",
+    "-",
+    "_",
+    "#",
+    "!",
+    "`",
+    '"',
+    "?",
+    "/",
+    ">",
+    "<",
+    "&",
+    "\\",
+]
+
+
+def tokenize_by_replacing(text):
+
+    text = text.encode("ascii", errors="ignore").decode()
+
+    for sym in REPLACED_SYMBOLS:
+        text = text.replace(sym, " ")
+
+    return text.split()
+
+
+def get_throughput(tokenizer, texts, text_size):
+
+    start_time = time.perf_counter()
+    for text in texts:
+        tokenizer(text)
+    return text_size / (time.perf_counter() - start_time) / (1 << 20)
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("dump_file")
+    arg_parser.add_argument("--pages", type=int, default=5000)
+    args = arg_parser.parse_args()
+
+    texts = []
+    dump_chunks = indexer.read_dump_chunks(args.dump_file)
+    for _, articles in indexer.read_article_batches(dump_chunks):
+        for title, text in articles:
+            texts.append(title.lower())
+            texts.append(text.lower())
+        if len(texts) >= 2 * args.pages:
+            break
+
+    mismatches = 0
+    for text in texts:
+        if tokenize(text) != tokenize_by_replacing(text):
+            mismatches += 1
+            print(f"Mismatch for {text[:60]!r}...")
+
+    text_size = sum(len(text.encode()) for text in texts)
+    print(
+        f"{len(texts) // 2} pages, {text_size / (1 << 20):.1f} MB, {mismatches} mismatches"
+    )
+    print(
+        f"replace:  {get_throughput(tokenize_by_replacing, texts, text_size):.1f} MB/s"
+    )
+    print(f"tokenize: {get_throughput(tokenize, texts, text_size):.1f} MB/s")
+
+    if mismatches > 0:
+        exit(1)
@@ -0,0 +1,78 @@
+"""
+Checks the top-k search of the searcher (`get_top_documents`), and the
+NumPy scoring if NumPy is installed, against the exhaustive scoring for
+every query of a queries file, and times them.
+The posting lists are read once before timing, so that only the scoring
+is timed.
+
+    $ python3 bench/bench_top_k.py <path_to_queries_file> <path_of_index_directory>
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from itertools import islice
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+)
+
+import searcher  # noqa: E402
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("queries_file")
+    arg_parser.add_argument("index_dir")
+    arg_parser.add_argument("--num-documents", type=int, default=10)
+    args = arg_parser.parse_args()
+
+    searcher.index_dir = args.index_dir
+    searcher.load_pre_indexes()
+
+    with open(args.queries_file, "r") as f:
+        queries = [query.strip() for query in f if len(query.strip()) > 0]
+
+    exhaustive_time, top_k_time, numpy_time, mismatches = 0, 0, 0, 0
+    for query in queries:
+        terms = searcher.get_query_terms(query)
+        for field_type, token, _ in terms:
+            searcher.get_posting_list(field_type, token)
+
+        start_time = time.perf_counter()
+        expected = list(
+            islice(searcher.get_ranked_documents_exhaustive(terms), args.num_documents)
+        )
+        exhaustive_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        top_documents = searcher.get_top_documents(terms, args.num_documents)
+        top_k_time += time.perf_counter() - start_time
+
+        if top_documents != expected:
+            mismatches += 1
+            print(f"Mismatch for {query!r}: {top_documents} != {expected}")
+
+        if searcher.np is None:
+            continue
+
+        start_time = time.perf_counter()
+        top_documents = list(
+            islice(searcher.get_ranked_documents_numpy(terms), args.num_documents)
+        )
+        numpy_time += time.perf_counter() - start_time
+
+        if top_documents != expected:
+            mismatches += 1
+            print(f"NumPy mismatch for {query!r}: {top_documents} != {expected}")
+
+    print(f"{len(queries)} queries, {mismatches} mismatches")
+    print(f"exhaustive: {exhaustive_time:.3f} s")
+    print(f"top-k:      {top_k_time:.3f} s ({exhaustive_time / top_k_time:.1f}x)")
+    if searcher.np is not None:
+        print(f"numpy:      {numpy_time:.3f} s ({exhaustive_time / numpy_time:.1f}x)")
+
+    if mismatches > 0:
+        exit(1)
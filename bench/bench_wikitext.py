@@ -0,0 +1,101 @@
+"""
+Compares the fields that `scan_wikitext` extracts from the pages of a dump
+with the ones of the former regex and split based extractors, and times
+both in MB/s. The two differ on purpose where templates are nested or
+span several lines, so the pages whose tokens differ are only counted.
+
+    $ python3 bench/bench_wikitext.py <path_to_xml_dump_file> [--pages 5000]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+)
+
+import indexer  # noqa: E402
+
+from tokenizer import tokenize  # noqa: E402
+
+FIELD_NAMES = ["body", "infobox", "categories", "references", "external links"]
+
+REGEX_INFOBOX = re.compile(r"{{infobox.*?^}}$", flags=re.M | re.DOTALL)
+REGEX_BRACES = re.compile(r"{{.*?}}", flags=re.M)
+REGEX_CATEGORY = re.compile(r"\[\[category:(?P<cat>.*?)\]\]")
+
+
+def extract_fields_by_regex(text):
+
+    for sep in ["== ", " =="]:
+        text = text.replace(sep, "==")
+    data = text.split("==references==")
+
+    body = REGEX_INFOBOX.sub(repl=" ", string=data[0])
+    body = REGEX_BRACES.sub(repl=" ", string=body)
+
+    infobox = []
+    pieces = data[0].split("{{infobox")
+    for piece in pieces[0 if data[0].startswith("{{infobox") else 1 :]:
+        for line in piece.split("\n"):
+            if line == "}}":
+                break
+            infobox.append(line)
+
+    categories = " ".join(REGEX_CATEGORY.findall(string=text))
+
+    references, external_links = "", ""
+    if len(data) > 1:
+        references = data[1].split("\n\n", maxsplit=1)[0].replace("reflist", " ")
+        links = data[1].split("==external links==")
+        if len(links) > 1:
+            external_links = links[1].split("\n\n", maxsplit=1)[0]
+
+    return body, " ".join(infobox), categories, references, external_links
+
+
+def get_throughput(extract_fields, texts, text_size):
+
+    start_time = time.perf_counter()
+    for text in texts:
+        extract_fields(text)
+    return text_size / (time.perf_counter() - start_time) / (1 << 20)
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("dump_file")
+    arg_parser.add_argument("--pages", type=int, default=5000)
+    args = arg_parser.parse_args()
+
+    texts = []
+    dump_chunks = indexer.read_dump_chunks(args.dump_file)
+    for _, articles in indexer.read_article_batches(dump_chunks):
+        texts.extend(text.lower() for _, text in articles)
+        if len(texts) >= args.pages:
+            break
+
+    differences = [0] * len(FIELD_NAMES)
+    for text in texts:
+        fields = zip(indexer.scan_wikitext(text), extract_fields_by_regex(text))
+        for indx, (field, regex_field) in enumerate(fields):
+            if tokenize(field) != tokenize(regex_field):
+                differences[indx] += 1
+
+    text_size = sum(len(text.encode()) for text in texts)
+    print(f"{len(texts)} pages, {text_size / (1 << 20):.1f} MB")
+    for field_name, count in zip(FIELD_NAMES, differences):
+        print(f"{field_name}: different tokens in {count} pages")
+    print(
+        f"regex: {get_throughput(extract_fields_by_regex, texts, text_size):.1f} MB/s"
+    )
+    print(f"scan:  {get_throughput(indexer.scan_wikitext, texts, text_size):.1f} MB/s")
+
+    nested = "{{cite|first {{date|1990}} last}} word"
+    print(f"body of {nested!r}:")
+    print(f"  regex: {tokenize(extract_fields_by_regex(nested)[0])}")
+    print(f"  scan:  {tokenize(indexer.scan_wikitext(nested)[0])}")
@@ -0,0 +1,202 @@
+"""
+Generates a synthetic MediaWiki XML dump, the same for the same options
+and seed. The words are made of syllables and drawn from a Zipfian
+distribution, the lengths of the articles from a Pareto distribution,
+and the articles have infoboxes (with nested templates), sections,
+references, external links and categories at the given densities. Some
+of the pages are in the meta namespaces that the indexer or the searcher
+leave out. Queries drawn from the same vocabulary, some of them field
+queries, can be written too.
+
+    $ python3 bench/generate_dump.py <path_of_dump_file> [--pages 10000] [--seed 1] [--queries-file <path>]
+"""
+
+import argparse
+import html
+import random
+
+from itertools import accumulate
+
+SYLLABLES = [
+    "ka", "lo", "mi", "ren", "tor", "as", "el", "vin", "dra", "qu", "ph", "ost",
+    "ing", "tion", "ed", "er", "s", "ly", "ment", "ness", "pre", "con", "un",
+]  # fmt: skip
+STOPWORDS = ["the", "and", "of", "is", "a", "in", "to", "was"]
+META_PREFIXES = ["Template:", "Help:", "Wikipedia:", "Module:", "File:"]
+FIELD_PREFIXES = ["t", "b", "i", "c", "r", "l"]
+
+DEFAULT_CONFIG = {
+    "pages": 10_000,
+    "seed": 1,
+    "vocabulary_size": 50_000,
+    "zipf_exponent": 1.0,
+    "length_alpha": 1.2,
+    "length_scale": 60,
+    "max_length": 20_000,
+    "infobox_density": 0.4,
+    "section_density": 0.5,
+    "reference_density": 0.6,
+    "external_links_density": 0.5,
+    "categories_per_page": 1.5,
+    "meta_density": 0.05,
+    "queries": 500,
+    "field_query_density": 0.3,
+}
+
+
+class DumpGenerator:
+    """
+    Draws the words, pages and queries of a dump from one seeded random
+    number generator
+    """
+
+    def __init__(self, config):
+
+        self.config = config
+        self.random = random.Random(config["seed"])
+
+        vocabulary = set()
+        while len(vocabulary) < config["vocabulary_size"]:
+            syllables = self.random.choices(SYLLABLES, k=self.random.randint(2, 5))
+            vocabulary.add("".join(syllables))
+        vocabulary = sorted(vocabulary)
+        self.random.shuffle(vocabulary)
+        # The stop words are the most frequent words, as in English
+        self.vocabulary = STOPWORDS + vocabulary
+
+        self.cum_weights = list(
+            accumulate(
+                1 / (rank + 1) ** config["zipf_exponent"]
+                for rank in range(len(self.vocabulary))
+            )
+        )
+
+    def get_words(self, count):
+        return self.random.choices(
+            self.vocabulary, cum_weights=self.cum_weights, k=count
+        )
+
+    def get_text(self, count):
+        return " ".join(self.get_words(count))
+
+    def get_article_length(self):
+
+        length = self.config["length_scale"] * self.random.paretovariate(
+            self.config["length_alpha"]
+        )
+        return min(int(length), self.config["max_length"])
+
+    def get_page(self, page_id):
+        """
+        Returns the title and the wikitext of a page
+        """
+
+        config = self.config
+        title = self.get_text(self.random.randint(1, 4)).title()
+        if self.random.random() < config["meta_density"]:
+            title = self.random.choice(META_PREFIXES) + title
+
+        length = self.get_article_length()
+        parts = []
+
+        if self.random.random() < config["infobox_density"]:
+            parts.append(
+                f"{{{{Infobox {self.get_text(1)}\n"
+                f"| name = {self.get_text(2)}\n"
+                f"| born = {self.get_text(2)} {{{{birth date|{1000 + page_id % 1000}}}}}\n"
+                f"| known = {{{{hlist|{self.get_text(1)}|{{{{nowrap|{self.get_text(2)}}}}}}}}}\n"
+                f"}}}}"
+            )
+
+        parts.append(
+            f"'''{title}''' is {self.get_text(max(length, 1))}"
+            f" [[{self.get_text(1)}|{self.get_text(2)}]]"
+            f" {{{{cite web|title={self.get_text(3)}}}}} &amp; {self.get_text(2)}."
+        )
+
+        if self.random.random() < config["section_density"]:
+            parts.append(f"== {self.get_text(2)} ==\n{self.get_text(length // 2)}")
+
+        if self.random.random() < config["reference_density"]:
+            parts.append(
+                f"== References ==\n{{{{reflist}}}}\n"
+                f"* {self.get_text(8)} {{{{cite book|title={self.get_text(3)}}}}}"
+            )
+
+        if self.random.random() < config["external_links_density"]:
+            parts.append(
+                f"== External links ==\n"
+                f"* [http://example.org/{page_id} {self.get_text(4)}]"
+            )
+
+        category_count = min(
+            int(self.random.expovariate(1 / config["categories_per_page"])), 20
+        )
+        for _ in range(category_count):
+            parts.append(f"[[Category:{self.get_text(2).title()}]]")
+
+        return title, "\n\n".join(parts)
+
+    def write_dump(self, f):
+
+        f.write('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">\n')
+        f.write("  <siteinfo>\n    <sitename>Synthetic</sitename>\n  </siteinfo>\n")
+
+        for page_id in range(1, self.config["pages"] + 1):
+            title, text = self.get_page(page_id)
+            f.write(
+                f"  <page>\n"
+                f"    <title>{html.escape(title)}</title>\n"
+                f"    <ns>0</ns>\n"
+                f"    <id>{page_id}</id>\n"
+                f"    <revision>\n"
+                f"      <id>{page_id + 1_000_000}</id>\n"
+                f'      <text bytes="{len(text.encode())}" xml:space="preserve">'
+                f"{html.escape(text, quote=False)}</text>\n"
+                f"    </revision>\n"
+                f"  </page>\n"
+            )
+
+        f.write("</mediawiki>\n")
+
+    def write_queries(self, f):
+
+        for _ in range(self.config["queries"]):
+            if self.random.random() < self.config["field_query_density"]:
+                fields = self.random.sample(FIELD_PREFIXES, k=self.random.randint(1, 3))
+                query = " ".join(
+                    f"{field}:{self.get_text(self.random.randint(1, 2))}"
+                    for field in fields
+                )
+            else:
+                query = self.get_text(self.random.randint(1, 4))
+            f.write(f"{query}\n")
+
+
+def add_config_arguments(arg_parser):
+
+    for name, default in DEFAULT_CONFIG.items():
+        arg_parser.add_argument(
+            f"--{name.replace('_', '-')}", type=type(default), default=default
+        )
+
+
+def get_config(args):
+    return {name: getattr(args, name) for name in DEFAULT_CONFIG}
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("dump_file")
+    arg_parser.add_argument("--queries-file")
+    add_config_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    generator = DumpGenerator(get_config(args))
+    with open(args.dump_file, "w") as f:
+        generator.write_dump(f)
+
+    if args.queries_file is not None:
+        with open(args.queries_file, "w") as f:
+            generator.write_queries(f)
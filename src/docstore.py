@@ -0,0 +1,76 @@
+import struct
+
+# Document Store <<<
+# The articles of a segment are written one after the other into
+# DOCSTORE_FILE, each as
+#   {flags}{length}{title}
+# with the flags as a byte, the length (the number of tokens of the
+# article) as a 4 byte little endian integer, and the title in UTF-8.
+# DOCSTORE_OFFSETS_FILE holds the offset of the record of every article,
+# by its doc id from the first one of the segment, and then the size of
+# DOCSTORE_FILE, as 8 byte little endian integers. So the record of an
+# article is found with one read in the offsets, and no other record is
+# read.
+
+DOCSTORE_FILE = "docstore.bin"
+DOCSTORE_OFFSETS_FILE = "docstore_offsets.bin"
+
+# The help and module pages, which are left out of the search results
+DOC_FLAG_META = 1
+META_TITLE_PREFIXES = ("Help:", "Module:")
+
+MAX_DOCUMENT_LENGTH = (1 << 32) - 1
+
+DOCUMENT_HEADER = struct.Struct("<BI")
+OFFSET = struct.Struct("<Q")
+OFFSET_PAIR = struct.Struct("<QQ")
+
+
+def get_document_flags(title):
+
+    flags = 0
+    if title.startswith(META_TITLE_PREFIXES):
+        flags |= DOC_FLAG_META
+    return flags
+
+
+def encode_document(title, length):
+
+    header = DOCUMENT_HEADER.pack(
+        get_document_flags(title), min(length, MAX_DOCUMENT_LENGTH)
+    )
+    return header + title.encode()
+
+
+def encode_offsets(offsets):
+    return struct.pack(f"<{len(offsets)}Q", *offsets)
+
+
+def decode_document(record):
+    """
+    Returns the title, the flags and the length of the article
+    """
+
+    flags, length = DOCUMENT_HEADER.unpack_from(record)
+    return str(record[DOCUMENT_HEADER.size :], "utf-8"), flags, length
+
+
+def read_document(docstore, offsets, doc_num):
+    """
+    Decodes the record of the `doc_num`th article of the (mapped) files
+    """
+
+    start, end = OFFSET_PAIR.unpack_from(offsets, doc_num * OFFSET.size)
+    return decode_document(docstore[start:end])
+
+
+def read_documents(docstore, offsets):
+    """
+    Yields the title, the flags and the length of every article
+    """
+
+    for doc_num in range(len(offsets) // OFFSET.size - 1):
+        yield read_document(docstore, offsets, doc_num)
+
+
+# >>>
@@ -1,22 +1,48 @@
+import argparse
+import bz2
+import cProfile
+import gzip
 import heapq
+import json
+import lzma
+import multiprocessing
 import os
+import pstats
 import re
+import resource
 import shutil
 import string
 import sys
-import math
 import time
 import subprocess
 
-from functools import cache
-from collections import defaultdict
+from array import array
+from functools import cache, partial
+from itertools import groupby, islice
+from collections import Counter, defaultdict, deque
 
 import xml.sax
 import xml.sax.handler
 
 from Stemmer import Stemmer
 
-UNSTEMMED_TOKENS = set()
+from docstore import (
+    DOCSTORE_FILE,
+    DOCSTORE_OFFSETS_FILE,
+    encode_document,
+    encode_offsets,
+    read_documents,
+)
+from postings import (
+    POSTINGS_FILE_HEADER,
+    check_postings_header,
+    decode_postings,
+    decode_token,
+    encode_postings,
+)
+from snapshot import SNAPSHOT_FILE, encode_keys, encode_numbers, write_snapshot
+from tokenizer import tokenize
+
 ENGLISH_STEMMER = Stemmer("english")
 
 # Constants <<<
@@ -27,9 +53,26 @@ FIELD_TYPE_CATEGORIES = "c"
 FIELD_TYPE_EXTERNAL_LINKS = "l"
 FIELD_TYPE_REFERENCES = "r"
 
-REGEX_INFOBOX = re.compile(r"{{infobox.*?^}}$", flags=re.M | re.DOTALL)
-REGEX_BRACES = re.compile(r"{{.*?}}", flags=re.M)
-REGEX_CATEGORY = re.compile(r"\[\[category:(?P<cat>.*?)\]\]")
+POSTINGS_FORMAT_TEXT = "text"
+POSTINGS_FORMAT_BINARY = "binary"
+
+FILE_TYPE_IDF = "idf"
+
+# An index directory holds the base segment, built from a whole dump, and
+# the delta segments `delta_{n}`, each built from a dump of the pages added
+# or changed since the segments before it
+DELTA_DIR_PREFIX = "delta_"
+SEGMENT_INFO_FILE = "segment.txt"
+TOMBSTONES_FILE = "tombstones.bin"
+
+# A sharded index directory holds the shards `shard_{n}`, each an index of
+# a range of the pages of the dump with its own doc ids, and the idf of
+# all of them. The doc ids of a shard follow the ones of the shards before
+SHARD_DIR_PREFIX = "shard_"
+SHARDS_FILE = "shards.txt"
+
+REGEX_SECTION = re.compile(r"==[ \t]*(references|external links)[ \t]*==")
+REGEX_CATEGORY = re.compile(r"\[\[category:(.*?)\]\]")
 
 ENGLISH_STOPWORDS = {
     "or",
@@ -209,6 +252,20 @@ ENGLISH_STOPWORDS = {
 NUMBER_OF_PAGES_PER_PREINDEX_FILE = 15_000
 NUMBER_OF_TOKENS_PER_FILE = 50_000
 NUMBER_OF_TITLES_PER_FILE = 50_000
+NUMBER_OF_ARTICLES_PER_BATCH = 500
+NUMBER_OF_PENDING_BATCHES_PER_WORKER = 2
+XML_READ_CHUNK_SIZE = 1 << 20
+NUMBER_OF_STREAMS_PER_DECOMPRESSION_TASK = 16
+STEM_CACHE_SIZE = 500_000
+MERGE_FAN_IN = 64
+MERGE_BUFFER_SIZE = 1 << 20
+PROGRESS_INTERVAL = 30
+PROFILE_PRINTED_FUNCTIONS = 25
+
+# Rough sizes of the Python objects held by the index maps, used to
+# flush them by --memory-budget
+POSTING_SIZE = 9
+TOKEN_ENTRY_SIZE = 350
 # >>>
 
 # Base Conversion <<<
@@ -242,19 +299,110 @@ def base_64_decode(chars):
 
 # >>>
 
+
 # Utils <<<
-@cache
-def stem_word(token):
-    return ENGLISH_STEMMER.stemWord(token)
+class StemCache:
+    """
+    Cache of the stems of the tokens, bounded by its number of entries.
+    The tokens whose stem is not indexed are mapped to None. Once full,
+    the entries that were added first are evicted first
+    """
+
+    def __init__(self, max_entries):
+
+        self.max_entries = max_entries
+        self.stems = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stem(self, tokens):
+        """
+        Stems all the `tokens` not in the cache in one call, returns the
+        cache, in which all of the `tokens` are until the next call
+        """
+
+        stems = self.stems
+
+        overflow = len(stems) - self.max_entries
+        if overflow > 0:
+            for token in list(islice(stems, overflow)):
+                del stems[token]
+            self.evictions += overflow
+
+        new_tokens = [token for token in tokens if token not in stems]
+        self.hits += len(tokens) - len(new_tokens)
+        self.misses += len(new_tokens)
+
+        for token, stem in zip(new_tokens, ENGLISH_STEMMER.stemWords(new_tokens)):
+            stems[token] = stem if is_index_token(stem) else None
+
+        return stems
+
+    def get_stats(self):
+        return self.hits, self.misses, self.evictions, len(self.stems)
+
+
+class StageStats:
+    """
+    Time spent in every stage of the indexing, with its number of calls,
+    and counters of what went through them. The worker processes keep
+    their own and send them with their results, to be added up in the
+    main process, so the times of their stages are summed over them
+    """
+
+    def __init__(self):
+
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def add_time(self, stage, seconds, calls=1):
+
+        self.seconds[stage] += seconds
+        self.calls[stage] += calls
+
+    def count(self, counter, num=1):
+        self.counters[counter] += num
+
+    def clear(self):
 
+        self.seconds.clear()
+        self.calls.clear()
+        self.counters.clear()
 
-def handle_frequency(num, sig):
-    num = math.log10(num)
-    return round(num, sig - int(math.floor(math.log10(abs(num)))) - 1)
+    def get_stats(self):
+        return dict(self.seconds), dict(self.calls), dict(self.counters)
+
+    def add_stats(self, stats):
+
+        seconds, calls, counters = stats
+        for stage, stage_seconds in seconds.items():
+            self.add_time(stage, stage_seconds, calls[stage])
+        for counter, num in counters.items():
+            self.count(counter, num)
+
+    def get_summary(self):
+        """
+        The stages from the longest one, with their times
+        """
+
+        return ", ".join(
+            f"{stage} {seconds:.1f}s"
+            for stage, seconds in sorted(self.seconds.items(), key=lambda x: -x[1])
+        )
+
+
+def is_index_token(token):
+    return (
+        (token.isalpha()) and (token not in ENGLISH_STOPWORDS) and (3 < len(token) < 15)
+    ) or (token.isnumeric() and len(token) <= 7)
 
 
 # >>>
 
+
 # Writing Index Files <<<
 def write_article_id_to_title_mappings(titles, _, file_count):
 
@@ -274,6 +422,27 @@ def write_article_id_to_title_mappings(titles, _, file_count):
     #     f.write("\n".join(offsets))
 
 
+def write_docstore_records(records, is_last=False):
+    """
+    Appends the records of the articles to the document store, and their
+    offsets to its offsets file, which ends with the size of the store
+    """
+
+    global DOCSTORE_SIZE
+
+    offsets = []
+    for record in records:
+        offsets.append(DOCSTORE_SIZE)
+        DOCSTORE_SIZE += len(record)
+    if is_last:
+        offsets.append(DOCSTORE_SIZE)
+
+    with open(os.path.join(index_dir, DOCSTORE_FILE), "ab") as f:
+        f.write(b"".join(records))
+    with open(os.path.join(index_dir, DOCSTORE_OFFSETS_FILE), "ab") as f:
+        f.write(encode_offsets(offsets))
+
+
 def write_temp_idf_files(token_to_idf_map, file_count):
 
     file_name = os.path.join(index_dir, f"temp_idf_{file_count}.txt")
@@ -287,14 +456,21 @@ def write_temp_idf_files(token_to_idf_map, file_count):
 
 def write_pages_in_temp_index_files(field_type, index_map, file_count):
 
+    # The same doc ids and counts come up over and over again
+    encode = cache(base_64_encode)
+
     index_filename = os.path.join(
         index_dir, f"temp_index_{field_type}_{file_count}.txt"
     )
     with open(index_filename, "w") as f:
-        lines = [
-            f"{token} {' '.join(index_map[token])}"
-            for token in sorted(index_map.keys())
-        ]
+        lines = []
+        for token in sorted(index_map.keys()):
+            postings = index_map[token]
+            documents = [
+                f"{encode(doc_id)}:{encode(token_count)}"
+                for doc_id, token_count in zip(postings[::2], postings[1::2])
+            ]
+            lines.append(f"{token} {' '.join(documents)}")
         f.writelines("\n".join(lines))
 
 
@@ -307,14 +483,39 @@ def write_final_idf_files(data, file_count):
         f.write("\n".join(data))
 
 
+def encode_index_lines(data):
+
+    # The records follow the header of the file
+    records, offsets = [], [len(POSTINGS_FILE_HEADER)]
+    for line in data:
+        token, *documents = line.split()
+        doc_ids, tfs = [], []
+        for document in documents:
+            enc_doc_id, enc_tf = document.split(":")
+            doc_ids.append(base_64_decode(enc_doc_id))
+            tfs.append(base_64_decode(enc_tf))
+
+        records.append(encode_postings(token, doc_ids, tfs))
+        offsets.append(offsets[-1] + len(records[-1]))
+
+    return records, offsets
+
+
 def write_final_index_file(page_count, field_type, data, offsets):
 
     global TOP_LINES_IN_FINAL_INDEX
     TOP_LINES_IN_FINAL_INDEX[field_type].append(data[0].split()[0])
 
-    file_name = os.path.join(index_dir, f"index_{field_type}_{page_count}.txt")
-    with open(file_name, "w") as f:
-        f.write("\n".join(data))
+    if postings_format == POSTINGS_FORMAT_BINARY:
+        records, offsets = encode_index_lines(data)
+        file_name = os.path.join(index_dir, f"index_{field_type}_{page_count}.bin")
+        with open(file_name, "wb") as f:
+            f.write(POSTINGS_FILE_HEADER)
+            f.write(b"".join(records))
+    else:
+        file_name = os.path.join(index_dir, f"index_{field_type}_{page_count}.txt")
+        with open(file_name, "w") as f:
+            f.write("\n".join(data))
 
     file_name = os.path.join(index_dir, f"offsets_{field_type}_{page_count}.txt")
     with open(file_name, "w") as f:
@@ -341,659 +542,1572 @@ def write_pre_index_files():
     with open(file_name, "w") as f:
         f.write("\n".join(ARTICLE_TITLE_PRE_INDEX))
 
+    write_idf_pre_index_file()
+
+
+def write_idf_pre_index_file():
+
     file_name = os.path.join(index_dir, f"pre_index_idf.txt")
     with open(file_name, "w") as f:
         f.write("\n".join(IDF_PRE_INDEX))
 
 
+def write_snapshot_file():
+    """
+    Packs the pre index files and the offsets files of the index into
+    its snapshot, which the searcher maps at startup
+    """
+
+    sections = {}
+    for field_type in FIELD_TYPE_TO_INDEX_MAP:
+        file_name = os.path.join(index_dir, f"pre_index_{field_type}.txt")
+        if not os.path.exists(file_name):
+            continue
+
+        with open(file_name, "r") as f:
+            headings = [line.strip() for line in f.readlines()]
+        sections[f"pre_index_{field_type}"] = encode_keys(headings)
+
+        for file_num in range(len(headings)):
+            file_name = os.path.join(index_dir, f"offsets_{field_type}_{file_num}.txt")
+            with open(file_name, "r") as f:
+                offsets = [int(offset) for offset in f.read().split("\n")]
+            sections[f"offsets_{field_type}_{file_num}"] = encode_numbers(offsets)
+
+    file_name = os.path.join(index_dir, "pre_index_idf.txt")
+    if os.path.exists(file_name):
+        with open(file_name, "r") as f:
+            sections["pre_index_idf"] = encode_keys(f.read().split())
+
+    file_name = os.path.join(index_dir, "pre_index_titles.txt")
+    if os.path.exists(file_name):
+        with open(file_name, "r") as f:
+            first_doc_ids = [base_64_decode(i) for i in f.read().split()]
+        sections["pre_index_titles"] = encode_numbers(first_doc_ids)
+
+    write_snapshot(os.path.join(index_dir, SNAPSHOT_FILE), sections)
+
+
+def open_merge_file(file_name, mode):
+
+    global OPEN_MERGE_FILE_COUNT
+    global PEAK_OPEN_MERGE_FILE_COUNT
+
+    OPEN_MERGE_FILE_COUNT += 1
+    PEAK_OPEN_MERGE_FILE_COUNT = max(PEAK_OPEN_MERGE_FILE_COUNT, OPEN_MERGE_FILE_COUNT)
+    return open(file_name, mode, buffering=MERGE_BUFFER_SIZE)
+
+
+def close_merge_file(f):
+
+    global OPEN_MERGE_FILE_COUNT
+
+    f.close()
+    OPEN_MERGE_FILE_COUNT -= 1
+
+
+def read_temp_file(file_name, file_num):
+
+    f = open_merge_file(file_name, "r")
+    try:
+        for line in f:
+            if line.startswith(" "):
+                continue
+            line = line.strip()
+            if len(line) == 0:
+                break
+            token, rest = line.split(maxsplit=1)
+            yield token, file_num, rest
+    finally:
+        close_merge_file(f)
+
+    os.remove(file_name)
+
+
+def merge_temp_files(file_names):
+    """
+    Merges sorted temp files, yields every token with the rest of its
+    lines (postings or article counts) in the order of the files, which
+    is the order of the doc ids
+    """
+
+    temp_files = [
+        read_temp_file(file_name, file_num)
+        for file_num, file_name in enumerate(file_names)
+    ]
+    merged_lines = heapq.merge(*temp_files)
+    for token, lines in groupby(merged_lines, key=lambda line: line[0]):
+        yield token, [rest for _, _, rest in lines]
+
+
+def join_index_lines(token, lines):
+    return " ".join([token, *lines])
+
+
+def join_idf_lines(token, lines):
+    return f"{token} {sum(int(article_count) for article_count in lines)}"
+
+
+def reduce_temp_files(prefix, join_lines):
+    """
+    Merges the temp files `{prefix}_{n}.txt` MERGE_FAN_IN at a time, level
+    by level, until at most MERGE_FAN_IN of them are left, so that the
+    final merge never has more than MERGE_FAN_IN files open
+    """
+
+    file_names = [
+        os.path.join(index_dir, f"{prefix}_{file_num}.txt")
+        for file_num in range(TEMP_INDEX_FILE_COUNT)
+    ]
+
+    level = 0
+    while len(file_names) > MERGE_FAN_IN:
+        level += 1
+        merged_file_names = []
+        for start in range(0, len(file_names), MERGE_FAN_IN):
+            merged_file_name = os.path.join(
+                index_dir, f"{prefix}_level_{level}_{len(merged_file_names)}.txt"
+            )
+            f = open_merge_file(merged_file_name, "w")
+            for token, lines in merge_temp_files(
+                file_names[start : start + MERGE_FAN_IN]
+            ):
+                f.write(join_lines(token, lines))
+                f.write("\n")
+            close_merge_file(f)
+            merged_file_names.append(merged_file_name)
+        file_names = merged_file_names
+
+    return file_names
+
+
 def merge_temp_index_files(field_type):
 
-    (
-        priority_queue,
-        top_lines,
-        top_line_words,
-        fds,
-        page_count,
-        buffer_token_count,
-        total_token_count,
-        current_word,
-        current_data,
-        current_frequency,
-        data,
-        offsets,
-    ) = ([], {}, {}, {}, 0, 1, 0, "", "", 0, [], [0])
-
-    for file_num in range(TEMP_INDEX_FILE_COUNT):
-        file_name = os.path.join(index_dir, f"temp_index_{field_type}_{file_num}.txt")
-        fds[file_num] = open(file_name, "r")
-
-        top_lines[file_num] = fds[file_num].readline()
-        if top_lines[file_num].startswith(" "):
-            top_lines[file_num] = fds[file_num].readline()
-        top_lines[file_num] = top_lines[file_num].strip()
-
-        if len(top_lines[file_num]) > 0:
-            top_line_words[file_num] = top_lines[file_num].split()
-            heapq.heappush(priority_queue, (top_line_words[file_num][0], file_num))
-
-    while len(priority_queue) > 0:
-        top_element = heapq.heappop(priority_queue)
-        new_file_num = top_element[1]
-
-        if buffer_token_count % NUMBER_OF_TOKENS_PER_FILE == 0:
+    page_count, total_token_count, data, offsets = 0, 0, [], [0]
+
+    file_names = reduce_temp_files(f"temp_index_{field_type}", join_index_lines)
+    for token, lines in merge_temp_files(file_names):
+        if len(data) == NUMBER_OF_TOKENS_PER_FILE:
             write_final_index_file(page_count, field_type, data, offsets)
             page_count += 1
             data = []
-            buffer_token_count = 1
             offsets = [0]
 
-        if current_word == top_element[0]:
-            current_data = " ".join([current_data, *top_line_words[new_file_num][1:]])
-            current_word = top_element[0]
-            current_frequency += 1
-        else:
-            if len(current_word) > 0:
-                data.append(current_data)
-                offsets.append(len(current_data) + 1 + offsets[-1])
-                buffer_token_count += 1
-                total_token_count += 1
-            current_word = top_element[0]
-            current_data = top_lines[new_file_num]
-            current_frequency = 1
-
-        top_lines[new_file_num] = fds[new_file_num].readline().strip()
-        if len(top_lines[new_file_num]) == 0:
-            fds[new_file_num].close()
-            top_line_words[new_file_num] = []
-            file_name = os.path.join(
-                index_dir, f"temp_index_{field_type}_{new_file_num}.txt"
-            )
-            os.remove(file_name)
-        else:
-            top_line_words[new_file_num] = top_lines[new_file_num].split()
-            heapq.heappush(
-                priority_queue, (top_line_words[new_file_num][0], new_file_num)
-            )
+        data.append(join_index_lines(token, lines))
+        offsets.append(len(data[-1]) + 1 + offsets[-1])
+        total_token_count += 1
 
-    data.append(current_data)
-    offsets.append(len(current_data) + 1 + offsets[-1])
-    buffer_token_count += 1
-    write_final_index_file(page_count, field_type, data, offsets)
+    if len(data) > 0:
+        write_final_index_file(page_count, field_type, data, offsets)
 
     return total_token_count
 
 
 def merge_temp_idf_files():
 
-    (
-        priority_queue,
-        fds,
-        frequencies,
-        page_count,
-        buffer_token_count,
-        current_word,
-        current_frequency,
-        data,
-    ) = ([], {}, {}, 0, 1, "", 0, [])
-
-    for file_num in range(TEMP_INDEX_FILE_COUNT):
-        file_name = os.path.join(index_dir, f"temp_idf_{file_num}.txt")
-        fds[file_num] = open(file_name, "r")
-        top_line = fds[file_num].readline().strip()
-        if len(top_line) != 0:
-            top_line = top_line.split()
-            frequencies[file_num] = int(top_line[1])
-            heapq.heappush(priority_queue, (top_line[0], file_num))
-
-    while len(priority_queue) > 0:
-        top_element = heapq.heappop(priority_queue)
-        new_file_num = top_element[1]
-
-        if buffer_token_count % NUMBER_OF_TOKENS_PER_FILE == 0:
+    page_count, total_token_count, data = 0, 0, []
+
+    file_names = reduce_temp_files("temp_idf", join_idf_lines)
+    for token, lines in merge_temp_files(file_names):
+        if len(data) == NUMBER_OF_TOKENS_PER_FILE:
             write_final_idf_files(data, page_count)
             page_count += 1
             data = []
-            buffer_token_count = 1
 
-        if current_word == top_element[0] or current_word == "":
-            current_word = top_element[0]
-            current_frequency += frequencies[new_file_num]
-        else:
-            buffer_token_count += 1
-            # freq = handle_frequency(TOTAL_ARTICLE_COUNT / current_frequency, 6)
-            freq = TOTAL_ARTICLE_COUNT / current_frequency
-            data.append(f"{current_word} {freq}")
-            current_word = top_element[0]
-            current_frequency = frequencies[new_file_num]
-
-        top_line = fds[new_file_num].readline().strip()
-        if len(top_line) == 0:
-            fds[new_file_num].close()
-            frequencies[new_file_num] = 0
-            file_name = os.path.join(index_dir, f"temp_idf_{new_file_num}.txt")
-            os.remove(file_name)
+        # The number of articles with the token is kept along with its idf,
+        # so that the idf of several segments can be computed exactly
+        article_count = sum(int(article_count) for article_count in lines)
+        freq = TOTAL_ARTICLE_COUNT / article_count
+        data.append(f"{token} {freq} {article_count}")
+        total_token_count += 1
+
+    if len(data) > 0:
+        write_final_idf_files(data, page_count)
+
+    return total_token_count
+
+
+def init_merge_worker(
+    worker_index_dir,
+    worker_postings_format,
+    temp_index_file_count,
+    total_article_count,
+    merge_fan_in,
+):
+
+    global index_dir
+    global postings_format
+    global TEMP_INDEX_FILE_COUNT
+    global TOTAL_ARTICLE_COUNT
+    global MERGE_FAN_IN
+
+    index_dir = worker_index_dir
+    postings_format = worker_postings_format
+    TEMP_INDEX_FILE_COUNT = temp_index_file_count
+    TOTAL_ARTICLE_COUNT = total_article_count
+    MERGE_FAN_IN = merge_fan_in
+
+
+def merge_file_type(file_type):
+    """
+    Merges the temp files of a field type (or the idf ones), returns
+    what the pre index files need from it and the peak number of files
+    it had open at once
+    """
+
+    global PEAK_OPEN_MERGE_FILE_COUNT
+    PEAK_OPEN_MERGE_FILE_COUNT = 0
+
+    start_time = time.perf_counter()
+
+    if file_type == FILE_TYPE_IDF:
+        IDF_PRE_INDEX.clear()
+        merge_temp_idf_files()
+        token_count, top_lines = 0, list(IDF_PRE_INDEX)
+    else:
+        TOP_LINES_IN_FINAL_INDEX[file_type] = []
+        token_count = merge_temp_index_files(file_type)
+        top_lines = TOP_LINES_IN_FINAL_INDEX[file_type]
+
+    elapsed_time = time.perf_counter() - start_time
+    return (
+        file_type,
+        token_count,
+        top_lines,
+        PEAK_OPEN_MERGE_FILE_COUNT,
+        elapsed_time,
+    )
+
+
+def merge_index(workers):
+    """
+    Merges the temp files of the six field types and the idf ones, in
+    `workers` processes, returns the number of tokens and the peak number
+    of files a merge process had open at once. The time taken by each of
+    them is the stage `merge_{file_type}`
+    """
+
+    global IDF_PRE_INDEX
+
+    # Largest first, so that it does not start last
+    file_types = [
+        FIELD_TYPE_BODY,
+        FIELD_TYPE_REFERENCES,
+        FIELD_TYPE_EXTERNAL_LINKS,
+        FIELD_TYPE_CATEGORIES,
+        FIELD_TYPE_INFOBOX,
+        FIELD_TYPE_TITLE,
+        FILE_TYPE_IDF,
+    ]
+
+    if workers == 1:
+        merge_results = [merge_file_type(file_type) for file_type in file_types]
+    else:
+        with multiprocessing.Pool(
+            processes=min(workers, len(file_types)),
+            initializer=init_merge_worker,
+            initargs=(
+                index_dir,
+                postings_format,
+                TEMP_INDEX_FILE_COUNT,
+                TOTAL_ARTICLE_COUNT,
+                MERGE_FAN_IN,
+            ),
+        ) as pool:
+            merge_results = pool.map(merge_file_type, file_types, chunksize=1)
+
+    total_token_count, peak_open_file_count = 0, 0
+    for (
+        file_type,
+        token_count,
+        top_lines,
+        open_file_count,
+        elapsed_time,
+    ) in merge_results:
+        STAGE_STATS.add_time(f"merge_{file_type}", elapsed_time)
+        if file_type == FILE_TYPE_IDF:
+            IDF_PRE_INDEX = top_lines
         else:
-            top_line = top_line.split()
-            frequencies[new_file_num] = int(top_line[1])
-            heapq.heappush(priority_queue, (top_line[0], new_file_num))
+            TOP_LINES_IN_FINAL_INDEX[file_type] = top_lines
+        total_token_count += token_count
+        peak_open_file_count = max(peak_open_file_count, open_file_count)
 
-    # freq = handle_frequency(TOTAL_ARTICLE_COUNT / current_frequency, 6)
-    freq = TOTAL_ARTICLE_COUNT / current_frequency
-    data.append(f"{current_word} {freq}")
-    write_final_idf_files(data, page_count)
+    return total_token_count, peak_open_file_count
 
 
 # >>>
 
 # Indexing <<<
-INDEX_MAP_TITLE = defaultdict(list)
-INDEX_MAP_BODY = defaultdict(list)
-INDEX_MAP_INFOBOX = defaultdict(list)
-INDEX_MAP_CATEGORIES = defaultdict(list)
-INDEX_MAP_EXTERNAL_LINKS = defaultdict(list)
-INDEX_MAP_REFERENCES = defaultdict(list)
+# The postings of a token are kept as doc id, count, doc id, count, ...
+# in an array instead of as strings, and only formatted when written
+new_postings = partial(array, "I")
+
+INDEX_MAP_TITLE = defaultdict(new_postings)
+INDEX_MAP_BODY = defaultdict(new_postings)
+INDEX_MAP_INFOBOX = defaultdict(new_postings)
+INDEX_MAP_CATEGORIES = defaultdict(new_postings)
+INDEX_MAP_EXTERNAL_LINKS = defaultdict(new_postings)
+INDEX_MAP_REFERENCES = defaultdict(new_postings)
+
+FIELD_TYPE_TO_INDEX_MAP = {
+    FIELD_TYPE_TITLE: INDEX_MAP_TITLE,
+    FIELD_TYPE_BODY: INDEX_MAP_BODY,
+    FIELD_TYPE_INFOBOX: INDEX_MAP_INFOBOX,
+    FIELD_TYPE_CATEGORIES: INDEX_MAP_CATEGORIES,
+    FIELD_TYPE_EXTERNAL_LINKS: INDEX_MAP_EXTERNAL_LINKS,
+    FIELD_TYPE_REFERENCES: INDEX_MAP_REFERENCES,
+}
 
 TOP_LINES_IN_FINAL_INDEX = defaultdict(list)
 
 ARTICLE_ID_TO_TITLE_MAP = []
 ARTICLE_TITLE_PRE_INDEX = []
+DOCSTORE_RECORDS = []
+DOCSTORE_SIZE = 0
 IDF_PRE_INDEX = []
 TOTAL_ARTICLE_COUNT = 0
 ARTICLE_TITLES_FILE_OFFSET = [0]
 TOKEN_TO_ARTICLE_COUNT = defaultdict(int)
 
+# The doc ids of a delta segment follow the ones of the segments before it
+FIRST_ARTICLE_ID = 0
 PAGE_COUNT = 0
 ARTICLE_MAPPING_FILE_COUNT = 0
 TEMP_INDEX_FILE_COUNT = 0
+POSTINGS_COUNT = 0
 
-
-def create_pre_index(
-    title, body, infobox, categories, external_links, references, original_title
+count_unstemmed_tokens = False
+UNSTEMMED_TOKENS = set()
+UNSTEMMED_TOKENS_IN_BATCH = set()
+STEM_CACHE = StemCache(STEM_CACHE_SIZE)
+STEM_CACHE_STATS = {}
+OPEN_MERGE_FILE_COUNT = 0
+PEAK_OPEN_MERGE_FILE_COUNT = 0
+
+STAGE_STATS = StageStats()
+PARSE_STAGE_STATS = StageStats()
+INDEXING_START_TIME = 0
+LAST_PROGRESS_TIME = 0
+
+
+def count_article_tokens(
+    article_id,
+    title,
+    body,
+    infobox,
+    categories,
+    external_links,
+    references,
+    index_maps,
+    token_to_article_count,
 ):
 
-    global INDEX_MAP_TITLE
-    global INDEX_MAP_BODY
-    global INDEX_MAP_INFOBOX
-    global INDEX_MAP_CATEGORIES
-    global INDEX_MAP_EXTERNAL_LINKS
-    global INDEX_MAP_REFERENCES
-    global PAGE_COUNT
-    global TEMP_INDEX_FILE_COUNT
+    field_counters = [
+        (FIELD_TYPE_TITLE, Counter(title)),
+        (FIELD_TYPE_BODY, Counter(body)),
+        (FIELD_TYPE_INFOBOX, Counter(infobox)),
+        (FIELD_TYPE_CATEGORIES, Counter(categories)),
+        (FIELD_TYPE_EXTERNAL_LINKS, Counter(external_links)),
+        (FIELD_TYPE_REFERENCES, Counter(references)),
+    ]
 
-    global ARTICLE_ID_TO_TITLE_MAP
-    global ARTICLE_MAPPING_FILE_COUNT
-    global TOTAL_ARTICLE_COUNT
-    global ARTICLE_TITLES_FILE_OFFSET
-    global TOKEN_TO_ARTICLE_COUNT
-
-    article_id = base_64_encode(PAGE_COUNT)
-    # title_file_line = (
-    #     f"{article_id} {len(title)} {len(body)} {len(infobox)} {len(categories)}"
-    #     f" {len(references)} {len(external_links)} {original_title}"
-    # )
-    title_file_line = f"{article_id} {original_title}"
-    ARTICLE_ID_TO_TITLE_MAP.append(title_file_line)
-    # ARTICLE_TITLES_FILE_OFFSET.append(
-    #     ARTICLE_TITLES_FILE_OFFSET[-1] + len(title_file_line) + 1
-    # )
-    TOTAL_ARTICLE_COUNT += 1
-
-    # title_counter = Counter(title)
-    # body_counter = Counter(body)
-    # infobox_counter = Counter(infobox)
-    # categories_counter = Counter(categories)
-    # external_links_counter = Counter(external_links)
-    # references_counter = Counter(references)
-    # combined_counter = (
-    #     title_counter
-    #     + body_counter
-    #     + infobox_counter
-    #     + categories_counter
-    #     + external_links_counter
-    #     + references_counter
-    # )
-
-    title_counter = defaultdict(int)
-    body_counter = defaultdict(int)
-    infobox_counter = defaultdict(int)
-    categories_counter = defaultdict(int)
-    external_links_counter = defaultdict(int)
-    references_counter = defaultdict(int)
-    combined_counter = defaultdict(int)
-
-    for token in title:
-        title_counter[token] += 1
-        combined_counter[token] += 1
-
-    for token in body:
-        body_counter[token] += 1
-        combined_counter[token] += 1
-
-    for token in infobox:
-        infobox_counter[token] += 1
-        combined_counter[token] += 1
-
-    for token in categories:
-        categories_counter[token] += 1
-        combined_counter[token] += 1
-
-    for token in external_links:
-        external_links_counter[token] += 1
-        combined_counter[token] += 1
-
-    for token in references:
-        references_counter[token] += 1
-        combined_counter[token] += 1
-
-    for token in combined_counter:
-        in_title = title_counter[token]
-        in_body = body_counter[token]
-        in_infobox = infobox_counter[token]
-        in_categories = categories_counter[token]
-        in_external_links = external_links_counter[token]
-        in_references = references_counter[token]
-
-        if in_title > 0:
-            INDEX_MAP_TITLE[token].append(f"{article_id}:{base_64_encode(in_title)}")
-        if in_body > 0:
-            INDEX_MAP_BODY[token].append(f"{article_id}:{base_64_encode(in_body)}")
-        if in_infobox > 0:
-            INDEX_MAP_INFOBOX[token].append(
-                f"{article_id}:{base_64_encode(in_infobox)}"
-            )
-        if in_categories > 0:
-            INDEX_MAP_CATEGORIES[token].append(
-                f"{article_id}:{base_64_encode(in_categories)}"
-            )
-        if in_external_links > 0:
-            INDEX_MAP_EXTERNAL_LINKS[token].append(
-                f"{article_id}:{base_64_encode(in_external_links)}"
-            )
-        if in_references > 0:
-            INDEX_MAP_REFERENCES[token].append(
-                f"{article_id}:{base_64_encode(in_references)}"
-            )
+    for field_type, field_counter in field_counters:
+        index_map = index_maps[field_type]
+        for token, token_count in field_counter.items():
+            postings = index_map[token]
+            postings.append(article_id)
+            postings.append(token_count)
 
-        TOKEN_TO_ARTICLE_COUNT[token] += 1
+    article_tokens = set()
+    for _, field_counter in field_counters:
+        article_tokens.update(field_counter.keys())
 
-    PAGE_COUNT += 1
+    for token in article_tokens:
+        token_to_article_count[token] += 1
 
-    if PAGE_COUNT % NUMBER_OF_TITLES_PER_FILE == 0:
-        write_article_id_to_title_mappings(
-            ARTICLE_ID_TO_TITLE_MAP,
-            ARTICLE_TITLES_FILE_OFFSET,
-            ARTICLE_MAPPING_FILE_COUNT,
-        )
-        ARTICLE_MAPPING_FILE_COUNT += 1
-        ARTICLE_TITLES_FILE_OFFSET = [0]
-        ARTICLE_ID_TO_TITLE_MAP = []
 
-    if PAGE_COUNT % NUMBER_OF_PAGES_PER_PREINDEX_FILE == 0:
+def parse_articles(batch):
+    """
+    Parses and counts the tokens of a batch of articles. Nothing in here
+    depends on the other batches, so this is what the worker processes
+    run when indexing with more than one worker. The stem cache stats of
+    the process and the unstemmed tokens of the batch (if counted) come
+    with the results.
+    """
 
-        write_pages_in_temp_index_files(
-            FIELD_TYPE_TITLE,
-            INDEX_MAP_TITLE,
-            TEMP_INDEX_FILE_COUNT,
-        )
-        write_pages_in_temp_index_files(
-            FIELD_TYPE_BODY,
-            INDEX_MAP_BODY,
-            TEMP_INDEX_FILE_COUNT,
-        )
-        write_pages_in_temp_index_files(
-            FIELD_TYPE_INFOBOX,
-            INDEX_MAP_INFOBOX,
-            TEMP_INDEX_FILE_COUNT,
-        )
-        write_pages_in_temp_index_files(
-            FIELD_TYPE_CATEGORIES,
-            INDEX_MAP_CATEGORIES,
-            TEMP_INDEX_FILE_COUNT,
+    first_article_id, articles = batch
+    UNSTEMMED_TOKENS_IN_BATCH.clear()
+    PARSE_STAGE_STATS.clear()
+
+    index_maps = {
+        field_type: defaultdict(new_postings) for field_type in FIELD_TYPE_TO_INDEX_MAP
+    }
+    token_to_article_count = defaultdict(int)
+    titles, article_lengths = [], []
+
+    for article_id, (article_title, article_text) in enumerate(
+        articles, start=first_article_id
+    ):
+        (
+            title,
+            body,
+            infobox,
+            categories,
+            external_links,
+            references,
+        ) = process_text(article_title, article_text)
+
+        start_time = time.perf_counter()
+        count_article_tokens(
+            article_id,
+            title,
+            body,
+            infobox,
+            categories,
+            external_links,
+            references,
+            index_maps,
+            token_to_article_count,
         )
-        write_pages_in_temp_index_files(
-            FIELD_TYPE_EXTERNAL_LINKS,
-            INDEX_MAP_EXTERNAL_LINKS,
-            TEMP_INDEX_FILE_COUNT,
-        )
-        write_pages_in_temp_index_files(
-            FIELD_TYPE_REFERENCES,
-            INDEX_MAP_REFERENCES,
-            TEMP_INDEX_FILE_COUNT,
+        PARSE_STAGE_STATS.add_time("count_tokens", time.perf_counter() - start_time)
+
+        titles.append(article_title)
+        article_lengths.append(
+            len(title)
+            + len(body)
+            + len(infobox)
+            + len(categories)
+            + len(external_links)
+            + len(references)
         )
 
-        write_temp_idf_files(TOKEN_TO_ARTICLE_COUNT, TEMP_INDEX_FILE_COUNT)
+    PARSE_STAGE_STATS.count("articles", len(articles))
+    PARSE_STAGE_STATS.count("indexed_tokens", sum(article_lengths))
 
-        INDEX_MAP_TITLE.clear()
-        INDEX_MAP_BODY.clear()
-        INDEX_MAP_INFOBOX.clear()
-        INDEX_MAP_CATEGORIES.clear()
-        INDEX_MAP_EXTERNAL_LINKS.clear()
-        INDEX_MAP_REFERENCES.clear()
+    parse_stats = (
+        os.getpid(),
+        STEM_CACHE.get_stats(),
+        set(UNSTEMMED_TOKENS_IN_BATCH),
+        PARSE_STAGE_STATS.get_stats(),
+    )
+    return titles, article_lengths, index_maps, token_to_article_count, parse_stats
 
-        TEMP_INDEX_FILE_COUNT += 1
 
+def add_parse_stats(pid, stem_cache_stats, unstemmed_tokens, stage_stats):
 
-# >>>
+    STEM_CACHE_STATS[pid] = stem_cache_stats
+    UNSTEMMED_TOKENS.update(unstemmed_tokens)
+    STAGE_STATS.add_stats(stage_stats)
 
-# Article Parsing <<<
-def process_text(title: str, text: str):
 
-    # Fold Case
-    text = text.lower()
-    title = title.lower()
+def init_parse_worker(worker_count_unstemmed_tokens):
 
-    # extract references
-    for sep in {"== ", " =="}:
-        text = text.replace(sep, "==")
-    data = text.split("==references==")
+    global count_unstemmed_tokens
+    count_unstemmed_tokens = worker_count_unstemmed_tokens
 
-    final_title = tokenize_and_stem(title)
-    final_body = extract_body(data[0])
-    final_infobox = extract_infobox(data[0])
-    final_categories = extract_categories(text)
 
-    if len(data) == 1:
-        # No references
-        final_references = []
-        final_external_links = []
-    else:
-        final_references = extract_references(data[1])
-        final_external_links = extract_external_links(data[1])
+def create_pre_index(titles, article_lengths, index_maps, token_to_article_count):
 
-    return (
-        final_title,
-        final_body,
-        final_infobox,
-        final_categories,
-        final_external_links,
-        final_references,
-    )
+    global POSTINGS_COUNT
 
+    start_time = time.perf_counter()
+    add_article_titles(titles, article_lengths)
 
-def tokenize_and_stem(text):
-
-    global UNSTEMMED_TOKENS
-
-    text = text.encode("ascii", errors="ignore").decode()
-
-    for sym in {
-        "&nbsp;",
-        "&lt;",
-        "&gt;",
-        "&amp;",
-        "&quot;",
-        "&apos;",
-        "—",
-        "%",
-        "$",
-        "'",
-        "~",
-        "|",
-        ".",
-        "*",
-        "[",
-        "]",
-        ":",
-        ";",
-        ",",
-        "{",
-        "}",
-        "(",
-        ")",
-        "=",
-        "+",
-        "-",
-        "_",
-        "#",
-        "!",
-        "`",
-        '"',
-        "?",
-        "/",
-        ">",
-        "<",
-        "&",
-        "\\",
-    }:
-        text = text.replace(sym, " ")
-
-    text = text.split()
-
-    for token in text:
-        UNSTEMMED_TOKENS.add(token)
-
-    text = [stem_word(token) for token in text]
-    text = [
-        token
-        for token in text
-        if (
-            (token.isalpha())
-            and (token not in ENGLISH_STOPWORDS)
-            and (3 < len(token) < 15)
-        )
-        or (token.isnumeric() and len(token) <= 7)
-    ]
+    postings_count = 0
+    for field_type, index_map in index_maps.items():
+        pre_index_map = FIELD_TYPE_TO_INDEX_MAP[field_type]
+        for token, postings in index_map.items():
+            pre_index_map[token].extend(postings)
+            postings_count += len(postings) // 2
+    POSTINGS_COUNT += postings_count
 
-    return text
+    for token, article_count in token_to_article_count.items():
+        TOKEN_TO_ARTICLE_COUNT[token] += article_count
 
+    STAGE_STATS.add_time("create_pre_index", time.perf_counter() - start_time)
+    STAGE_STATS.count("postings", postings_count)
 
-def extract_body(text):
+    if memory_budget is None:
+        # Batches never cross this boundary (see WikiXMLHandler), so the temp
+        # index files are cut at the same pages however the batches were parsed
+        if TOTAL_ARTICLE_COUNT % NUMBER_OF_PAGES_PER_PREINDEX_FILE == 0:
+            write_temp_index_files()
+    elif get_index_maps_size() >= memory_budget:
+        write_temp_index_files()
 
-    # remove infobox
-    text = REGEX_INFOBOX.sub(repl=" ", string=text)
-    # remove any remaining {{}}
-    text = REGEX_BRACES.sub(repl=" ", string=text)
+    print_progress()
 
-    return tokenize_and_stem(text)
 
+def add_article_titles(titles, article_lengths):
 
-def extract_infobox(text):
+    global PAGE_COUNT
+    global ARTICLE_ID_TO_TITLE_MAP
+    global ARTICLE_MAPPING_FILE_COUNT
+    global TOTAL_ARTICLE_COUNT
+    global ARTICLE_TITLES_FILE_OFFSET
+    global DOCSTORE_RECORDS
+
+    for original_title, article_length in zip(titles, article_lengths):
+        article_id = base_64_encode(PAGE_COUNT)
+        # title_file_line = (
+        #     f"{article_id} {len(title)} {len(body)} {len(infobox)} {len(categories)}"
+        #     f" {len(references)} {len(external_links)} {original_title}"
+        # )
+        title_file_line = f"{article_id} {original_title}"
+        ARTICLE_ID_TO_TITLE_MAP.append(title_file_line)
+        DOCSTORE_RECORDS.append(encode_document(original_title, article_length))
+        # ARTICLE_TITLES_FILE_OFFSET.append(
+        #     ARTICLE_TITLES_FILE_OFFSET[-1] + len(title_file_line) + 1
+        # )
+        TOTAL_ARTICLE_COUNT += 1
+        PAGE_COUNT += 1
+
+        if PAGE_COUNT % NUMBER_OF_TITLES_PER_FILE == 0:
+            write_article_id_to_title_mappings(
+                ARTICLE_ID_TO_TITLE_MAP,
+                ARTICLE_TITLES_FILE_OFFSET,
+                ARTICLE_MAPPING_FILE_COUNT,
+            )
+            write_docstore_records(DOCSTORE_RECORDS)
+            ARTICLE_MAPPING_FILE_COUNT += 1
+            ARTICLE_TITLES_FILE_OFFSET = [0]
+            ARTICLE_ID_TO_TITLE_MAP = []
+            DOCSTORE_RECORDS = []
 
-    start_index = 0
-    if not text.startswith("{{infobox"):
-        start_index = 1
 
-    infobox = []
+def write_remaining_article_titles():
 
-    text = text.split("{{infobox")
-    for t in text[start_index:]:
-        lines = t.split("\n")
-        for line in lines:
-            if line == "}}":
-                break
-            infobox.append(line)
+    global ARTICLE_ID_TO_TITLE_MAP
+    global ARTICLE_MAPPING_FILE_COUNT
+    global ARTICLE_TITLES_FILE_OFFSET
+    global DOCSTORE_RECORDS
 
-    return tokenize_and_stem(" ".join(infobox))
+    if len(ARTICLE_ID_TO_TITLE_MAP) != 0:
+        write_article_id_to_title_mappings(
+            ARTICLE_ID_TO_TITLE_MAP,
+            ARTICLE_TITLES_FILE_OFFSET,
+            ARTICLE_MAPPING_FILE_COUNT,
+        )
+    write_docstore_records(DOCSTORE_RECORDS, is_last=True)
+    ARTICLE_ID_TO_TITLE_MAP = []
+    ARTICLE_TITLES_FILE_OFFSET = [0]
+    ARTICLE_MAPPING_FILE_COUNT += 1
+    DOCSTORE_RECORDS = []
 
 
-def extract_categories(text):
+def get_index_maps_size():
+    """
+    Estimated size in bytes of the postings held in memory
+    """
 
-    matches = REGEX_CATEGORY.findall(string=text)
+    token_count = len(TOKEN_TO_ARTICLE_COUNT)
+    for index_map in FIELD_TYPE_TO_INDEX_MAP.values():
+        token_count += len(index_map)
 
-    return tokenize_and_stem(" ".join(matches))
+    return POSTING_SIZE * POSTINGS_COUNT + TOKEN_ENTRY_SIZE * token_count
 
 
-def extract_references(text):
+def get_peak_rss():
+    """
+    Peak resident set size of the process, in bytes
+    """
 
-    text = text.split("\n\n", maxsplit=1)[0].replace("reflist", " ")
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak_rss
+    return peak_rss << 10
 
-    return tokenize_and_stem(text)
 
+def write_temp_index_files():
 
-def extract_external_links(text):
+    global TEMP_INDEX_FILE_COUNT
+    global POSTINGS_COUNT
 
-    text = text.split("==external links==")
-    if len(text) == 1:
-        return []
-    else:
-        return tokenize_and_stem(text[1].split("\n\n", maxsplit=1)[0])
+    start_time = time.perf_counter()
 
+    print(
+        f"Temp index file {TEMP_INDEX_FILE_COUNT}: {PAGE_COUNT} pages indexed,"
+        f" {get_index_maps_size() / (1 << 20):.1f} MB of postings in memory,"
+        f" peak RSS {get_peak_rss() / (1 << 20):.1f} MB"
+    )
 
-# >>>
+    for field_type, index_map in FIELD_TYPE_TO_INDEX_MAP.items():
+        write_pages_in_temp_index_files(field_type, index_map, TEMP_INDEX_FILE_COUNT)
+        index_map.clear()
 
-# XML Parsing <<<
-class WikiXMLHandler(xml.sax.ContentHandler):
-    """
-    This class is the ContentHandler that will be used
-    by SAX parser to extract different usefule data from
-    XML dump
-    """
+    # The article counts are added up over all the temp idf files when
+    # merging, so they have to start from zero in each of them
+    write_temp_idf_files(TOKEN_TO_ARTICLE_COUNT, TEMP_INDEX_FILE_COUNT)
+    TOKEN_TO_ARTICLE_COUNT.clear()
+    POSTINGS_COUNT = 0
 
-    def __init__(self):
+    TEMP_INDEX_FILE_COUNT += 1
 
-        self.current_element = ""
+    STAGE_STATS.add_time("write_temp_files", time.perf_counter() - start_time)
 
-        self.article_title = ""
-        self.article_text = ""
 
-    def startElement(self, name, attrs):
+def print_progress():
+    """
+    Prints the pages indexed so far, their rate and the time taken by
+    every stage, at most once every PROGRESS_INTERVAL seconds
+    """
 
-        self.current_element = name
+    global LAST_PROGRESS_TIME
+
+    now = time.perf_counter()
+    if PROGRESS_INTERVAL <= 0 or now - LAST_PROGRESS_TIME < PROGRESS_INTERVAL:
+        return
+    LAST_PROGRESS_TIME = now
+
+    elapsed_time = now - INDEXING_START_TIME
+    page_count = PAGE_COUNT - FIRST_ARTICLE_ID
+    dump_size = STAGE_STATS.counters["dump_bytes"] / (1 << 20)
+    print(
+        f"Progress: {page_count} pages in {elapsed_time:.0f} seconds"
+        f" ({page_count / elapsed_time:.1f} pages/s,"
+        f" {dump_size / elapsed_time:.2f} MB/s of dump),"
+        f" {STAGE_STATS.get_summary()}",
+        flush=True,
+    )
 
-    def endElement(self, name):
 
-        if name == "page":
+def index_dump(dump_file, workers, multistream_index_file=None, shard=None):
 
-            self.article_title = self.article_title.strip()
-            self.article_text = self.article_text.strip()
+    global INDEXING_START_TIME
+    global LAST_PROGRESS_TIME
 
-            if not any(
-                self.article_title.startswith(meta_title)
-                for meta_title in ["Wikipedia:", "File:", "Template:"]
-            ):
-                (
-                    title,
-                    body,
-                    infobox,
-                    categories,
-                    external_links,
-                    references,
-                ) = process_text(self.article_title, self.article_text)
-
-                create_pre_index(
-                    title,
-                    body,
-                    infobox,
-                    categories,
-                    external_links,
-                    references,
-                    self.article_title.strip(),
-                )
-
-            self.article_title = ""
-            self.article_text = ""
+    INDEXING_START_TIME = LAST_PROGRESS_TIME = time.perf_counter()
 
-    def characters(self, content):
+    if workers == 1:
+        if multistream_index_file is None:
+            dump_chunks = read_dump_chunks(dump_file, shard)
+        else:
+            dump_chunks = read_multistream_dump_chunks(
+                dump_file, multistream_index_file, None, workers, shard
+            )
 
-        if self.current_element == "title":
-            self.article_title = f"{self.article_title}{content}"
+        for batch in read_article_batches(dump_chunks):
+            *parsed_batch, parse_stats = parse_articles(batch)
+            create_pre_index(*parsed_batch)
+            add_parse_stats(*parse_stats)
+        return
+
+    with multiprocessing.Pool(
+        processes=workers,
+        initializer=init_parse_worker,
+        initargs=(count_unstemmed_tokens,),
+    ) as pool:
+        if multistream_index_file is None:
+            dump_chunks = read_dump_chunks(dump_file, shard)
+        else:
+            dump_chunks = read_multistream_dump_chunks(
+                dump_file, multistream_index_file, pool, workers, shard
+            )
 
-        elif self.current_element == "text":
-            self.article_text = f"{self.article_text}{content}"
+        for *parsed_batch, parse_stats in imap_bounded(
+            pool, parse_articles, read_article_batches(dump_chunks), workers
+        ):
+            create_pre_index(*parsed_batch)
+            add_parse_stats(*parse_stats)
 
 
-# >>>
+def imap_bounded(pool, func, iterable, workers):
+    """
+    Like `pool.imap`, but only hands out a bounded number of tasks at a
+    time, otherwise the whole dump would be read into memory ahead of
+    the workers
+    """
 
-# Running Script <<<
-if __name__ == "__main__":
+    max_pending_tasks = NUMBER_OF_PENDING_BATCHES_PER_WORKER * workers
+    pending_tasks = deque()
 
-    # Handle Arguments
+    for item in iterable:
+        pending_tasks.append(pool.apply_async(func, (item,)))
+        if len(pending_tasks) >= max_pending_tasks:
+            yield pending_tasks.popleft().get()
 
-    if len(sys.argv) < 4:
-        print("Expected three arguments: dump_file, index_dir & stats_file")
-        exit(1)
+    while len(pending_tasks) > 0:
+        yield pending_tasks.popleft().get()
 
-    dump_file = sys.argv[1]
-    index_dir = sys.argv[2]
-    stat_file = sys.argv[3]
 
-    if not os.path.exists(dump_file):
-        print("Dump file doesn't exist")
-        exit(1)
+def build_index(dump_file, workers, multistream_index_file=None, shard=None):
+    """
+    Indexes the dump (or one shard of it) into index_dir, returns the
+    number of tokens of the index
+    """
 
-    if os.path.exists(index_dir):
-        shutil.rmtree(index_dir)
+    index_dump(dump_file, workers, multistream_index_file, shard)
+
+    write_remaining_article_titles()
+    write_temp_index_files()
+
+    merge_start_time = time.perf_counter()
+    net_count, peak_open_file_count = merge_index(workers)
+    merge_elapsed_time = time.perf_counter() - merge_start_time
+
+    print(
+        f"Merging took {merge_elapsed_time} seconds,"
+        f" with at most {peak_open_file_count} files open per process."
+    )
+
+    start_time = time.perf_counter()
+    write_pre_index_files()
+    write_snapshot_file()
+    write_segment_info()
+    STAGE_STATS.add_time("write_pre_index", time.perf_counter() - start_time)
+
+    # Sent with the stage stats of a shard
+    hits, misses, evictions, _ = get_stem_cache_totals()
+    STAGE_STATS.count("stem_cache_hits", hits)
+    STAGE_STATS.count("stem_cache_misses", misses)
+    STAGE_STATS.count("stem_cache_evictions", evictions)
+
+    return net_count
+
+
+def get_stem_cache_totals():
+    return map(sum, zip((0, 0, 0, 0), *STEM_CACHE_STATS.values()))
+
+
+def print_stem_cache_stats():
+
+    hits, misses, evictions, entries = get_stem_cache_totals()
+    print(
+        f"Stem cache: {hits} hits, {misses} misses"
+        f" ({hits / max(hits + misses, 1):.1%} hit rate), {evictions} evictions,"
+        f" {entries} entries in {len(STEM_CACHE_STATS)} processes."
+    )
+    if count_unstemmed_tokens:
+        print(f"{len(UNSTEMMED_TOKENS)} distinct tokens before stemming.")
+
+
+# >>>
+
+
+# Delta Segments <<<
+def get_segment_dirs(base_dir):
+    """
+    Directories of the segments of an index, the base one first and then
+    the delta ones in the order in which they were added
+    """
+
+    # Not the `.partial` ones, still being built
+    delta_nums = sorted(
+        int(file_name[len(DELTA_DIR_PREFIX) :])
+        for file_name in os.listdir(base_dir)
+        if file_name.startswith(DELTA_DIR_PREFIX)
+        and file_name[len(DELTA_DIR_PREFIX) :].isdigit()
+    )
+    return [
+        base_dir,
+        *[os.path.join(base_dir, f"{DELTA_DIR_PREFIX}{num}") for num in delta_nums],
+    ]
+
+
+def read_segment_info(segment_dir):
+    """
+    Returns the first doc id and the number of articles of a segment
+    """
+
+    with open(os.path.join(segment_dir, SEGMENT_INFO_FILE), "r") as f:
+        first_article_id, article_count = f.read().split()
+    return int(first_article_id), int(article_count)
+
+
+def write_segment_info():
+
+    file_name = os.path.join(index_dir, SEGMENT_INFO_FILE)
+    with open(file_name, "w") as f:
+        f.write(f"{FIRST_ARTICLE_ID} {TOTAL_ARTICLE_COUNT}")
+
+
+def get_postings_format(segment_dir):
+
+    for file_name in os.listdir(segment_dir):
+        if file_name.startswith("index_") and file_name.endswith(".bin"):
+            return POSTINGS_FORMAT_BINARY
+    return POSTINGS_FORMAT_TEXT
+
+
+def read_tombstones(base_dir):
+    """
+    Bitmap of the doc ids of the articles deleted or changed since they
+    were indexed: bit `doc_id % 8` of byte `doc_id // 8`
+    """
+
+    file_name = os.path.join(base_dir, TOMBSTONES_FILE)
+    if not os.path.exists(file_name):
+        return bytearray()
+
+    with open(file_name, "rb") as f:
+        return bytearray(f.read())
+
+
+def write_tombstones(base_dir, tombstones):
+
+    # Replaced at once, so that a searcher never reads half of it
+    file_name = os.path.join(base_dir, TOMBSTONES_FILE)
+    with open(f"{file_name}.tmp", "wb") as f:
+        f.write(tombstones)
+    os.replace(f"{file_name}.tmp", file_name)
+
+
+def add_tombstone(tombstones, doc_id):
+
+    byte_num = doc_id >> 3
+    if byte_num >= len(tombstones):
+        tombstones.extend(bytes(byte_num + 1 - len(tombstones)))
+    tombstones[byte_num] |= 1 << (doc_id & 7)
+
+
+def is_tombstoned(tombstones, doc_id):
+
+    byte_num = doc_id >> 3
+    return byte_num < len(tombstones) and (tombstones[byte_num] >> (doc_id & 7)) & 1
+
+
+def read_segment_titles(segment_dir):
+    """
+    Yields the doc id and the title of every article of a segment
+    """
+
+    file_num = 0
+    while True:
+        file_name = os.path.join(segment_dir, f"article_titles_{file_num}.txt")
+        if not os.path.exists(file_name):
+            break
+
+        with open(file_name, "r") as f:
+            for line in f.read().split("\n"):
+                enc_doc_id, title = line.split(" ", maxsplit=1)
+                yield base_64_decode(enc_doc_id), title
+        file_num += 1
+
+
+def read_segment_article_lengths(segment_dir):
+    """
+    Yields the length of every article of a segment, from its document
+    store, or 0 if it was built before there was one
+    """
+
+    docstore_file_name = os.path.join(segment_dir, DOCSTORE_FILE)
+    if not os.path.exists(docstore_file_name):
+        while True:
+            yield 0
+
+    with open(docstore_file_name, "rb") as f:
+        docstore = f.read()
+    with open(os.path.join(segment_dir, DOCSTORE_OFFSETS_FILE), "rb") as f:
+        offsets = f.read()
+
+    for _, _, article_length in read_documents(docstore, offsets):
+        yield article_length
+
+
+def remove_articles(base_dir, segment_dirs, titles):
+    """
+    Tombstones the articles of the segments that have one of the
+    `titles`, returns the number of articles tombstoned
+    """
+
+    tombstones = read_tombstones(base_dir)
+    removed_count = 0
+
+    for segment_dir in segment_dirs:
+        for doc_id, title in read_segment_titles(segment_dir):
+            if title in titles and not is_tombstoned(tombstones, doc_id):
+                add_tombstone(tombstones, doc_id)
+                removed_count += 1
+
+    write_tombstones(base_dir, tombstones)
+    return removed_count
+
+
+def read_segment_postings(segment_dir, field_type):
+    """
+    Yields every token of a field of a segment, in order, with the arrays
+    of its doc ids and term frequencies
+    """
+
+    extension = "bin" if postings_format == POSTINGS_FORMAT_BINARY else "txt"
+
+    file_num = 0
+    while True:
+        file_name = os.path.join(
+            segment_dir, f"index_{field_type}_{file_num}.{extension}"
+        )
+        if not os.path.exists(file_name):
+            break
+
+        if postings_format == POSTINGS_FORMAT_BINARY:
+            with open(file_name, "rb") as f:
+                records = memoryview(f.read())
+            check_postings_header(records, file_name)
+            offsets_file_name = os.path.join(
+                segment_dir, f"offsets_{field_type}_{file_num}.txt"
+            )
+            with open(offsets_file_name, "r") as f:
+                offsets = [int(offset) for offset in f.read().split("\n")]
+
+            for start, end in zip(offsets, offsets[1:]):
+                doc_ids, tfs, _ = decode_postings(records[start:end])
+                yield decode_token(records[start:end]), doc_ids, tfs
+        else:
+            with open(file_name, "r") as f:
+                for line in f:
+                    token, *documents = line.split()
+                    doc_ids, tfs = array("I"), array("I")
+                    for document in documents:
+                        enc_doc_id, enc_tf = document.split(":")
+                        doc_ids.append(base_64_decode(enc_doc_id))
+                        tfs.append(base_64_decode(enc_tf))
+                    yield token, doc_ids, tfs
+        file_num += 1
+
+
+def read_segment_article_counts(segment_dir):
+    """
+    Yields every token of a segment, in order, with the number of its
+    articles that have it
+    """
+
+    file_num = 0
+    while True:
+        file_name = os.path.join(segment_dir, f"idf_{file_num}.txt")
+        if not os.path.exists(file_name):
+            break
+
+        with open(file_name, "r") as f:
+            for line in f.read().split("\n"):
+                token, _, article_count = line.split()
+                yield token, int(article_count)
+        file_num += 1
+
+
+def compact_segment(segment_dir, file_num, tombstones):
+    """
+    Adds the articles of a segment that are not tombstoned to the titles
+    files, and writes their postings and article counts into the temp
+    files `file_num`, to be merged like the ones of a dump. Their doc ids
+    are renumbered to follow the ones of the segments before
+    """
+
+    first_article_id, _ = read_segment_info(segment_dir)
+
+    # -1 for the tombstoned articles
+    new_article_ids, titles, article_lengths = array("l"), [], []
+    for (article_id, title), article_length in zip(
+        read_segment_titles(segment_dir), read_segment_article_lengths(segment_dir)
+    ):
+        if is_tombstoned(tombstones, article_id):
+            new_article_ids.append(-1)
+        else:
+            new_article_ids.append(PAGE_COUNT + len(titles))
+            titles.append(title)
+            article_lengths.append(article_length)
+    add_article_titles(titles, article_lengths)
+
+    encode = cache(base_64_encode)
+    tombstoned_articles = defaultdict(set)
+
+    for field_type in FIELD_TYPE_TO_INDEX_MAP:
+        index_filename = os.path.join(
+            index_dir, f"temp_index_{field_type}_{file_num}.txt"
+        )
+        with open(index_filename, "w") as f:
+            for token, doc_ids, tfs in read_segment_postings(segment_dir, field_type):
+                documents = []
+                for doc_id, token_count in zip(doc_ids, tfs):
+                    new_doc_id = new_article_ids[doc_id - first_article_id]
+                    if new_doc_id < 0:
+                        tombstoned_articles[token].add(doc_id)
+                    else:
+                        documents.append(
+                            f"{base_64_encode(new_doc_id)}:{encode(token_count)}"
+                        )
+                if len(documents) > 0:
+                    f.write(f"{token} {' '.join(documents)}\n")
+
+    write_segment_temp_idf_file(segment_dir, file_num, tombstoned_articles)
+
+
+def write_segment_temp_idf_file(segment_dir, file_num, tombstoned_articles):
+    """
+    Writes the number of articles with each token of a segment (less the
+    `tombstoned_articles` with it) into the temp idf file `file_num`
+    """
+
+    idf_file_name = os.path.join(index_dir, f"temp_idf_{file_num}.txt")
+    with open(idf_file_name, "w") as f:
+        for token, token_article_count in read_segment_article_counts(segment_dir):
+            if token in tombstoned_articles:
+                token_article_count -= len(tombstoned_articles[token])
+            if token_article_count > 0:
+                f.write(f"{token} {token_article_count}\n")
+
+
+# >>>
+
+
+# Shards <<<
+def build_shard(
+    shard_num,
+    num_shards,
+    dump_file,
+    shard_dir,
+    workers,
+    multistream_index_file,
+    shard_postings_format,
+    shard_memory_budget,
+    merge_fan_in,
+    shard_count_unstemmed_tokens,
+    progress_interval,
+    stats_connection,
+):
+    """
+    Builds the index of a shard of the dump into `shard_dir`, with doc ids
+    from 0, in a process of its own, and sends its stage stats through
+    `stats_connection`
+    """
+
+    global index_dir
+    global postings_format
+    global memory_budget
+    global MERGE_FAN_IN
+    global count_unstemmed_tokens
+    global PROGRESS_INTERVAL
+
+    index_dir = shard_dir
+    postings_format = shard_postings_format
+    memory_budget = shard_memory_budget
+    MERGE_FAN_IN = merge_fan_in
+    count_unstemmed_tokens = shard_count_unstemmed_tokens
+    PROGRESS_INTERVAL = progress_interval
+
+    start_time = time.perf_counter()
 
     os.mkdir(index_dir)
+    build_index(dump_file, workers, multistream_index_file, (shard_num, num_shards))
 
-    # import cProfile, pstats
-    #
-    # with cProfile.Profile() as prof:
+    elapsed_time = time.perf_counter() - start_time
+
+    print(
+        f"Shard {shard_num}: {TOTAL_ARTICLE_COUNT} articles indexed in"
+        f" {elapsed_time} seconds."
+    )
+    print_stem_cache_stats()
+
+    stats_connection.send(STAGE_STATS.get_stats())
+    stats_connection.close()
+
+
+def build_shards(dump_file, num_shards, workers, multistream_index_file):
+    """
+    Builds the shards of the dump in parallel, each in a process (with
+    `workers` processes of its own), then merges their idf into the one
+    of the whole dump. Returns the number of tokens of this idf
+    """
+
+    shard_dirs = [
+        os.path.join(index_dir, f"{SHARD_DIR_PREFIX}{shard_num}")
+        for shard_num in range(num_shards)
+    ]
+    stats_connections = [multiprocessing.Pipe(duplex=False) for _ in shard_dirs]
+
+    processes = [
+        multiprocessing.Process(
+            target=build_shard,
+            args=(
+                shard_num,
+                num_shards,
+                dump_file,
+                shard_dir,
+                workers,
+                multistream_index_file,
+                postings_format,
+                memory_budget,
+                MERGE_FAN_IN,
+                count_unstemmed_tokens,
+                PROGRESS_INTERVAL,
+                stats_connections[shard_num][1],
+            ),
+        )
+        for shard_num, shard_dir in enumerate(shard_dirs)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    if any(process.exitcode != 0 for process in processes):
+        print("Building a shard failed")
+        exit(1)
+
+    # The stages of the shards are added up, as the ones of workers are
+    for receiving_connection, _ in stats_connections:
+        STAGE_STATS.add_stats(receiving_connection.recv())
+
+    start_time = time.perf_counter()
+    token_count = merge_shard_idf_files(shard_dirs)
+    STAGE_STATS.add_time("merge_shard_idf", time.perf_counter() - start_time)
+
+    return token_count
+
+
+def merge_shard_idf_files(shard_dirs):
+    """
+    Writes the idf of the whole dump from the ones of its shards, and
+    the doc ids of the shards into SHARDS_FILE
+    """
+
+    global TEMP_INDEX_FILE_COUNT
+    global TOTAL_ARTICLE_COUNT
+    global IDF_PRE_INDEX
+
+    shard_lines = []
+    for file_num, shard_dir in enumerate(shard_dirs):
+        _, article_count = read_segment_info(shard_dir)
+        shard_lines.append(
+            f"{os.path.basename(shard_dir)} {TOTAL_ARTICLE_COUNT} {article_count}"
+        )
+        TOTAL_ARTICLE_COUNT += article_count
+        write_segment_temp_idf_file(shard_dir, file_num, {})
+
+    TEMP_INDEX_FILE_COUNT = len(shard_dirs)
+    IDF_PRE_INDEX = []
+    token_count = merge_temp_idf_files()
+    write_idf_pre_index_file()
+    write_snapshot_file()
+
+    with open(os.path.join(index_dir, SHARDS_FILE), "w") as f:
+        f.write("\n".join(shard_lines))
+
+    return token_count
+
+
+# >>>
+
+
+# Article Parsing <<<
+def process_text(title: str, text: str):
+
+    # Fold Case
+    text = text.lower()
+    title = title.lower()
 
     start_time = time.perf_counter()
+    body, infobox, categories, references, external_links = scan_wikitext(text)
+    end_time = time.perf_counter()
+    PARSE_STAGE_STATS.add_time("scan_wikitext", end_time - start_time)
+
+    start_time = end_time
+    fields = [
+        tokenize(title),
+        tokenize(body),
+        tokenize(infobox),
+        tokenize(categories),
+        tokenize(external_links),
+        tokenize(references),
+    ]
+    end_time = time.perf_counter()
+    PARSE_STAGE_STATS.add_time("tokenize", end_time - start_time)
+    PARSE_STAGE_STATS.count("tokens", sum(map(len, fields)))
+
+    start_time = end_time
+    fields = stem_article_tokens(fields)
+    PARSE_STAGE_STATS.add_time("stem", time.perf_counter() - start_time)
+
+    return fields
+
+
+def scan_wikitext(text):
+    """
+    Splits the wikitext of an article into the text of its fields. Only the
+    positions of the markup are visited, each found with `str.find` or a
+    regex with a literal prefix. Templates are matched with their nesting:
+    the body is the text outside of all of them, up to the references or
+    external links, and the infobox is everything inside `{{infobox`
+    """
+
+    sections, body_end = {}, len(text)
+    if "==" in text:
+        for match in REGEX_SECTION.finditer(text):
+            if match.group(1) not in sections:
+                sections[match.group(1)] = match.end()
+                body_end = min(body_end, match.start())
+
+    categories = []
+    if "[[category:" in text:
+        categories = REGEX_CATEGORY.findall(text)
+
+    body, infobox = [], []
+    body_start, depth, infobox_depth, infobox_start = 0, 0, -1, 0
+    open_at, close_at = text.find("{{"), text.find("}}")
+
+    while open_at >= 0 or close_at >= 0:
+        if close_at < 0 or 0 <= open_at < close_at:
+            if depth == 0:
+                if body_start < body_end:
+                    body.append(text[body_start : min(open_at, body_end)])
+                # The rest of a template that is never closed is body
+                body_start = open_at
+            if infobox_depth < 0 and text.startswith("infobox", open_at + 2):
+                infobox_depth = depth
+                infobox_start = open_at + len("{{infobox")
+            depth += 1
+            open_at = text.find("{{", open_at + 2)
+
+        else:
+            # A stray }} closes nothing
+            if depth > 0:
+                depth -= 1
+                if depth == infobox_depth:
+                    infobox.append(text[infobox_start:close_at])
+                    infobox_depth = -1
+                if depth == 0:
+                    body_start = close_at + 2
+            close_at = text.find("}}", close_at + 2)
+
+    if body_start < body_end:
+        body.append(text[body_start:body_end])
+
+    references = ""
+    if "references" in sections:
+        references = get_paragraph(text, sections["references"])
+        references = references.replace("reflist", " ")
+
+    external_links = ""
+    if "external links" in sections:
+        external_links = get_paragraph(text, sections["external links"])
+
+    return (
+        " ".join(body),
+        " ".join(infobox),
+        " ".join(categories),
+        references,
+        external_links,
+    )
+
+
+def get_paragraph(text, start):
+
+    end = text.find("\n\n", start)
+    if end < 0:
+        return text[start:]
+    return text[start:end]
+
+
+def stem_article_tokens(fields):
+    """
+    Stems and filters the tokens of all the fields of an article, with
+    each distinct token of the article looked up only once
+    """
+
+    article_tokens = set()
+    for tokens in fields:
+        article_tokens.update(tokens)
+
+    if count_unstemmed_tokens:
+        UNSTEMMED_TOKENS_IN_BATCH.update(article_tokens)
+
+    stems = STEM_CACHE.stem(article_tokens)
+    return [list(filter(None, map(stems.__getitem__, tokens))) for tokens in fields]
+
+
+# >>>
+
+
+# XML Parsing <<<
+class WikiXMLHandler(xml.sax.ContentHandler):
+    """
+    This class is the ContentHandler that will be used
+    by SAX parser to extract different usefule data from
+    XML dump. The articles are only collected here, in
+    batches, and are parsed by `parse_articles`
+    """
+
+    def __init__(self):
+
+        self.current_element = ""
+
+        # Character data comes in many small chunks, so it is collected in
+        # lists and joined once at the end of the page
+        self.article_title = []
+        self.article_text = []
+
+        self.article_count = 0
+        self.batch = []
+        self.batches = []
+
+    def startElement(self, name, attrs):
+
+        self.current_element = name
+
+    def endElement(self, name):
+
+        self.current_element = ""
+
+        if name == "page":
+
+            article_title = "".join(self.article_title).strip()
+            article_text = "".join(self.article_text).strip()
+
+            if not any(
+                article_title.startswith(meta_title)
+                for meta_title in ["Wikipedia:", "File:", "Template:"]
+            ):
+                self.batch.append((article_title, article_text))
+                self.article_count += 1
+
+                if (
+                    len(self.batch) == NUMBER_OF_ARTICLES_PER_BATCH
+                    or self.article_count % NUMBER_OF_PAGES_PER_PREINDEX_FILE == 0
+                ):
+                    self.end_batch()
+
+            self.article_title = []
+            self.article_text = []
+
+    def characters(self, content):
+
+        if self.current_element == "title":
+            self.article_title.append(content)
+
+        elif self.current_element == "text":
+            self.article_text.append(content)
+
+    def end_batch(self):
+
+        if len(self.batch) > 0:
+            first_article_id = FIRST_ARTICLE_ID + self.article_count - len(self.batch)
+            self.batches.append((first_article_id, self.batch))
+            self.batch = []
+
+    def pop_batches(self):
+
+        batches = self.batches
+        self.batches = []
+        return batches
+
+
+def read_article_batches(dump_chunks):
+    """
+    Yields the batches of articles of the dump. The time taken by reading
+    (and decompressing) the dump is the stage `read_dump`, and the one
+    taken by the SAX parser the stage `sax_parse`
+    """
 
     wiki_xml_handler = WikiXMLHandler()
 
     xml_parser = xml.sax.make_parser()
     xml_parser.setFeature(xml.sax.handler.feature_namespaces, 0)
     xml_parser.setContentHandler(wiki_xml_handler)
-    xml_parser.parse(dump_file)
 
-    if len(ARTICLE_ID_TO_TITLE_MAP) != 0:
-        write_article_id_to_title_mappings(
-            ARTICLE_ID_TO_TITLE_MAP,
-            ARTICLE_TITLES_FILE_OFFSET,
-            ARTICLE_MAPPING_FILE_COUNT,
+    dump_chunks = iter(dump_chunks)
+    while True:
+        start_time = time.perf_counter()
+        chunk = next(dump_chunks, None)
+        end_time = time.perf_counter()
+        STAGE_STATS.add_time("read_dump", end_time - start_time)
+        if chunk is None:
+            break
+        STAGE_STATS.count("dump_bytes", len(chunk))
+
+        xml_parser.feed(chunk)
+        STAGE_STATS.add_time("sax_parse", time.perf_counter() - end_time)
+        yield from wiki_xml_handler.pop_batches()
+
+    start_time = time.perf_counter()
+    xml_parser.close()
+    wiki_xml_handler.end_batch()
+    STAGE_STATS.add_time("sax_parse", time.perf_counter() - start_time)
+    yield from wiki_xml_handler.pop_batches()
+
+
+# >>>
+
+# Reading Dump <<<
+DUMP_FILE_OPENERS = {
+    ".bz2": bz2.open,
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+}
+
+
+def open_dump_file(file_name):
+
+    extension = os.path.splitext(file_name)[1]
+    return DUMP_FILE_OPENERS.get(extension, open)(file_name, "rb")
+
+
+def read_dump_chunks(dump_file, shard=None):
+
+    if shard is not None:
+        yield from read_shard_dump_chunks(dump_file, *shard)
+        return
+
+    with open_dump_file(dump_file) as f:
+        while True:
+            chunk = f.read(XML_READ_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+
+def find_in_file(f, pattern, start):
+    """
+    Offset of the first `pattern` in the file at or after `start`, or -1
+    """
+
+    f.seek(start)
+    data = b""
+    while True:
+        chunk = f.read(XML_READ_CHUNK_SIZE)
+        if len(chunk) == 0:
+            return -1
+
+        # Keeps the end of the previous chunk, in case the pattern spans both
+        data = data[-(len(pattern) - 1) :] + chunk
+        indx = data.find(pattern)
+        if indx >= 0:
+            return f.tell() - len(data) + indx
+
+
+def get_shard_offsets(dump_file, num_shards):
+    """
+    Splits an uncompressed dump into `num_shards` byte ranges of about the
+    same size, each starting at a <page> (but the first). The ranges of
+    the shards are between consecutive offsets
+    """
+
+    dump_size = os.path.getsize(dump_file)
+    offsets = [0]
+
+    with open(dump_file, "rb") as f:
+        # The shards left after the last page only get the footer
+        f.seek(max(dump_size - XML_READ_CHUNK_SIZE, 0))
+        footer_offset = f.tell() + f.read().rfind(b"</mediawiki>")
+
+        for shard_num in range(1, num_shards):
+            start = max(dump_size * shard_num // num_shards, offsets[-1])
+            offset = find_in_file(f, b"<page>", start)
+            if offset < 0 or offset > footer_offset:
+                offset = footer_offset
+            offsets.append(offset)
+
+    offsets.append(dump_size)
+    return offsets
+
+
+def wrap_shard_chunks(chunks, start, end, dump_size):
+    """
+    The pages of a shard are parsed like a whole dump, so unless the shard
+    starts with the header or ends with the footer of the dump, they are
+    wrapped in a root element
+    """
+
+    if start == end:
+        yield b"<mediawiki></mediawiki>"
+        return
+
+    if start > 0:
+        yield b"<mediawiki>"
+    yield from chunks
+    if end < dump_size:
+        yield b"</mediawiki>"
+
+
+def read_shard_dump_chunks(dump_file, shard_num, num_shards):
+
+    offsets = get_shard_offsets(dump_file, num_shards)
+    start, end = offsets[shard_num], offsets[shard_num + 1]
+
+    def read_range():
+        with open(dump_file, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(XML_READ_CHUNK_SIZE, remaining))
+                remaining -= len(chunk)
+                yield chunk
+
+    yield from wrap_shard_chunks(read_range(), start, end, offsets[-1])
+
+
+def get_multistream_ranges(dump_file, multistream_index_file, shard=None):
+    """
+    Groups the bz2 streams of a multistream dump (or of a shard of it,
+    a range of its streams) into byte ranges. The index has a
+    `{offset}:{page_id}:{title}` line for every page, and does not cover
+    the streams holding the header and the footer of the XML, which are
+    the bytes before the first and after the last offset
+    """
+
+    offsets = [0]
+    with open_dump_file(multistream_index_file) as f:
+        for line in f:
+            offset = int(line.split(b":", maxsplit=1)[0])
+            if offset != offsets[-1]:
+                offsets.append(offset)
+    offsets.append(os.path.getsize(dump_file))
+
+    if shard is not None:
+        shard_num, num_shards = shard
+        stream_count = len(offsets) - 1
+        first_stream = stream_count * shard_num // num_shards
+        end_stream = stream_count * (shard_num + 1) // num_shards
+        offsets = offsets[first_stream : end_stream + 1]
+
+    ranges = []
+    for indx in range(0, len(offsets) - 1, NUMBER_OF_STREAMS_PER_DECOMPRESSION_TASK):
+        end_indx = min(
+            indx + NUMBER_OF_STREAMS_PER_DECOMPRESSION_TASK, len(offsets) - 1
         )
-    ARTICLE_ID_TO_TITLE_MAP = []
-    ARTICLE_TITLES_FILE_OFFSET = [0]
-    ARTICLE_MAPPING_FILE_COUNT += 1
+        ranges.append((offsets[indx], offsets[end_indx]))
 
-    write_pages_in_temp_index_files(
-        FIELD_TYPE_TITLE,
-        INDEX_MAP_TITLE,
-        TEMP_INDEX_FILE_COUNT,
-    )
-    write_pages_in_temp_index_files(
-        FIELD_TYPE_BODY,
-        INDEX_MAP_BODY,
-        TEMP_INDEX_FILE_COUNT,
-    )
-    write_pages_in_temp_index_files(
-        FIELD_TYPE_INFOBOX,
-        INDEX_MAP_INFOBOX,
-        TEMP_INDEX_FILE_COUNT,
-    )
-    write_pages_in_temp_index_files(
-        FIELD_TYPE_CATEGORIES,
-        INDEX_MAP_CATEGORIES,
-        TEMP_INDEX_FILE_COUNT,
-    )
-    write_pages_in_temp_index_files(
-        FIELD_TYPE_EXTERNAL_LINKS,
-        INDEX_MAP_EXTERNAL_LINKS,
-        TEMP_INDEX_FILE_COUNT,
-    )
-    write_pages_in_temp_index_files(
-        FIELD_TYPE_REFERENCES,
-        INDEX_MAP_REFERENCES,
-        TEMP_INDEX_FILE_COUNT,
-    )
-    write_temp_idf_files(TOKEN_TO_ARTICLE_COUNT, TEMP_INDEX_FILE_COUNT)
+    return ranges
 
-    INDEX_MAP_TITLE.clear()
-    INDEX_MAP_BODY.clear()
-    INDEX_MAP_INFOBOX.clear()
-    INDEX_MAP_CATEGORIES.clear()
-    INDEX_MAP_EXTERNAL_LINKS.clear()
-    INDEX_MAP_REFERENCES.clear()
 
-    TEMP_INDEX_FILE_COUNT += 1
+def decompress_dump_range(task):
 
-    net_count = 0
-    net_count += merge_temp_index_files(FIELD_TYPE_TITLE)
-    net_count += merge_temp_index_files(FIELD_TYPE_BODY)
-    net_count += merge_temp_index_files(FIELD_TYPE_INFOBOX)
-    net_count += merge_temp_index_files(FIELD_TYPE_CATEGORIES)
-    net_count += merge_temp_index_files(FIELD_TYPE_EXTERNAL_LINKS)
-    net_count += merge_temp_index_files(FIELD_TYPE_REFERENCES)
-    merge_temp_idf_files()
+    dump_file, start, end = task
+    with open(dump_file, "rb") as f:
+        f.seek(start)
+        return bz2.decompress(f.read(end - start))
 
-    write_pre_index_files()
 
-    elapsed_time = time.perf_counter() - start_time
+def read_multistream_dump_chunks(
+    dump_file, multistream_index_file, pool, workers, shard=None
+):
+    """
+    Decompresses the streams of a multistream dump in the processes of
+    `pool` (in this one if there is none). A shard of the dump is a range
+    of its groups of streams
+    """
 
-    print(f"Indexing took {elapsed_time} seconds.")
+    ranges = get_multistream_ranges(dump_file, multistream_index_file, shard)
+    tasks = ((dump_file, start, end) for start, end in ranges)
+    if pool is None:
+        dump_chunks = map(decompress_dump_range, tasks)
+    else:
+        dump_chunks = imap_bounded(pool, decompress_dump_range, tasks, workers)
+
+    if shard is None:
+        yield from dump_chunks
+    elif len(ranges) == 0:
+        yield b"<mediawiki></mediawiki>"
+    else:
+        dump_size = os.path.getsize(dump_file)
+        yield from wrap_shard_chunks(
+            dump_chunks, ranges[0][0], ranges[-1][1], dump_size
+        )
+
+
+# >>>
+
+
+# Running Script <<<
+def write_stat_file(stat_file, net_count):
 
     with open(stat_file, "w") as f:
         index_size = (
@@ -1007,7 +2121,325 @@ if __name__ == "__main__":
 
         f.write(f"{index_size}\n{net_count}\n{files_count}")
 
-    # stats = pstats.Stats(prof)
-    # stats.sort_stats(pstats.SortKey.TIME)
-    # stats.dump_stats(filename="prof.prof")
+
+def write_stage_stats_file(stats_file, elapsed_time, net_count):
+    """
+    Writes the time taken by every stage of the indexing, with its number
+    of calls, and the counters, as JSON
+    """
+
+    seconds, calls, counters = STAGE_STATS.get_stats()
+    stats = {
+        "elapsed_seconds": elapsed_time,
+        "articles": TOTAL_ARTICLE_COUNT,
+        "index_tokens": net_count,
+        "peak_rss_bytes": get_peak_rss(),
+        "stages": {
+            stage: {"seconds": seconds[stage], "calls": calls[stage]}
+            for stage in sorted(seconds, key=lambda stage: -seconds[stage])
+        },
+        "counters": counters,
+    }
+
+    with open(stats_file, "w") as f:
+        json.dump(stats, f, indent=2)
+        f.write("\n")
+
+
+def compact_main():
+    """
+    Merges the segments of an index into one, without the tombstoned
+    articles. The result is the index of a dump of the articles left, in
+    the order of the segments
+    """
+
+    global index_dir
+    global postings_format
+    global MERGE_FAN_IN
+    global TEMP_INDEX_FILE_COUNT
+
+    arg_parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} compact")
+    arg_parser.add_argument("index_dir")
+    arg_parser.add_argument("stat_file")
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes merging the index",
+    )
+    arg_parser.add_argument(
+        "--merge-fan-in",
+        type=int,
+        default=MERGE_FAN_IN,
+        help="max number of temp files merged at once",
+    )
+    args = arg_parser.parse_args(sys.argv[2:])
+
+    base_dir = os.path.normpath(args.index_dir)
+    MERGE_FAN_IN = args.merge_fan_in
+
+    if args.workers < 1:
+        print("Number of workers should be at least 1")
+        exit(1)
+
+    if MERGE_FAN_IN < 2:
+        print("Merge fan-in should be at least 2")
+        exit(1)
+
+    if not os.path.exists(os.path.join(base_dir, SEGMENT_INFO_FILE)):
+        print("Index directory has no index to compact")
+        exit(1)
+
+    start_time = time.perf_counter()
+
+    segment_dirs = get_segment_dirs(base_dir)
+    tombstones = read_tombstones(base_dir)
+    postings_format = get_postings_format(base_dir)
+
+    index_dir = f"{base_dir}.compact"
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    os.mkdir(index_dir)
+
+    for file_num, segment_dir in enumerate(segment_dirs):
+        compact_segment(segment_dir, file_num, tombstones)
+    TEMP_INDEX_FILE_COUNT = len(segment_dirs)
+    write_remaining_article_titles()
+
+    net_count, _ = merge_index(args.workers)
+    write_pre_index_files()
+    write_snapshot_file()
+    write_segment_info()
+
+    # Swapped in only once complete
+    os.rename(base_dir, f"{base_dir}.old")
+    os.rename(index_dir, base_dir)
+    shutil.rmtree(f"{base_dir}.old")
+    index_dir = base_dir
+
+    elapsed_time = time.perf_counter() - start_time
+
+    print(
+        f"Compacting {len(segment_dirs)} segments took {elapsed_time} seconds,"
+        f" {TOTAL_ARTICLE_COUNT} articles left."
+    )
+
+    write_stat_file(args.stat_file, net_count)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 and sys.argv[1] == "compact":
+        compact_main()
+        exit(0)
+
+    # Handle Arguments
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("dump_file")
+    arg_parser.add_argument("index_dir")
+    arg_parser.add_argument("stat_file")
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes parsing the articles and merging the index",
+    )
+    arg_parser.add_argument(
+        "--postings-format",
+        choices=[POSTINGS_FORMAT_TEXT, POSTINGS_FORMAT_BINARY],
+        default=POSTINGS_FORMAT_TEXT,
+        help="format of the final index files",
+    )
+    arg_parser.add_argument(
+        "--multistream-index",
+        help="offsets index of a multistream bz2 dump, to decompress it in parallel",
+    )
+    arg_parser.add_argument(
+        "--memory-budget",
+        type=int,
+        help="MB of postings to hold in memory before writing a temp index file,"
+        f" instead of every {NUMBER_OF_PAGES_PER_PREINDEX_FILE} pages",
+    )
+    arg_parser.add_argument(
+        "--count-unstemmed",
+        action="store_true",
+        help="count the distinct tokens before stemming (kept in memory)",
+    )
+    arg_parser.add_argument(
+        "--merge-fan-in",
+        type=int,
+        default=MERGE_FAN_IN,
+        help="max number of temp files merged at once",
+    )
+    arg_parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="add the dump (of new or changed pages) to the index in index_dir"
+        " as a delta segment, instead of building the index again",
+    )
+    arg_parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="number of shards (ranges of pages) of the index, built in parallel",
+    )
+    arg_parser.add_argument(
+        "--deleted-titles",
+        help="file with the titles of the pages to remove with --delta, one per line",
+    )
+    arg_parser.add_argument(
+        "--progress-interval",
+        type=int,
+        default=PROGRESS_INTERVAL,
+        help="seconds between the progress lines, with the time taken by every"
+        " stage so far (0 for none)",
+    )
+    arg_parser.add_argument(
+        "--stats-json",
+        help="file to write the time taken by every stage and the counters to,"
+        " as JSON",
+    )
+    arg_parser.add_argument(
+        "--profile",
+        help="file to dump the cProfile stats of the run to; only the main"
+        " process is profiled, which parses and merges with --workers 1",
+    )
+    args = arg_parser.parse_args()
+
+    dump_file = args.dump_file
+    index_dir = args.index_dir
+    stat_file = args.stat_file
+    postings_format = args.postings_format
+    MERGE_FAN_IN = args.merge_fan_in
+    PROGRESS_INTERVAL = args.progress_interval
+    count_unstemmed_tokens = args.count_unstemmed
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = args.memory_budget << 20
+
+    if args.workers < 1:
+        print("Number of workers should be at least 1")
+        exit(1)
+
+    if MERGE_FAN_IN < 2:
+        print("Merge fan-in should be at least 2")
+        exit(1)
+
+    if not os.path.exists(dump_file):
+        print("Dump file doesn't exist")
+        exit(1)
+
+    if args.shards < 1:
+        print("Number of shards should be at least 1")
+        exit(1)
+
+    if args.shards > 1 and args.delta:
+        print("A sharded index cannot have delta segments")
+        exit(1)
+
+    # The shards are read from ranges of bytes or of streams
+    if (
+        args.shards > 1
+        and args.multistream_index is None
+        and os.path.splitext(dump_file)[1] in DUMP_FILE_OPENERS
+    ):
+        print("Sharding needs an uncompressed dump, or a multistream one")
+        exit(1)
+
+    if args.multistream_index is not None and not os.path.exists(
+        args.multistream_index
+    ):
+        print("Multistream index file doesn't exist")
+        exit(1)
+
+    deleted_titles = set()
+    if args.deleted_titles is not None:
+        if not args.delta:
+            print("Deleted titles can only be given with --delta")
+            exit(1)
+        if not os.path.exists(args.deleted_titles):
+            print("Deleted titles file doesn't exist")
+            exit(1)
+        with open(args.deleted_titles, "r") as f:
+            deleted_titles = {line.strip() for line in f if len(line.strip()) > 0}
+
+    if args.delta:
+        base_dir = os.path.normpath(index_dir)
+        if not os.path.exists(os.path.join(base_dir, SEGMENT_INFO_FILE)):
+            print("Index directory has no index to add a delta segment to")
+            exit(1)
+
+        # The delta segment takes the doc ids and the postings format of
+        # the segments before it
+        segment_dirs = get_segment_dirs(base_dir)
+        first_article_id, article_count = read_segment_info(segment_dirs[-1])
+        FIRST_ARTICLE_ID = first_article_id + article_count
+        PAGE_COUNT = FIRST_ARTICLE_ID
+        postings_format = get_postings_format(base_dir)
+
+        delta_num = len(segment_dirs)
+        if len(segment_dirs) > 1:
+            delta_num = int(segment_dirs[-1].rsplit("_", maxsplit=1)[1]) + 1
+        index_dir = os.path.join(base_dir, f"{DELTA_DIR_PREFIX}{delta_num}.partial")
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+
+    elif os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+
+    os.mkdir(index_dir)
+
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start_time = time.perf_counter()
+
+    if args.shards > 1:
+        net_count = build_shards(
+            dump_file, args.shards, args.workers, args.multistream_index
+        )
+    else:
+        net_count = build_index(dump_file, args.workers, args.multistream_index)
+
+    if args.delta:
+        # Only searched once complete, and only then are the articles it
+        # replaces removed
+        delta_dir = index_dir.removesuffix(".partial")
+        os.rename(index_dir, delta_dir)
+        index_dir = delta_dir
+
+        removed_titles = deleted_titles | {
+            title for _, title in read_segment_titles(index_dir)
+        }
+        removed_count = remove_articles(base_dir, segment_dirs, removed_titles)
+        print(
+            f"Added delta segment {index_dir} with {TOTAL_ARTICLE_COUNT} articles,"
+            f" removed {removed_count} articles of the segments before it."
+        )
+
+    elapsed_time = time.perf_counter() - start_time
+
+    if profiler is not None:
+        profiler.disable()
+
+    print(f"Indexing took {elapsed_time} seconds.")
+    print(f"Stages: {STAGE_STATS.get_summary()}")
+
+    # Printed by every shard otherwise
+    if args.shards == 1:
+        print_stem_cache_stats()
+
+    write_stat_file(stat_file, net_count)
+
+    if args.stats_json is not None:
+        write_stage_stats_file(args.stats_json, elapsed_time, net_count)
+
+    if profiler is not None:
+        profiler.dump_stats(args.profile)
+        stats = pstats.Stats(profiler)
+        stats.sort_stats(pstats.SortKey.TIME)
+        stats.print_stats(PROFILE_PRINTED_FUNCTIONS)
 # >>>
@@ -0,0 +1,151 @@
+import sys
+
+from array import array
+from itertools import accumulate
+
+# Binary Postings <<<
+# A posting list is written as
+#   {token} {number of postings}{block}{block}...
+# with the number of postings as a varint. Each block holds up to
+# POSTINGS_BLOCK_SIZE postings as
+#   {doc delta width}{tf width}{block max tf}{doc id deltas}{term frequencies}
+# with the max term frequency of the block as a varint. The max term
+# frequencies bound the scores of the postings in the top-k search.
+# The deltas and the frequencies of a block are packed little endian with
+# the smallest width (1, 2 or 4 bytes) that fits all of them, so that a
+# block is decoded by `array.frombytes` instead of byte by byte.
+# Every binary index file starts with POSTINGS_FILE_HEADER, whose last
+# byte is the version of the format, so that a file written in another
+# version is rejected instead of being misread.
+
+POSTINGS_BLOCK_SIZE = 128
+POSTINGS_FORMAT_VERSION = 2
+POSTINGS_FILE_HEADER = b"\x00postings" + bytes([POSTINGS_FORMAT_VERSION])
+WIDTH_TO_TYPECODE = {1: "B", 2: "H", 4: "I"}
+MAX_TOKEN_LENGTH = 32
+
+
+def encode_varint(num):
+    chars = bytearray()
+    while num >= 0x80:
+        chars.append((num & 0x7F) | 0x80)
+        num >>= 7
+    chars.append(num)
+    return chars
+
+
+def decode_varint(data, pos):
+    num, shift = 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        num |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return num, pos
+        shift += 7
+
+
+def get_width(max_num):
+    if max_num < 1 << 8:
+        return 1
+    if max_num < 1 << 16:
+        return 2
+    return 4
+
+
+def pack_numbers(nums, width):
+    packed = array(WIDTH_TO_TYPECODE[width], nums)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_numbers(data, pos, count, width):
+    unpacked = array(WIDTH_TO_TYPECODE[width])
+    unpacked.frombytes(data[pos : pos + count * width])
+    if sys.byteorder == "big":
+        unpacked.byteswap()
+    return unpacked, pos + count * width
+
+
+def encode_postings(token, doc_ids, tfs):
+    """
+    Encodes the posting list of `token`, `doc_ids` have to be sorted
+    """
+
+    deltas = [doc_id - prev for doc_id, prev in zip(doc_ids, [0, *doc_ids])]
+
+    record = bytearray(token.encode())
+    record += b" "
+    record += encode_varint(len(doc_ids))
+
+    for start in range(0, len(doc_ids), POSTINGS_BLOCK_SIZE):
+        block_deltas = deltas[start : start + POSTINGS_BLOCK_SIZE]
+        block_tfs = tfs[start : start + POSTINGS_BLOCK_SIZE]
+        deltas_width = get_width(max(block_deltas))
+        tfs_width = get_width(max(block_tfs))
+
+        record.append(deltas_width)
+        record.append(tfs_width)
+        record += encode_varint(max(block_tfs))
+        record += pack_numbers(block_deltas, deltas_width)
+        record += pack_numbers(block_tfs, tfs_width)
+
+    return bytes(record)
+
+
+def check_postings_header(header, file_name):
+
+    if bytes(header[: len(POSTINGS_FILE_HEADER)]) != POSTINGS_FILE_HEADER:
+        raise ValueError(
+            f"{file_name} is not in version {POSTINGS_FORMAT_VERSION} of the"
+            " binary postings format, the index has to be built again"
+        )
+
+
+def decode_token(record):
+    return bytes(record[: MAX_TOKEN_LENGTH + 1]).split(b" ", maxsplit=1)[0].decode()
+
+
+def decode_postings(record):
+    """
+    Decodes a record written by `encode_postings` into the arrays of doc
+    ids and term frequencies, and the array of the max term frequency
+    of every block
+    """
+
+    pos = bytes(record[: MAX_TOKEN_LENGTH + 1]).index(b" ") + 1
+    count, pos = decode_varint(record, pos)
+
+    deltas, tfs, block_max_tfs = [], [], array("I")
+    for start in range(0, count, POSTINGS_BLOCK_SIZE):
+        block_size = min(POSTINGS_BLOCK_SIZE, count - start)
+        deltas_width, tfs_width = record[pos], record[pos + 1]
+        block_max_tf, pos = decode_varint(record, pos + 2)
+        block_max_tfs.append(block_max_tf)
+
+        block_deltas, pos = unpack_numbers(record, pos, block_size, deltas_width)
+        block_tfs, pos = unpack_numbers(record, pos, block_size, tfs_width)
+        deltas.extend(block_deltas)
+        tfs.extend(block_tfs)
+
+    return array("I", accumulate(deltas)), array("I", tfs), block_max_tfs
+
+
+def get_block_max_tfs(tfs):
+    """
+    Returns the array of the max term frequency of every block of
+    POSTINGS_BLOCK_SIZE postings, for the posting lists that are not
+    decoded from blocks
+    """
+
+    return array(
+        "I",
+        [
+            max(tfs[start : start + POSTINGS_BLOCK_SIZE])
+            for start in range(0, len(tfs), POSTINGS_BLOCK_SIZE)
+        ],
+    )
+
+
+# >>>
@@ -1,16 +1,57 @@
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import asyncio
+import functools
+import json
+import mmap
 import os
 import sys
+import threading
 import time
 import re
 import bisect
 import heapq
+import math
 import string
 
+from array import array
+from itertools import accumulate, chain, groupby, repeat
+
+from docstore import (
+    DOC_FLAG_META,
+    DOCSTORE_FILE,
+    DOCSTORE_OFFSETS_FILE,
+    get_document_flags,
+    read_document,
+)
+from postings import (
+    MAX_TOKEN_LENGTH,
+    POSTINGS_BLOCK_SIZE,
+    POSTINGS_FILE_HEADER,
+    check_postings_header,
+    decode_postings,
+    decode_token,
+    get_block_max_tfs,
+)
+from snapshot import (
+    SNAPSHOT_FILE,
+    get_snapshot_keys,
+    get_snapshot_numbers,
+    read_snapshot,
+)
+from tokenizer import tokenize
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Stemmer <<<
 from Stemmer import Stemmer
 
 ENGLISH_STEMMER = Stemmer("english")
+
 ENGLISH_STOPWORDS = {
     "or",
     "re",
@@ -186,7 +227,7 @@ ENGLISH_STOPWORDS = {
 
 # Base Conversion <<<
 ENCODING_CHARS = "".join(
-    ["!+", string.digits, string.ascii_uppercase, string.ascii_lowercase]
+    ["#+", string.digits, string.ascii_uppercase, string.ascii_lowercase]
 )
 ENCODING_CHAR_TO_INDEX = dict(
     (char, indx) for (indx, char) in enumerate(ENCODING_CHARS)
@@ -215,58 +256,176 @@ def base_64_decode(chars):
 
 # >>>
 
-# Utils <<<
-def normalize_enc_doc_id(enc_doc_id):
-    zeros_required = 8 - len(enc_doc_id)
-    return f"{zeros_required*ENCODING_CHARS[0]}{enc_doc_id}"
 
+# Query Tracing <<<
+# With `--trace`, every query is run with a QueryTrace, which records the
+# time taken by each of its stages (the functions decorated with `traced`)
+# and counts what it went through: the postings of its terms, the lookups
+# of posting lists with the bytes of their records, and the hits and
+# misses of the caches. The time not taken by any stage is `other`
+QUERY_TRACE = None
+
+
+class QueryTrace:
+    """
+    The stages are timed on a stack, so the time of a stage does not
+    include the ones of the stages run inside it. The stack is per thread,
+    and the reads of the fetch threads are added up with the other stages
+    """
+
+    def __init__(self):
+
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.lookups = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_stack(self):
+
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def start(self, stage):
+
+        stack = self.get_stack()
+        now = time.perf_counter()
+        if len(stack) > 0:
+            self.add_time(stack[-1][0], now - stack[-1][1])
+        stack.append([stage, now])
+
+    def stop(self):
+
+        stack = self.get_stack()
+        now = time.perf_counter()
+        stage, start_time = stack.pop()
+        self.add_time(stage, now - start_time)
+        if len(stack) > 0:
+            stack[-1][1] = now
+
+    def add_time(self, stage, seconds):
+
+        with self.lock:
+            self.seconds[stage] += seconds
+
+    def count(self, counter, num=1):
+
+        with self.lock:
+            self.counts[counter] += num
+
+    def add_lookup(self, segment, field_type, token, file_num, record_size):
+
+        with self.lock:
+            self.lookups.append(
+                {
+                    "segment": segment,
+                    "field": field_type,
+                    "token": token,
+                    "file": file_num,
+                    "bytes": record_size,
+                }
+            )
+        self.count("lookups")
+        self.count("record_bytes", record_size)
+
+    def get_record(self, query, elapsed_time):
+
+        stages_ms = {stage: seconds * 1000 for stage, seconds in self.seconds.items()}
+        other_time = max(elapsed_time - sum(self.seconds.values()), 0)
+        stages_ms["other"] = other_time * 1000
+        return {
+            "query": query,
+            "time_ms": elapsed_time * 1000,
+            "stages_ms": stages_ms,
+            "counts": dict(self.counts),
+            "lookups": self.lookups,
+        }
+
+
+def traced(stage):
+    """
+    Times the calls of the function as `stage` of the query being traced
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+
+            trace = QUERY_TRACE
+            if trace is None:
+                return func(*args, **kwargs)
+
+            trace.start(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.stop()
+
+        return wrapper
+
+    return decorator
+
+
+def get_traced_results(get_results, query):
+    """
+    Runs `get_results(query)` with a trace, returns its results, its time
+    and the record of its trace
+    """
 
+    global QUERY_TRACE
+
+    cache_counts = [(cache.hits, cache.misses) for cache in ALL_CACHES]
+    QUERY_TRACE = QueryTrace()
+    start_time = time.perf_counter()
+    try:
+        results = get_results(query)
+    finally:
+        elapsed_time = time.perf_counter() - start_time
+        trace, QUERY_TRACE = QUERY_TRACE, None
+
+    for cache, (hits, misses) in zip(ALL_CACHES, cache_counts):
+        trace.count(f"{cache.name}_cache_hits", cache.hits - hits)
+        trace.count(f"{cache.name}_cache_misses", cache.misses - misses)
+
+    return results, elapsed_time, trace.get_record(query, elapsed_time)
+
+
+def get_percentile(sorted_values, percent):
+    return sorted_values[
+        min(len(sorted_values) * percent // 100, len(sorted_values) - 1)
+    ]
+
+
+def get_trace_summary(records):
+    """
+    The p50, p95 and p99 of the time of the queries, and of every stage
+    """
+
+    stages = sorted(set().union(*[record["stages_ms"] for record in records]))
+    rows = [("total", [record["time_ms"] for record in records])]
+    for stage in stages:
+        rows.append((stage, [record["stages_ms"].get(stage, 0) for record in records]))
+
+    lines = [f"{'stage':<24} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+    for stage, times in rows:
+        times = sorted(times)
+        lines.append(
+            f"{stage:<24} {get_percentile(times, 50):>9.3f}"
+            f" {get_percentile(times, 95):>9.3f} {get_percentile(times, 99):>9.3f}"
+        )
+    return "\n".join(lines)
+
+
+# >>>
+
+
+# Utils <<<
+@traced("process_query")
 def process_query(query):
 
-    query = query.encode("ascii", errors="ignore").decode()
-
-    for sym in {
-        "&nbsp;",
-        "&lt;",
-        "&gt;",
-        "&amp;",
-        "&quot;",
-        "&apos;",
-        "—",
-        "%",
-        "$",
-        "'",
-        "~",
-        "|",
-        ".",
-        "*",
-        "[",
-        "]",
-        ":",
-        ";",
-        ",",
-        "{",
-        "}",
-        "(",
-        ")",
-        "=",
-        "+",
-        "-",
-        "_",
-        "#",
-        "!",
-        "`",
-        '"',
-        "?",
-        "/",
-        ">",
-        "<",
-        "&",
-        "\\",
-    }:
-        query = query.replace(sym, " ")
-
-    query = query.split()
+    query = tokenize(query)
 
     query = ENGLISH_STEMMER.stemWords(query)
     query = [
@@ -292,6 +451,14 @@ FIELD_TYPE_INFOBOX = "i"
 FIELD_TYPE_CATEGORIES = "c"
 FIELD_TYPE_EXTERNAL_LINKS = "l"
 FIELD_TYPE_REFERENCES = "r"
+
+POSTINGS_FORMAT_TEXT = "text"
+POSTINGS_FORMAT_BINARY = "binary"
+
+DELTA_DIR_PREFIX = "delta_"
+SEGMENT_INFO_FILE = "segment.txt"
+TOMBSTONES_FILE = "tombstones.bin"
+SHARDS_FILE = "shards.txt"
 # >>>
 
 # Configuration <<<
@@ -312,37 +479,321 @@ FIELD_TYPE_TO_WEIGHT_MAP_NORMAL_QUERY = {
     FIELD_TYPE_REFERENCES: 0.1,
 }
 NUM_RESULTS_PER_QUERY = 10
+USE_TOP_K = True
+USE_NUMPY = np is not None
+POSTINGS_CACHE_SIZE_MB = 256
+IDF_CACHE_SIZE_MB = 64
+TITLES_CACHE_SIZE_MB = 64
+QUERIES_PER_JOB_CHUNK = 64
+FETCH_THREADS = 1
+USE_SNAPSHOT = True
+TRACE_QUERIES = False
+# >>>
+
+
+# Caches <<<
+class LRUCache:
+    """
+    Least recently used cache, bounded by the estimated size in bytes of
+    the values it holds. It also counts its hits, misses and evictions
+    """
+
+    def __init__(self, name, max_size_mb):
+
+        self.name = name
+        self.max_size = max_size_mb << 20
+        self.size = 0
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+
+        if size > self.max_size or key in self.entries:
+            return
+
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def get_stats(self):
+
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups > 0 else 0
+        return (
+            f"{self.name} cache: {self.hits} hits, {self.misses} misses"
+            f" ({hit_rate:.1%} hit rate), {self.evictions} evictions,"
+            f" {self.size / (1 << 20):.1f}/{self.max_size >> 20} MB"
+        )
+
+
+# Rough sizes of the Python objects held by the caches
+POSTING_SIZE = 8
+IDF_ENTRY_SIZE = 230
+TITLE_ENTRY_SIZE = 60
+
+POSTINGS_CACHE = LRUCache("postings", POSTINGS_CACHE_SIZE_MB)
+IDF_CACHE = LRUCache("idf", IDF_CACHE_SIZE_MB)
+TITLES_CACHE = LRUCache("titles", TITLES_CACHE_SIZE_MB)
+ALL_CACHES = [POSTINGS_CACHE, IDF_CACHE, TITLES_CACHE]
+
+
+def configure_caches(postings_cache_size_mb, idf_cache_size_mb, titles_cache_size_mb):
+
+    POSTINGS_CACHE.max_size = postings_cache_size_mb << 20
+    IDF_CACHE.max_size = idf_cache_size_mb << 20
+    TITLES_CACHE.max_size = titles_cache_size_mb << 20
+
+
+# >>>
+
+
+# Segments <<<
+# The index is searched over its base segment and its delta segments
+# (see the indexer). The doc ids of a segment all come after the ones of
+# the segments before it, and the tombstoned ones are left out of the
+# posting lists
+SEGMENT_DIRS = []
+SEGMENT_FIRST_DOC_IDS = []
+SEGMENT_ARTICLE_COUNTS = []
+SEGMENT_TOMBSTONES = []
+
+
+def get_segment_dirs(base_dir):
+
+    delta_nums = sorted(
+        int(file_name[len(DELTA_DIR_PREFIX) :])
+        for file_name in os.listdir(base_dir)
+        if file_name.startswith(DELTA_DIR_PREFIX)
+        and file_name[len(DELTA_DIR_PREFIX) :].isdigit()
+    )
+    return [
+        base_dir,
+        *[os.path.join(base_dir, f"{DELTA_DIR_PREFIX}{num}") for num in delta_nums],
+    ]
+
+
+def get_segment_info(segment_dir):
+
+    file_name = os.path.join(segment_dir, SEGMENT_INFO_FILE)
+    if not os.path.exists(file_name):
+        # Built before there were delta segments
+        return 0, 0
+
+    with open(file_name, "r") as f:
+        first_doc_id, article_count = f.read().split()
+    return int(first_doc_id), int(article_count)
+
+
+def get_tombstoned_doc_ids():
+    """
+    Reads the bitmap of the tombstoned doc ids (bit `doc_id % 8` of
+    byte `doc_id // 8`), returns them sorted
+    """
+
+    file_name = os.path.join(index_dir, TOMBSTONES_FILE)
+    if not os.path.exists(file_name):
+        return []
+
+    with open(file_name, "rb") as f:
+        tombstones = f.read()
+
+    return [
+        (byte_num << 3) + bit
+        for byte_num, byte in enumerate(tombstones)
+        if byte != 0
+        for bit in range(8)
+        if (byte >> bit) & 1
+    ]
+
+
+def load_segments():
+
+    global SEGMENT_DIRS
+    global SEGMENT_FIRST_DOC_IDS
+    global SEGMENT_ARTICLE_COUNTS
+    global SEGMENT_TOMBSTONES
+
+    SEGMENT_DIRS = get_segment_dirs(index_dir)
+    SEGMENT_FIRST_DOC_IDS, SEGMENT_ARTICLE_COUNTS = [], []
+    for segment_dir in SEGMENT_DIRS:
+        first_doc_id, article_count = get_segment_info(segment_dir)
+        SEGMENT_FIRST_DOC_IDS.append(first_doc_id)
+        SEGMENT_ARTICLE_COUNTS.append(article_count)
+
+    SEGMENT_TOMBSTONES = [[] for _ in SEGMENT_DIRS]
+    for doc_id in get_tombstoned_doc_ids():
+        SEGMENT_TOMBSTONES[get_segment(doc_id)].append(doc_id)
+
+
+def get_segment(doc_id):
+    return bisect.bisect_right(SEGMENT_FIRST_DOC_IDS, doc_id) - 1
+
+
+def remove_tombstoned_postings(doc_ids, tfs, tombstones):
+    """
+    Removes the sorted doc ids `tombstones` from a posting list, by
+    bisection, and copies the postings between them in slices
+    """
+
+    positions, lwr = [], 0
+    for doc_id in tombstones:
+        lwr = bisect.bisect_left(doc_ids, doc_id, lwr)
+        if lwr == len(doc_ids):
+            break
+        if doc_ids[lwr] == doc_id:
+            positions.append(lwr)
+
+    if len(positions) == 0:
+        return doc_ids, tfs
+
+    live_doc_ids, live_tfs, start = array("I"), array("I"), 0
+    for position in positions:
+        live_doc_ids += doc_ids[start:position]
+        live_tfs += tfs[start:position]
+        start = position + 1
+    live_doc_ids += doc_ids[start:]
+    live_tfs += tfs[start:]
+    return live_doc_ids, live_tfs
+
+
+# >>>
+
+# Snapshots <<<
+# The snapshot of every directory of the index (see the indexer), or None
+# if it has none, in which case the pre indexes and the offsets are read
+# from the text files
+SNAPSHOTS = {}
+
+
+def get_snapshot(snapshot_dir):
+
+    if not USE_SNAPSHOT:
+        return None
+
+    if snapshot_dir not in SNAPSHOTS:
+        snapshot_file_name = os.path.join(snapshot_dir, SNAPSHOT_FILE)
+        SNAPSHOTS[snapshot_dir] = read_snapshot(snapshot_file_name)
+    return SNAPSHOTS[snapshot_dir]
+
+
 # >>>
 
 # File Name Queries <<<
 FIELD_TO_DOCUMENT_HEADINGS_MAP = {}
 
 
-def get_document_headings(field_type):
+def get_document_headings(segment, field_type):
     global FIELD_TO_DOCUMENT_HEADINGS_MAP
 
-    file_name = os.path.join(index_dir, f"preindex_{field_type}")
+    headings = get_snapshot_keys(
+        get_snapshot(SEGMENT_DIRS[segment]), f"pre_index_{field_type}"
+    )
+    if headings is not None:
+        FIELD_TO_DOCUMENT_HEADINGS_MAP[(segment, field_type)] = headings
+        return
+
+    file_name = os.path.join(SEGMENT_DIRS[segment], f"pre_index_{field_type}.txt")
     with open(file_name, "r") as f:
         data = f.readlines()
-        FIELD_TO_DOCUMENT_HEADINGS_MAP[field_type] = [line.strip() for line in data]
+        FIELD_TO_DOCUMENT_HEADINGS_MAP[(segment, field_type)] = [
+            line.strip() for line in data
+        ]
 
 
-def get_file_num_for_query(field_type, query):
+@traced("get_file_num_for_query")
+def get_file_num_for_query(segment, field_type, query):
 
-    num = bisect.bisect_left(FIELD_TO_DOCUMENT_HEADINGS_MAP[field_type], query)
-    return num - 1 if num else -1
+    num = bisect.bisect_right(
+        FIELD_TO_DOCUMENT_HEADINGS_MAP[(segment, field_type)], query
+    )
+    return num - 1
 
 
 # >>>
 
 # File data Queries <<<
-def get_line_from_file(field_type, file_num, query):
+POSTINGS_FORMAT = POSTINGS_FORMAT_TEXT
+USE_MMAP = False
+MAPPED_INDEX_FILES = {}
+CHECKED_INDEX_FILES = set()
+
+
+def get_mapped_index_file(segment, field_type, file_num):
+    """
+    Memory maps the index file and loads its offsets at its first lookup,
+    so that the next ones do not need to open or read any file
+    """
+
+    mapped_index_file = MAPPED_INDEX_FILES.get((segment, field_type, file_num))
+    if mapped_index_file is not None:
+        return mapped_index_file
+
+    extension = "bin" if POSTINGS_FORMAT == POSTINGS_FORMAT_BINARY else "txt"
+    file_name = os.path.join(
+        SEGMENT_DIRS[segment], f"index_{field_type}_{file_num}.{extension}"
+    )
+    with open(file_name, "rb") as f:
+        index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if POSTINGS_FORMAT == POSTINGS_FORMAT_BINARY:
+        check_postings_header(index_map, file_name)
+        CHECKED_INDEX_FILES.add(file_name)
+    mapped_index_file = (index_map, get_offsets(segment, field_type, file_num))
+    MAPPED_INDEX_FILES[(segment, field_type, file_num)] = mapped_index_file
+    return mapped_index_file
+
 
-    index_file_name = os.path.join(index_dir, f"index_{field_type}{file_num}.txt")
-    offsets_file_name = os.path.join(index_dir, f"offset_{field_type}{file_num}.txt")
-    offsets = None
+def check_index_file(file_name):
+    """
+    Checks the header of a binary index file at its first lookup
+    """
+
+    if file_name in CHECKED_INDEX_FILES:
+        return
+    with open(file_name, "rb") as f:
+        check_postings_header(f.read(len(POSTINGS_FILE_HEADER)), file_name)
+    CHECKED_INDEX_FILES.add(file_name)
+
+
+def get_offsets(segment, field_type, file_num):
+
+    offsets = get_snapshot_numbers(
+        get_snapshot(SEGMENT_DIRS[segment]), f"offsets_{field_type}_{file_num}"
+    )
+    if offsets is not None:
+        return offsets
+
+    offsets_file_name = os.path.join(
+        SEGMENT_DIRS[segment], f"offsets_{field_type}_{file_num}.txt"
+    )
     with open(offsets_file_name, "r") as f:
-        offsets = f.read().split("\n")
+        return array("Q", [int(offset) for offset in f.read().split("\n")])
+
+
+@traced("read_postings")
+def get_line_from_file(segment, field_type, file_num, query):
+
+    index_file_name = os.path.join(
+        SEGMENT_DIRS[segment], f"index_{field_type}_{file_num}.txt"
+    )
+    offsets = get_offsets(segment, field_type, file_num)
 
     with open(index_file_name, "r") as f:
 
@@ -350,7 +801,7 @@ def get_line_from_file(field_type, file_num, query):
         lwr, upr = 0, len(offsets) - 2
         while lwr <= upr:
             mid = (lwr + upr) // 2
-            f.seek(int(offsets[mid]))
+            f.seek(offsets[mid])
             current_line = f.readline().strip().split()
 
             if current_line[0] == query:
@@ -362,85 +813,445 @@ def get_line_from_file(field_type, file_num, query):
         return []
 
 
+@traced("read_postings")
+def get_record_from_binary_file(segment, field_type, file_num, query):
+
+    index_file_name = os.path.join(
+        SEGMENT_DIRS[segment], f"index_{field_type}_{file_num}.bin"
+    )
+    offsets = get_offsets(segment, field_type, file_num)
+
+    with open(index_file_name, "rb") as f:
+
+        # Binary Search
+        lwr, upr = 0, len(offsets) - 2
+        while lwr <= upr:
+            mid = (lwr + upr) // 2
+            f.seek(offsets[mid])
+            current_token = decode_token(f.read(MAX_TOKEN_LENGTH))
+
+            if current_token == query:
+                f.seek(offsets[mid])
+                return f.read(offsets[mid + 1] - offsets[mid])
+            elif current_token < query:
+                lwr = mid + 1
+            else:
+                upr = mid - 1
+        return b""
+
+
+@traced("read_postings")
+def get_record_from_mapped_file(segment, field_type, file_num, query):
+
+    index_map, offsets = get_mapped_index_file(segment, field_type, file_num)
+
+    # Binary Search
+    lwr, upr = 0, len(offsets) - 2
+    while lwr <= upr:
+        mid = (lwr + upr) // 2
+        token_end = index_map.find(b" ", offsets[mid], offsets[mid + 1])
+        current_token = str(index_map[offsets[mid] : token_end], "ascii")
+
+        if current_token == query:
+            return memoryview(index_map)[offsets[mid] : offsets[mid + 1]]
+        elif current_token < query:
+            lwr = mid + 1
+        else:
+            upr = mid - 1
+    return b""
+
+
+def get_posting_list(field_type, token):
+    """
+    Returns the arrays of doc ids and term frequencies of the token,
+    and of the max term frequency of every block of its postings
+    """
+
+    posting_list = BATCH_POSTING_LISTS.get((field_type, token))
+    if posting_list is None:
+        posting_list = POSTINGS_CACHE.get((field_type, token))
+        if posting_list is None:
+            posting_list = read_posting_list(field_type, token)
+            cache_posting_list(field_type, token, posting_list)
+
+    if QUERY_TRACE is not None:
+        QUERY_TRACE.count("postings", len(posting_list[0]))
+    return posting_list
+
+
+def cache_posting_list(field_type, token, posting_list):
+
+    POSTINGS_CACHE.put(
+        (field_type, token),
+        posting_list,
+        POSTING_SIZE * len(posting_list[0]) + MAX_TOKEN_LENGTH,
+    )
+
+
+@traced("decode_postings")
+def read_posting_list(field_type, token):
+    """
+    Reads the posting list of the token in every segment, without the
+    tombstoned documents
+    """
+
+    if len(SEGMENT_DIRS) == 1 and len(SEGMENT_TOMBSTONES[0]) == 0:
+        return read_segment_posting_list(0, field_type, token)
+
+    return merge_segment_posting_lists(
+        [
+            read_segment_posting_list(segment, field_type, token)
+            for segment in range(len(SEGMENT_DIRS))
+        ]
+    )
+
+
+@traced("decode_postings")
+def read_posting_lists(field_type, tokens):
+    """
+    Same as `read_posting_list` for every one of the sorted tokens, read
+    in one sweep over the index files of the field
+    """
+
+    segment_posting_lists = [
+        read_segment_posting_lists(segment, field_type, tokens)
+        for segment in range(len(SEGMENT_DIRS))
+    ]
+    if len(SEGMENT_DIRS) == 1 and len(SEGMENT_TOMBSTONES[0]) == 0:
+        return segment_posting_lists[0]
+
+    return [
+        merge_segment_posting_lists(posting_lists)
+        for posting_lists in zip(*segment_posting_lists)
+    ]
+
+
+def merge_segment_posting_lists(segment_posting_lists):
+    """
+    Concatenates the posting lists of a token in all the segments,
+    without the tombstoned documents. The blocks of the segments do not
+    line up with the ones of the concatenation, so their max term
+    frequencies are found again
+    """
+
+    doc_ids, tfs = array("I"), array("I")
+    for (segment_doc_ids, segment_tfs, _), tombstones in zip(
+        segment_posting_lists, SEGMENT_TOMBSTONES
+    ):
+        segment_doc_ids, segment_tfs = remove_tombstoned_postings(
+            segment_doc_ids, segment_tfs, tombstones
+        )
+        doc_ids += segment_doc_ids
+        tfs += segment_tfs
+    return doc_ids, tfs, get_block_max_tfs(tfs)
+
+
+@traced("decode_postings")
+def read_segment_posting_list(segment, field_type, token):
+
+    file_num = get_file_num_for_query(segment, field_type, token)
+    if file_num < 0:
+        return array("I"), array("I"), array("I")
+
+    if POSTINGS_FORMAT == POSTINGS_FORMAT_BINARY:
+        check_index_file(
+            os.path.join(SEGMENT_DIRS[segment], f"index_{field_type}_{file_num}.bin")
+        )
+        if USE_MMAP:
+            record = get_record_from_mapped_file(segment, field_type, file_num, token)
+        else:
+            record = get_record_from_binary_file(segment, field_type, file_num, token)
+        if QUERY_TRACE is not None:
+            QUERY_TRACE.add_lookup(segment, field_type, token, file_num, len(record))
+        if len(record) == 0:
+            return array("I"), array("I"), array("I")
+        return decode_postings(record)
+
+    if USE_MMAP:
+        record = get_record_from_mapped_file(segment, field_type, file_num, token)
+        index_file_line = str(record, "ascii").split()
+    else:
+        index_file_line = get_line_from_file(segment, field_type, file_num, token)
+    if QUERY_TRACE is not None:
+        record_size = len(" ".join(index_file_line))
+        QUERY_TRACE.add_lookup(segment, field_type, token, file_num, record_size)
+    return decode_text_postings(index_file_line)
+
+
+def decode_text_postings(index_file_line):
+
+    doc_ids, tfs = array("I"), array("I")
+    for document in index_file_line[1:]:
+        enc_doc_id, enc_tf = document.split(":")
+        doc_ids.append(base_64_decode(enc_doc_id))
+        tfs.append(base_64_decode(enc_tf))
+    return doc_ids, tfs, get_block_max_tfs(tfs)
+
+
+@traced("decode_postings")
+def read_segment_posting_lists(segment, field_type, tokens):
+
+    extension = "bin" if POSTINGS_FORMAT == POSTINGS_FORMAT_BINARY else "txt"
+
+    records = []
+    for file_num, file_tokens in groupby(
+        tokens, key=functools.partial(get_file_num_for_query, segment, field_type)
+    ):
+        file_tokens = list(file_tokens)
+        file_records_start = len(records)
+        if file_num < 0:
+            records.extend(b"" for _ in file_tokens)
+        elif USE_MMAP:
+            index_map, offsets = get_mapped_index_file(segment, field_type, file_num)
+            records.extend(get_records_from_file(index_map, offsets, file_tokens))
+        else:
+            index_file_name = os.path.join(
+                SEGMENT_DIRS[segment], f"index_{field_type}_{file_num}.{extension}"
+            )
+            if POSTINGS_FORMAT == POSTINGS_FORMAT_BINARY:
+                check_index_file(index_file_name)
+            offsets = get_offsets(segment, field_type, file_num)
+            with open(index_file_name, "rb") as f:
+                records.extend(get_records_from_file(f, offsets, file_tokens))
+
+        if QUERY_TRACE is not None and file_num >= 0:
+            for token, record in zip(file_tokens, records[file_records_start:]):
+                QUERY_TRACE.add_lookup(
+                    segment, field_type, token, file_num, len(record)
+                )
+
+    posting_lists = []
+    for record in records:
+        if len(record) == 0:
+            posting_lists.append((array("I"), array("I"), array("I")))
+        elif POSTINGS_FORMAT == POSTINGS_FORMAT_BINARY:
+            posting_lists.append(decode_postings(record))
+        else:
+            posting_lists.append(decode_text_postings(str(record, "ascii").split()))
+    return posting_lists
+
+
+@traced("read_postings")
+def get_records_from_file(f, offsets, tokens):
+    """
+    Returns the records of the sorted tokens in an index file (or a map
+    of it), empty for the ones it does not have. Every token is searched
+    after the record of the one before it, so the file is read from its
+    start to its end
+    """
+
+    records, lwr = [], 0
+    for token in tokens:
+
+        # Binary Search
+        record, upr = b"", len(offsets) - 2
+        while lwr <= upr:
+            mid = (lwr + upr) // 2
+            f.seek(offsets[mid])
+            current_token = decode_token(f.read(MAX_TOKEN_LENGTH + 1))
+
+            if current_token == token:
+                f.seek(offsets[mid])
+                record = f.read(offsets[mid + 1] - offsets[mid])
+                lwr = mid + 1
+                break
+            elif current_token < token:
+                lwr = mid + 1
+            else:
+                upr = mid - 1
+        records.append(record)
+
+    return records
+
+
 # >>>
 
 # IDF Queries <<<
+# One per segment, read from the files in IDF_DIRS (the segments, or the
+# directory of a sharded index for its shards)
+IDF_DIRS = []
 IDF_PRE_INDEX = []
-IDF_CACHE = {}
 
 
-def get_token_idf(token):
-    global IDF_CACHE
+def load_idf_pre_indexes(idf_dirs):
+
+    global IDF_DIRS
+    global IDF_PRE_INDEX
+
+    IDF_DIRS = list(idf_dirs)
+    IDF_PRE_INDEX = []
+    for idf_dir in IDF_DIRS:
+        idf_pre_index = get_snapshot_keys(get_snapshot(idf_dir), "pre_index_idf")
+        if idf_pre_index is not None:
+            IDF_PRE_INDEX.append(idf_pre_index)
+            continue
+
+        # Split at whitespace, as it is empty for a segment without tokens
+        idf_pre_index_file_name = os.path.join(idf_dir, "pre_index_idf.txt")
+        with open(idf_pre_index_file_name, "r") as f:
+            IDF_PRE_INDEX.append(f.read().split())
 
-    if token in IDF_CACHE:
-        return IDF_CACHE[token]
 
-    file_num = bisect.bisect_left(IDF_PRE_INDEX, token) - 1
-    file_name = os.path.join(index_dir, f"idf_{file_num}.txt")
-    idf_file_data = None
+def get_idf_block(segment, file_num):
+
+    idf_block = IDF_CACHE.get((segment, file_num))
+    if idf_block is not None:
+        return idf_block
+
+    file_name = os.path.join(IDF_DIRS[segment], f"idf_{file_num}.txt")
     with open(file_name, "r") as f:
-        idf_file_data = f.read().split("\n")
-        tokens = [l.split()[0] for l in idf_file_data]
+        idf_block = {}
+        for line in f.read().split("\n"):
+            token, token_idf, article_count = line.split()
+            idf_block[token] = (float(token_idf), int(article_count))
+
+    IDF_CACHE.put((segment, file_num), idf_block, IDF_ENTRY_SIZE * len(idf_block))
+    return idf_block
+
 
-    token_line_num = bisect.bisect_left(tokens, token)
-    if token_line_num == len(tokens) or tokens[token_line_num] != token:
-        IDF_CACHE[token] = 0
+@traced("idf")
+def get_token_idf(token):
+    """
+    The idf of a segment is its number of articles over the number of
+    its articles with the token, so the numbers of articles of all the
+    segments are added up first. The tombstoned articles are still
+    counted, until the index is compacted
+    """
+
+    token_idf = BATCH_IDFS.get(token)
+    if token_idf is not None:
+        return token_idf
+
+    if len(SEGMENT_DIRS) == 1:
+        token_idf, _ = get_segment_token_idf(0, token)
+        return token_idf
+
+    article_count, token_article_count = 0, 0
+    for segment, segment_article_count in enumerate(SEGMENT_ARTICLE_COUNTS):
+        article_count += segment_article_count
+        _, segment_token_article_count = get_segment_token_idf(segment, token)
+        token_article_count += segment_token_article_count
+
+    if token_article_count == 0:
         return 0
-    token_idf = float(idf_file_data[token_line_num].split()[1])
-    IDF_CACHE[token] = token_idf
-    return token_idf
+    return article_count / token_article_count
+
+
+def get_segment_token_idf(segment, token):
+    """
+    Returns the idf of the token in the segment and its number of articles
+    with the token
+    """
+
+    file_num = bisect.bisect_right(IDF_PRE_INDEX[segment], token) - 1
+    if file_num < 0:
+        return 0, 0
+
+    return get_idf_block(segment, file_num).get(token, (0, 0))
 
 
 # >>>
 
 # Title Queries <<<
+# One per segment
 TITLES_PRE_INDEX = []
 
 
-def get_title_file_num(enc_doc_id):
-    enc_doc_id = normalize_enc_doc_id(enc_doc_id)
-    file_num = bisect.bisect_left(TITLES_PRE_INDEX, enc_doc_id)
-    return file_num - 1 if file_num else -1
+def get_title_file_num(segment, doc_id):
+    file_num = bisect.bisect_right(TITLES_PRE_INDEX[segment], doc_id)
+    return file_num - 1
+
+
+def get_title_block(segment, file_num):
 
+    title_block = TITLES_CACHE.get((segment, file_num))
+    if title_block is not None:
+        return title_block
 
-def get_line_from_title_file(enc_doc_id, file_num):
-    file_name = os.path.join(index_dir, f"title{file_num}.txt")
-    enc_doc_id = normalize_enc_doc_id(enc_doc_id)
+    file_name = os.path.join(SEGMENT_DIRS[segment], f"article_titles_{file_num}.txt")
     with open(file_name, "r") as f:
-        data = f.read().split("\n")
-        doc_id = base_64_decode(enc_doc_id)
-        first_id_in_file = base_64_decode(data[0].split(maxsplit=1)[0])
-        line_num = doc_id - first_id_in_file
-        return data[line_num]
+        title_block = f.read().split("\n")
+
+    title_block_size = sum(len(line) + TITLE_ENTRY_SIZE for line in title_block)
+    TITLES_CACHE.put((segment, file_num), title_block, title_block_size)
+    return title_block
+
+
+def get_line_from_title_file(segment, doc_id, file_num):
+    line_num = doc_id - TITLES_PRE_INDEX[segment][file_num]
+    return get_title_block(segment, file_num)[line_num]
+
+
+# The mapped document store and offsets of every segment (None if it was
+# built before there was one, then the title files are read)
+DOCSTORES = []
+
+
+def map_docstore(segment_dir):
+
+    maps = []
+    for file_name in [DOCSTORE_FILE, DOCSTORE_OFFSETS_FILE]:
+        file_name = os.path.join(segment_dir, file_name)
+        if not os.path.exists(file_name):
+            return None
+        if os.path.getsize(file_name) == 0:
+            # No articles, and an empty file cannot be mapped
+            maps.append(b"")
+            continue
+        with open(file_name, "rb") as f:
+            maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return tuple(maps)
+
+
+@traced("titles")
+def get_document(segment, doc_id):
+    """
+    Returns the title and the flags of the document
+    """
+
+    docstore = DOCSTORES[segment]
+    if docstore is not None:
+        doc_title, doc_flags, _ = read_document(
+            *docstore, doc_id - SEGMENT_FIRST_DOC_IDS[segment]
+        )
+        return doc_title, doc_flags
+
+    title_file_num = get_title_file_num(segment, doc_id)
+    line_from_title_file = get_line_from_title_file(segment, doc_id, title_file_num)
+    _, doc_title = line_from_title_file.split(maxsplit=1)
+    return doc_title, get_document_flags(doc_title)
 
 
 # >>>
 
 
+def get_field_weight(field_type, is_field_query):
+
+    if is_field_query:
+        return FIELD_TYPE_TO_WEIGHT_MAP_FIELD_QUERY[field_type]
+    return FIELD_TYPE_TO_WEIGHT_MAP_NORMAL_QUERY[field_type]
+
+
+@traced("scoring")
 def calculate_query_score(token, field_type, scores_map, is_field_query=False):
 
-    file_num = get_file_num_for_query(field_type, token)
-    index_file_line = get_line_from_file(field_type, file_num, token)
+    doc_ids, tfs, _ = get_posting_list(field_type, token)
     token_idf = get_token_idf(token)
-    field_weight = (
-        FIELD_TYPE_TO_WEIGHT_MAP_FIELD_QUERY[field_type]
-        if is_field_query
-        else FIELD_TYPE_TO_WEIGHT_MAP_NORMAL_QUERY[field_type]
-    )
-    for document in index_file_line[1:]:
-        enc_doc_id, enc_tf = document.split(":")
+    field_weight = get_field_weight(field_type, is_field_query)
+    for doc_id, token_tf in zip(doc_ids, tfs):
         if field_type == FIELD_TYPE_TITLE or field_type == FIELD_TYPE_INFOBOX:
             token_tf = 1
-        else:
-            token_tf = base_64_decode(enc_tf)
-        scores_map[enc_doc_id] += field_weight * token_tf * token_idf
+        scores_map[doc_id] += field_weight * token_tf * token_idf
 
 
-def get_search_results(search_string: str):
+def get_query_terms(search_string):
+    """
+    Returns the (field_type, token, is_field_query) terms of the
+    query, in the order in which their scores are added up
+    """
 
     search_string = search_string.lower()
-    scores_map = defaultdict(int)
-    results = []
+    terms = []
 
     if not re.match(r"[t|b|i|c|r|l]:", search_string):
         # Generic query
@@ -458,49 +1269,981 @@ def get_search_results(search_string: str):
 
         for field_type in all_fields:
             for token in query:
-                calculate_query_score(token, field_type, scores_map, False)
+                terms.append((field_type, token, False))
     else:
         # Field specific query
         for match in re.findall(r"([t|b|c|i|l|r]):([^:]*)(?!\S)", search_string):
             field, query_string = match
             query = process_query(query_string)
             for token in query:
-                calculate_query_score(token, field, scores_map, True)
+                terms.append((field, token, True))
+
+    return terms
+
+
+def get_ranked_documents_exhaustive(terms):
+
+    scores_map = defaultdict(int)
+    for field_type, token, is_field_query in terms:
+        calculate_query_score(token, field_type, scores_map, is_field_query)
 
     priority_queue = [(-v, k) for k, v in scores_map.items()]
     heapq.heapify(priority_queue)
 
-    while len(results) < NUM_RESULTS_PER_QUERY:
-        if len(priority_queue) == 0:
+    while len(priority_queue) > 0:
+        score, doc_id = heapq.heappop(priority_queue)
+        yield doc_id, -score
+
+
+# NumPy Scoring <<<
+@traced("scoring")
+def calculate_query_scores_numpy(terms):
+    """
+    Vectorized `calculate_query_score` over all the terms of a query,
+    returns the sorted array of doc ids and the array of their scores.
+    The scores of a document are added up in the order of the terms,
+    so they are the same floats as the ones of the exhaustive scoring
+    """
+
+    all_doc_ids, all_scores = [], []
+    for field_type, token, is_field_query in terms:
+        doc_ids, tfs, _ = get_posting_list(field_type, token)
+        if len(doc_ids) == 0:
+            continue
+
+        token_idf = get_token_idf(token)
+        field_weight = get_field_weight(field_type, is_field_query)
+
+        if field_type == FIELD_TYPE_TITLE or field_type == FIELD_TYPE_INFOBOX:
+            tfs = np.ones(len(doc_ids), dtype=np.uint32)
+        else:
+            tfs = np.frombuffer(tfs, dtype=np.uint32)
+
+        all_doc_ids.append(np.frombuffer(doc_ids, dtype=np.uint32))
+        all_scores.append(field_weight * tfs * token_idf)
+
+    if len(all_doc_ids) == 0:
+        return np.empty(0, dtype=np.uint32), np.empty(0)
+
+    doc_ids, positions = np.unique(np.concatenate(all_doc_ids), return_inverse=True)
+    scores = np.bincount(positions, weights=np.concatenate(all_scores))
+    return doc_ids, scores
+
+
+@traced("select_top")
+def get_top_positions_numpy(doc_ids, scores, num_documents):
+    """
+    Returns the positions of the `num_documents` best documents, ordered
+    like in the exhaustive scoring (by score, then by doc id)
+    """
+
+    if num_documents < len(scores):
+        kth = len(scores) - num_documents
+        kth_score = scores[np.argpartition(scores, kth)[kth]]
+        positions = np.flatnonzero(scores >= kth_score)
+    else:
+        positions = np.arange(len(scores))
+
+    order = np.lexsort((doc_ids[positions], -scores[positions]))
+    return positions[order[:num_documents]]
+
+
+def get_ranked_documents_numpy(terms):
+
+    doc_ids, scores = calculate_query_scores_numpy(terms)
+    num_documents = NUM_RESULTS_PER_QUERY
+    num_ranked = 0
+
+    while num_ranked < len(doc_ids):
+        top_positions = get_top_positions_numpy(doc_ids, scores, num_documents)
+        yield from zip(
+            doc_ids[top_positions[num_ranked:]].tolist(),
+            scores[top_positions[num_ranked:]].tolist(),
+        )
+
+        num_ranked = len(top_positions)
+        num_documents *= 2
+
+
+# >>>
+
+
+# Top-k Retrieval <<<
+# Slack on the upper bounds, so that rounding errors in adding them up
+# can never prune a document that belongs in the top-k
+UPPER_BOUND_SLACK = 1 + 1e-9
+# The posting lists shorter than this many times the number of documents
+# searched in them are gone through instead of bisected
+SCAN_RATIO = 8
+
+
+@traced("scoring")
+def get_top_documents(terms, num_documents):
+    """
+    Returns the `num_documents` best documents with their scores, in the
+    same order as the exhaustive scoring, using MaxScore pruning term at
+    a time. The scores are added up from the term with the highest upper
+    bound (field weight * max tf * idf) to the lowest, and the score of
+    the `num_documents`th document so far is the threshold to enter the
+    top-k. A block of POSTINGS_BLOCK_SIZE postings whose max tf, with the
+    upper bounds of the terms left, cannot reach this threshold only adds
+    to the documents already found. Once the terms left cannot bring in
+    any new document, only the documents that can still make it are
+    searched in their posting lists. The documents that make it are
+    scored again in the order of the terms, so that their scores are the
+    same floats as the ones of the exhaustive scoring
+    """
+
+    num_terms = len(terms)
+    doc_ids, tfs, field_weights, idfs = [], [], [], []
+    upper_bounds, block_bounds = [], []
+    for field_type, token, is_field_query in terms:
+        term_doc_ids, term_tfs, block_max_tfs = get_posting_list(field_type, token)
+        token_idf = get_token_idf(token)
+        field_weight = get_field_weight(field_type, is_field_query)
+
+        if field_type == FIELD_TYPE_TITLE or field_type == FIELD_TYPE_INFOBOX:
+            term_tfs = None
+            block_max_tfs = [1] * len(block_max_tfs)
+
+        doc_ids.append(term_doc_ids)
+        tfs.append(term_tfs)
+        field_weights.append(field_weight)
+        idfs.append(token_idf)
+        block_bounds.append(
+            [field_weight * max_tf * token_idf for max_tf in block_max_tfs]
+        )
+        upper_bounds.append(max(block_bounds[-1], default=0))
+
+    order = sorted(range(num_terms), key=lambda term: -upper_bounds[term])
+    # The upper bounds of the terms from the nth one in the order
+    remaining_bounds = list(
+        accumulate((upper_bounds[term] for term in reversed(order)), initial=0)
+    )[::-1]
+
+    scores = defaultdict(int)
+    threshold = -math.inf
+    num_added = 0
+    while (
+        num_added < num_terms
+        and remaining_bounds[num_added] * UPPER_BOUND_SLACK >= threshold
+    ):
+        term = order[num_added]
+        term_doc_ids, term_tfs = doc_ids[term], tfs[term]
+        field_weight, token_idf = field_weights[term], idfs[term]
+        other_bound = remaining_bounds[num_added + 1]
+
+        for adds_documents, blocks in groupby(
+            range(len(block_bounds[term])),
+            key=lambda block: (block_bounds[term][block] + other_bound)
+            * UPPER_BOUND_SLACK
+            >= threshold,
+        ):
+            blocks = list(blocks)
+            start = blocks[0] * POSTINGS_BLOCK_SIZE
+            end = (blocks[-1] + 1) * POSTINGS_BLOCK_SIZE
+            if term_tfs is None:
+                block_tfs = repeat(1, end - start)
+            else:
+                block_tfs = term_tfs[start:end]
+
+            if adds_documents:
+                for doc_id, token_tf in zip(term_doc_ids[start:end], block_tfs):
+                    scores[doc_id] += field_weight * token_tf * token_idf
+            else:
+                for doc_id, token_tf in zip(term_doc_ids[start:end], block_tfs):
+                    if doc_id in scores:
+                        scores[doc_id] += field_weight * token_tf * token_idf
+
+        num_added += 1
+        # The threshold cannot be higher than the sum of the upper bounds
+        # of the terms added, so it is only worth finding when the terms
+        # left are below it
+        if len(scores) >= num_documents and (
+            remaining_bounds[num_added]
+            < remaining_bounds[0] - remaining_bounds[num_added]
+        ):
+            threshold = heapq.nlargest(num_documents, scores.values())[-1]
+
+    cutoff = threshold / UPPER_BOUND_SLACK - remaining_bounds[num_added]
+    candidates = {doc_id: score for doc_id, score in scores.items() if score >= cutoff}
+    for indx in range(num_added, num_terms):
+        term = order[indx]
+        term_doc_ids, term_tfs = doc_ids[term], tfs[term]
+        field_weight, token_idf = field_weights[term], idfs[term]
+
+        if len(term_doc_ids) < len(candidates) * SCAN_RATIO:
+            if term_tfs is None:
+                term_tfs = repeat(1, len(term_doc_ids))
+            for doc_id, token_tf in zip(term_doc_ids, term_tfs):
+                if doc_id in candidates:
+                    candidates[doc_id] += field_weight * token_tf * token_idf
+        else:
+            cursor = 0
+            for doc_id in sorted(candidates):
+                cursor = bisect.bisect_left(term_doc_ids, doc_id, cursor)
+                if cursor == len(term_doc_ids):
+                    break
+                if term_doc_ids[cursor] == doc_id:
+                    token_tf = 1 if term_tfs is None else term_tfs[cursor]
+                    candidates[doc_id] += field_weight * token_tf * token_idf
+
+        threshold = max(
+            threshold, heapq.nlargest(num_documents, candidates.values())[-1]
+        )
+        cutoff = threshold / UPPER_BOUND_SLACK - remaining_bounds[indx + 1]
+        candidates = {
+            doc_id: score for doc_id, score in candidates.items() if score >= cutoff
+        }
+
+    # Only the documents of the top-k, and the ones that may tie with them
+    # once their scores are added up in the order of the terms, are scored
+    # again
+    ranked_documents = sorted(candidates, key=candidates.get, reverse=True)
+    if len(ranked_documents) > num_documents:
+        cutoff = candidates[ranked_documents[num_documents - 1]] / UPPER_BOUND_SLACK
+        ranked_documents = [
+            doc_id for doc_id in ranked_documents if candidates[doc_id] >= cutoff
+        ]
+
+    top_documents = []
+    for doc_id in ranked_documents:
+        # Same order of additions as the exhaustive scoring
+        score = 0
+        for term in range(num_terms):
+            cursor = bisect.bisect_left(doc_ids[term], doc_id)
+            if cursor < len(doc_ids[term]) and doc_ids[term][cursor] == doc_id:
+                token_tf = 1 if tfs[term] is None else tfs[term][cursor]
+                score += field_weights[term] * token_tf * idfs[term]
+        # Ties go to the lower doc id, like in the exhaustive scoring
+        top_documents.append((-score, doc_id))
+
+    return [
+        (doc_id, -score)
+        for score, doc_id in heapq.nsmallest(num_documents, top_documents)
+    ]
+
+
+def get_ranked_documents_top_k(terms):
+
+    num_documents = NUM_RESULTS_PER_QUERY
+    num_ranked = 0
+
+    # Some of the documents may be dropped for their titles, in which case
+    # the search is done again for twice as many
+    while True:
+        top_documents = get_top_documents(terms, num_documents)
+        yield from top_documents[num_ranked:]
+
+        if len(top_documents) < num_documents:
             break
-        top_element = heapq.heappop(priority_queue)
-        score, enc_doc_id = top_element
-        score = -score
-        title_file_num = get_title_file_num(enc_doc_id)
-        line_from_title_file = get_line_from_title_file(enc_doc_id, title_file_num)
-        doc_title = line_from_title_file.split(maxsplit=1)[1]
-        if any(doc_title.startswith(meta) for meta in ["Help:", "Module:"]):
+        num_ranked = num_documents
+        num_documents *= 2
+
+
+# >>>
+
+
+def get_search_results(search_string: str):
+
+    if len(SHARD_EXECUTORS) > 0:
+        return get_sharded_search_results(search_string)
+
+    return [
+        f"{base_64_encode(doc_id)}, {doc_title}"
+        for _, doc_id, doc_title in get_scored_results(search_string)
+    ]
+
+
+def get_scored_results(search_string):
+    """
+    Returns the score, the doc id and the title of the top documents of
+    the query, without the help and module pages
+    """
+
+    if FETCH_EXECUTOR is not None:
+        return get_batch_scored_results([search_string])[0]
+
+    return get_scored_results_for_terms(get_query_terms(search_string))
+
+
+@traced("select_top")
+def get_scored_results_for_terms(terms):
+
+    results = []
+    if not USE_TOP_K:
+        ranked_documents = get_ranked_documents_exhaustive(terms)
+    elif USE_NUMPY:
+        ranked_documents = get_ranked_documents_numpy(terms)
+    else:
+        ranked_documents = get_ranked_documents_top_k(terms)
+
+    for doc_id, score in ranked_documents:
+        doc_title, doc_flags = get_document(get_segment(doc_id), doc_id)
+        if doc_flags & DOC_FLAG_META:
             continue
-        results.append(f"{enc_doc_id}, {doc_title}")
+        results.append((score, doc_id, doc_title))
+        if len(results) == NUM_RESULTS_PER_QUERY:
+            break
 
     return results
 
 
-if __name__ == "__main__":
+def load_pre_indexes():
+
+    global TITLES_PRE_INDEX
+    global DOCSTORES
+    global POSTINGS_FORMAT
+
+    SNAPSHOTS.clear()
+    MAPPED_INDEX_FILES.clear()
+    CHECKED_INDEX_FILES.clear()
+
+    load_segments()
+    load_idf_pre_indexes(SEGMENT_DIRS)
+
+    TITLES_PRE_INDEX = []
+    DOCSTORES = [map_docstore(segment_dir) for segment_dir in SEGMENT_DIRS]
+    for segment, segment_dir in enumerate(SEGMENT_DIRS):
+        for field_type in [
+            FIELD_TYPE_TITLE,
+            FIELD_TYPE_BODY,
+            FIELD_TYPE_INFOBOX,
+            FIELD_TYPE_CATEGORIES,
+            FIELD_TYPE_EXTERNAL_LINKS,
+            FIELD_TYPE_REFERENCES,
+        ]:
+            get_document_headings(segment, field_type)
+
+        titles_pre_index = get_snapshot_numbers(
+            get_snapshot(segment_dir), "pre_index_titles"
+        )
+        if titles_pre_index is not None:
+            TITLES_PRE_INDEX.append(titles_pre_index)
+            continue
+
+        titles_pre_index_file_name = os.path.join(segment_dir, "pre_index_titles.txt")
+        with open(titles_pre_index_file_name, "r") as f:
+            TITLES_PRE_INDEX.append([base_64_decode(i) for i in f.read().split()])
+
+    if os.path.exists(os.path.join(index_dir, f"index_{FIELD_TYPE_TITLE}_0.bin")):
+        POSTINGS_FORMAT = POSTINGS_FORMAT_BINARY
+
+
+# Sharded Search <<<
+# A sharded index (see the indexer) is searched by a pool of processes per
+# shard, each scoring the documents of its shard with the idf of the whole
+# index, so with the same scores as if it was not sharded. Their top
+# documents are merged by score, then by doc id
+SHARD_DIRS = []
+SHARD_FIRST_DOC_IDS = []
+SHARD_EXECUTORS = []
+
+
+def load_shards():
+
+    file_name = os.path.join(index_dir, SHARDS_FILE)
+    with open(file_name, "r") as f:
+        for line in f.read().split("\n"):
+            shard_name, first_doc_id, _ = line.split()
+            SHARD_DIRS.append(os.path.join(index_dir, shard_name))
+            SHARD_FIRST_DOC_IDS.append(int(first_doc_id))
+
+
+def start_shard_executors(workers, cache_sizes_mb, use_mmap):
+
+    for shard_dir in SHARD_DIRS:
+        SHARD_EXECUTORS.append(
+            ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_shard_worker,
+                initargs=(
+                    shard_dir,
+                    index_dir,
+                    cache_sizes_mb,
+                    use_mmap,
+                    USE_TOP_K,
+                    USE_NUMPY,
+                    FETCH_THREADS,
+                ),
+            )
+        )
+
+
+def init_shard_worker(
+    shard_dir, idf_dir, cache_sizes_mb, use_mmap, use_top_k, use_numpy, fetch_threads
+):
+
+    global index_dir
+    global USE_MMAP
+    global USE_TOP_K
+    global USE_NUMPY
+    global SHARD_EXECUTORS
+
+    # The ones of the parent process, if forked
+    SHARD_EXECUTORS = []
+
+    index_dir = shard_dir
+    USE_MMAP = use_mmap
+    USE_TOP_K = use_top_k
+    USE_NUMPY = use_numpy
+    configure_caches(*cache_sizes_mb)
+    start_fetch_executor(fetch_threads)
+    load_pre_indexes()
+    load_idf_pre_indexes([idf_dir])
+
+
+def run_shard_query(query):
+    return get_scored_results(query)
+
+
+def run_traced_shard_query(query):
+    return get_traced_results(get_scored_results, query)
+
+
+def merge_shard_results(shard_results):
+
+    results = []
+    for first_doc_id, scored_results in zip(SHARD_FIRST_DOC_IDS, shard_results):
+        for score, doc_id, doc_title in scored_results:
+            results.append((-score, first_doc_id + doc_id, doc_title))
+
+    return [
+        f"{base_64_encode(doc_id)}, {doc_title}"
+        for _, doc_id, doc_title in heapq.nsmallest(NUM_RESULTS_PER_QUERY, results)
+    ]
+
+
+def merge_traced_shard_results(query, traced_shard_results, elapsed_time):
+    """
+    Returns the results of the shards, and the record of the trace of the
+    query: the stages of the slowest shard, which the query waited for,
+    and `shards` for the time taken by the rest (sending the query and the
+    results between the processes, and merging them), with the counts and
+    lookups of all the shards
+    """
+
+    results = merge_shard_results([results for results, _, _ in traced_shard_results])
+
+    counts, lookups = Counter(), []
+    for shard, (_, _, shard_record) in enumerate(traced_shard_results):
+        counts.update(shard_record["counts"])
+        lookups.extend({"shard": shard, **lookup} for lookup in shard_record["lookups"])
+
+    _, shard_time, slowest_record = max(
+        traced_shard_results, key=lambda shard_result: shard_result[1]
+    )
+    stages_ms = dict(slowest_record["stages_ms"])
+    stages_ms["shards"] = max(elapsed_time - shard_time, 0) * 1000
+
+    record = {
+        "query": query,
+        "time_ms": elapsed_time * 1000,
+        "stages_ms": stages_ms,
+        "counts": dict(counts),
+        "lookups": lookups,
+    }
+    return results, record
+
+
+def get_sharded_search_results(search_string):
+
+    futures = [
+        executor.submit(run_shard_query, search_string) for executor in SHARD_EXECUTORS
+    ]
+    return merge_shard_results([future.result() for future in futures])
+
+
+def get_traced_sharded_search_results(search_string):
+
+    start_time = time.perf_counter()
+    futures = [
+        executor.submit(run_traced_shard_query, search_string)
+        for executor in SHARD_EXECUTORS
+    ]
+    traced_shard_results = [future.result() for future in futures]
+    elapsed_time = time.perf_counter() - start_time
+
+    results, record = merge_traced_shard_results(
+        search_string, traced_shard_results, elapsed_time
+    )
+    return results, elapsed_time, record
+
+
+def get_traced_search_results(search_string):
+    """
+    Returns the results of the query, its time and the record of its trace
+    """
+
+    if len(SHARD_EXECUTORS) > 0:
+        return get_traced_sharded_search_results(search_string)
+    return get_traced_results(get_search_results, search_string)
+
+
+async def run_sharded_search_query(query):
+
+    loop = asyncio.get_running_loop()
+    run_query = run_traced_shard_query if TRACE_QUERIES else run_shard_query
 
-    if len(sys.argv) < 4:
-        print("Expected two arguments : queries_file, index_dir & output_file")
+    start_time = time.perf_counter()
+    shard_results = await asyncio.gather(
+        *[
+            loop.run_in_executor(executor, run_query, query)
+            for executor in SHARD_EXECUTORS
+        ]
+    )
+    elapsed_time = time.perf_counter() - start_time
+
+    if TRACE_QUERIES:
+        results, record = merge_traced_shard_results(query, shard_results, elapsed_time)
+        return results, elapsed_time, record
+
+    return merge_shard_results(shard_results), elapsed_time, None
+
+
+# >>>
+
+
+# Batch Search <<<
+# The queries of a batch are parsed first, and the posting list and the
+# idf of every distinct term of all of them are read once, in the order
+# of the files, before any query is scored
+BATCH_POSTING_LISTS = {}
+BATCH_IDFS = {}
+
+# A query is read like a batch of one query when the fields are read in
+# parallel, in FETCH_THREADS threads. The reads mostly wait for the disk,
+# so they do not need the GIL
+FETCH_EXECUTOR = None
+
+
+def load_batch_terms(terms_list):
+    """
+    Reads the posting lists that are not in the cache, the ones of every
+    field in a thread of FETCH_EXECUTOR (if any) while the idfs are read
+    """
+
+    field_tokens = defaultdict(set)
+    for terms in terms_list:
+        for field_type, token, _ in terms:
+            field_tokens[field_type].add(token)
+
+    field_reads = []
+    for field_type, tokens in sorted(field_tokens.items()):
+        missing_tokens = []
+        for token in sorted(tokens):
+            posting_list = POSTINGS_CACHE.get((field_type, token))
+            if posting_list is None:
+                missing_tokens.append(token)
+            else:
+                BATCH_POSTING_LISTS[(field_type, token)] = posting_list
+
+        if len(missing_tokens) == 0:
+            continue
+        if FETCH_EXECUTOR is None:
+            posting_lists = read_posting_lists(field_type, missing_tokens)
+        else:
+            posting_lists = FETCH_EXECUTOR.submit(
+                read_posting_lists, field_type, missing_tokens
+            )
+        field_reads.append((field_type, missing_tokens, posting_lists))
+
+    for token in sorted(set().union(*field_tokens.values())):
+        BATCH_IDFS[token] = get_token_idf(token)
+
+    for field_type, tokens, posting_lists in field_reads:
+        if FETCH_EXECUTOR is not None:
+            posting_lists = posting_lists.result()
+        for token, posting_list in zip(tokens, posting_lists):
+            BATCH_POSTING_LISTS[(field_type, token)] = posting_list
+            cache_posting_list(field_type, token, posting_list)
+
+
+def start_fetch_executor(fetch_threads):
+
+    global FETCH_THREADS
+    global FETCH_EXECUTOR
+
+    FETCH_THREADS = fetch_threads
+    FETCH_EXECUTOR = None
+    if fetch_threads > 1:
+        FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=fetch_threads)
+
+
+def get_batch_scored_results(queries):
+    """
+    Returns the `get_scored_results` of every query of the batch, scoring
+    the same query only once
+    """
+
+    terms_map = {query: get_query_terms(query) for query in queries}
+    load_batch_terms(terms_map.values())
+    try:
+        results_map = {
+            query: get_scored_results_for_terms(terms)
+            for query, terms in terms_map.items()
+        }
+    finally:
+        BATCH_POSTING_LISTS.clear()
+        BATCH_IDFS.clear()
+
+    return [results_map[query] for query in queries]
+
+
+def get_batch_search_results(queries):
+
+    if len(SHARD_EXECUTORS) > 0:
+        futures = [
+            executor.submit(get_batch_scored_results, queries)
+            for executor in SHARD_EXECUTORS
+        ]
+        batch_shard_results = [future.result() for future in futures]
+        return [
+            merge_shard_results(shard_results)
+            for shard_results in zip(*batch_shard_results)
+        ]
+
+    return [
+        [
+            f"{base_64_encode(doc_id)}, {doc_title}"
+            for _, doc_id, doc_title in scored_results
+        ]
+        for scored_results in get_batch_scored_results(queries)
+    ]
+
+
+# >>>
+
+
+# Parallel Queries <<<
+# With `--jobs N`, the queries file is split into chunks which are run by
+# N processes, each with its own pre indexes and caches loaded (or, for a
+# sharded index, by N threads sending them to N processes per shard). The
+# results of the chunks are written in the order of the queries
+def init_query_worker(
+    worker_index_dir,
+    cache_sizes_mb,
+    use_mmap,
+    use_top_k,
+    use_numpy,
+    fetch_threads,
+    trace_queries,
+):
+
+    global index_dir
+    global USE_MMAP
+    global USE_TOP_K
+    global USE_NUMPY
+    global TRACE_QUERIES
+
+    index_dir = worker_index_dir
+    USE_MMAP = use_mmap
+    USE_TOP_K = use_top_k
+    USE_NUMPY = use_numpy
+    TRACE_QUERIES = trace_queries
+    configure_caches(*cache_sizes_mb)
+    start_fetch_executor(fetch_threads)
+    load_pre_indexes()
+
+
+def run_query_chunk(queries, batch):
+    """
+    Returns the results of every query of the chunk, with its time and the
+    record of its trace (or None). The time of a query of a batch is its
+    share of the time of the batch
+    """
+
+    if batch:
+        start_time = time.perf_counter()
+        batch_results = get_batch_search_results(queries)
+        elapsed_time = (time.perf_counter() - start_time) / len(queries)
+        return [(results, elapsed_time, None) for results in batch_results]
+
+    chunk_results = []
+    for query in queries:
+        if TRACE_QUERIES:
+            chunk_results.append(get_traced_search_results(query))
+            continue
+
+        start_time = time.perf_counter()
+        results = get_search_results(query)
+        chunk_results.append((results, time.perf_counter() - start_time, None))
+    return chunk_results
+
+
+# >>>
+
+
+# Search Server <<<
+def init_search_worker(worker_index_dir, cache_sizes_mb, fetch_threads, trace_queries):
+
+    global index_dir
+    global USE_MMAP
+    global TRACE_QUERIES
+
+    index_dir = worker_index_dir
+    USE_MMAP = True
+    TRACE_QUERIES = trace_queries
+    configure_caches(*cache_sizes_mb)
+    start_fetch_executor(fetch_threads)
+    load_pre_indexes()
+
+
+def run_search_query(query):
+
+    if TRACE_QUERIES:
+        return get_traced_search_results(query)
+
+    start_time = time.perf_counter()
+    results = get_search_results(query)
+    elapsed_time = time.perf_counter() - start_time
+
+    return results, elapsed_time, None
+
+
+async def handle_search_connection(reader, writer, run_query):
+    """
+    Every line sent on the connection is a query, and it is answered with
+    a line of JSON holding the same results as `get_search_results` (and
+    the record of its trace, with `--trace`)
+    """
+
+    while True:
+        line = await reader.readline()
+        if len(line) == 0:
+            break
+
+        query = line.decode(errors="ignore").strip()
+        if len(query) == 0:
+            continue
+
+        try:
+            results, elapsed_time, record = await run_query(query)
+            response = {"query": query, "results": results, "time": elapsed_time}
+            if record is not None:
+                response["trace"] = record
+        except Exception as e:
+            response = {"query": query, "error": repr(e)}
+
+        writer.write(f"{json.dumps(response)}\n".encode())
+        await writer.drain()
+
+    writer.close()
+    await writer.wait_closed()
+
+
+async def serve(host, port, unix_socket, workers, cache_sizes_mb):
+
+    loop = asyncio.get_running_loop()
+
+    if os.path.exists(os.path.join(index_dir, SHARDS_FILE)):
+        # `workers` processes for every shard
+        load_shards()
+        start_shard_executors(workers, cache_sizes_mb, True)
+        executors, start_query = SHARD_EXECUTORS, run_shard_query
+        run_query = run_sharded_search_query
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_search_worker,
+            initargs=(index_dir, cache_sizes_mb, FETCH_THREADS, TRACE_QUERIES),
+        )
+        executors, start_query = [executor], run_search_query
+        run_query = functools.partial(loop.run_in_executor, executor, run_search_query)
+
+    try:
+        # Start (and load the pre indexes in) every worker before accepting
+        # any query, so that no query has to wait for it
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(executor, start_query, "")
+                for executor in executors
+                for _ in range(workers)
+            ]
+        )
+
+        handler = functools.partial(handle_search_connection, run_query=run_query)
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(handler, path=unix_socket)
+        else:
+            server = await asyncio.start_server(handler, host, port)
+
+        workers_description = f"{workers} workers"
+        if len(SHARD_EXECUTORS) > 0:
+            workers_description += f" for each of {len(SHARD_EXECUTORS)} shards"
+        for sock in server.sockets:
+            print(f"Serving on {sock.getsockname()} with {workers_description}")
+
+        async with server:
+            await server.serve_forever()
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+
+# >>>
+
+
+def add_fetch_threads_argument(arg_parser):
+
+    arg_parser.add_argument(
+        "--fetch-threads",
+        type=int,
+        default=FETCH_THREADS,
+        help="number of threads reading the posting lists of the fields of a query",
+    )
+
+
+def add_cache_arguments(arg_parser):
+
+    arg_parser.add_argument(
+        "--postings-cache-size",
+        type=int,
+        default=POSTINGS_CACHE_SIZE_MB,
+        help="MB of decoded posting lists to keep in memory",
+    )
+    arg_parser.add_argument(
+        "--idf-cache-size",
+        type=int,
+        default=IDF_CACHE_SIZE_MB,
+        help="MB of parsed idf files to keep in memory",
+    )
+    arg_parser.add_argument(
+        "--titles-cache-size",
+        type=int,
+        default=TITLES_CACHE_SIZE_MB,
+        help="MB of parsed title files to keep in memory",
+    )
+
+
+def serve_main():
+
+    global index_dir
+    global FETCH_THREADS
+    global TRACE_QUERIES
+
+    arg_parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} serve")
+    arg_parser.add_argument("index_dir")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8000)
+    arg_parser.add_argument(
+        "--unix-socket", help="listen on this unix socket instead of host:port"
+    )
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of processes running the queries",
+    )
+    arg_parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="add the time taken by every stage of a query to its response",
+    )
+    add_fetch_threads_argument(arg_parser)
+    add_cache_arguments(arg_parser)
+    args = arg_parser.parse_args(sys.argv[2:])
+
+    index_dir = args.index_dir
+    FETCH_THREADS = args.fetch_threads
+    TRACE_QUERIES = args.trace
+
+    if not os.path.exists(index_dir):
+        print("Index directory does not exist")
         exit(1)
 
-    queries_file = sys.argv[1]
-    index_dir = sys.argv[2]
-    output_file = sys.argv[3]
-    # output_file = "queries_op.txt"
+    try:
+        cache_sizes_mb = (
+            args.postings_cache_size,
+            args.idf_cache_size,
+            args.titles_cache_size,
+        )
+        asyncio.run(
+            serve(args.host, args.port, args.unix_socket, args.workers, cache_sizes_mb)
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        serve_main()
+        exit(0)
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("queries_file")
+    arg_parser.add_argument("index_dir")
+    arg_parser.add_argument("output_file")
+    arg_parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help="memory map the index files and keep their offsets in memory",
+    )
+    arg_parser.add_argument(
+        "--exhaustive",
+        action="store_true",
+        help="score every document instead of the top-k search",
+    )
+    arg_parser.add_argument(
+        "--no-numpy",
+        action="store_true",
+        help="do not score with NumPy even if it is installed",
+    )
+    arg_parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="read the posting list of every distinct term of a batch of queries once",
+    )
+    arg_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="number of queries of a batch, whose posting lists are held in memory",
+    )
+    arg_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes running the queries",
+    )
+    arg_parser.add_argument(
+        "--trace",
+        help="file to write the time taken by every stage of every query to,"
+        " as JSON lines, whose percentiles are printed",
+    )
+    add_fetch_threads_argument(arg_parser)
+    add_cache_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    queries_file = args.queries_file
+    index_dir = args.index_dir
+    output_file = args.output_file
+    USE_MMAP = args.mmap
+    USE_TOP_K = not args.exhaustive
+    USE_NUMPY = USE_NUMPY and not args.no_numpy
+    FETCH_THREADS = args.fetch_threads
+    TRACE_QUERIES = args.trace is not None
+    configure_caches(
+        args.postings_cache_size, args.idf_cache_size, args.titles_cache_size
+    )
 
     if not os.path.exists(queries_file):
         print("Queries file doesn't exist")
         exit(1)
 
+    if args.batch_size < 1:
+        print("Batch size should be at least 1")
+        exit(1)
+
+    if args.jobs < 1:
+        print("Number of jobs should be at least 1")
+        exit(1)
+
+    if args.batch and TRACE_QUERIES:
+        print("Queries can only be traced one at a time, not with --batch")
+        exit(1)
+
     if not os.path.exists(index_dir):
         print("Index directory does not exist")
         exit(1)
@@ -508,43 +2251,101 @@ if __name__ == "__main__":
     if os.path.exists(output_file):
         os.remove(output_file)
 
-    # Preprocessing <<<
-
-    for field_type in [
-        FIELD_TYPE_TITLE,
-        FIELD_TYPE_BODY,
-        FIELD_TYPE_INFOBOX,
-        FIELD_TYPE_CATEGORIES,
-        FIELD_TYPE_EXTERNAL_LINKS,
-        FIELD_TYPE_REFERENCES,
+    cache_sizes_mb = (
+        args.postings_cache_size,
+        args.idf_cache_size,
+        args.titles_cache_size,
+    )
+    if os.path.exists(os.path.join(index_dir, SHARDS_FILE)):
+        # `jobs` processes for every shard
+        load_shards()
+        start_shard_executors(args.jobs, cache_sizes_mb, USE_MMAP)
+        executors, start_query = SHARD_EXECUTORS, run_shard_query
+        jobs_executor = None
+        if args.jobs > 1:
+            jobs_executor = ThreadPoolExecutor(max_workers=args.jobs)
+    elif args.jobs > 1:
+        jobs_executor = ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=init_query_worker,
+            initargs=(
+                index_dir,
+                cache_sizes_mb,
+                USE_MMAP,
+                USE_TOP_K,
+                USE_NUMPY,
+                FETCH_THREADS,
+                TRACE_QUERIES,
+            ),
+        )
+        executors, start_query = [jobs_executor], run_search_query
+    else:
+        start_fetch_executor(FETCH_THREADS)
+        load_pre_indexes()
+        executors, jobs_executor = [], None
+
+    # Started before timing the first query
+    for future in [
+        executor.submit(start_query, "")
+        for executor in executors
+        for _ in range(args.jobs)
     ]:
-        get_document_headings(field_type)
+        future.result()
 
-    idf_pre_index_file_name = os.path.join(index_dir, f"idf_preindex.txt")
-    with open(idf_pre_index_file_name, "r") as f:
-        IDF_PRE_INDEX = f.read().split("\n")
+    with open(queries_file, "r") as qf:
+        queries = [query.strip() for query in qf.readlines()]
+        queries = [query for query in queries if len(query) > 0]
 
-    titles_pre_index_file_name = os.path.join(index_dir, "title_pre_index.txt")
-    with open(titles_pre_index_file_name, "r") as f:
-        TITLES_PRE_INDEX = [normalize_enc_doc_id(i) for i in f.read().split("\n")]
+    if args.batch:
+        # Enough batches for all the jobs
+        chunk_size = min(args.batch_size, -(-len(queries) // args.jobs))
+    else:
+        chunk_size = QUERIES_PER_JOB_CHUNK
+    chunk_size = max(chunk_size, 1)
+    chunks = [
+        queries[start : start + chunk_size]
+        for start in range(0, len(queries), chunk_size)
+    ]
 
-    # >>>
+    start_time = time.perf_counter()
+    run_chunk = functools.partial(run_query_chunk, batch=args.batch)
+    if jobs_executor is None:
+        chunk_results = map(run_chunk, chunks)
+    else:
+        chunk_results = jobs_executor.map(run_chunk, chunks)
 
+    trace_records = []
     with open(output_file, "w") as of:
-        with open(queries_file, "r") as qf:
-            for query in qf.readlines():
+        for results, elapsed_time, record in chain.from_iterable(chunk_results):
+
+            # Write results in output file
+            if results is not None and len(results) > 0:
+                of.write("\n".join(results))
 
-                query = query.strip()
-                if len(query) == 0:
-                    continue
+            of.write(f"\n{elapsed_time}\n\n")
 
-                # Gather results for current query
-                start_time = time.perf_counter()
-                results = get_search_results(query)
-                elapsed_time = time.perf_counter() - start_time
+            if record is not None:
+                trace_records.append(record)
 
-                # Write results in output file
-                if results is not None and len(results) > 0:
-                    of.write("\n".join(results))
+    total_time = time.perf_counter() - start_time
+    print(
+        f"{len(queries)} queries in {total_time:.2f} seconds"
+        f" ({len(queries) / total_time:.1f} queries/s) with {args.jobs} jobs"
+    )
 
-                of.write(f"\n{elapsed_time}\n\n")
+    # The caches of the jobs and the shards are in their processes
+    for executor in executors:
+        executor.shutdown()
+    if jobs_executor is not None:
+        jobs_executor.shutdown()
+    if len(executors) == 0:
+        for cache in ALL_CACHES:
+            print(cache.get_stats())
+
+    if TRACE_QUERIES:
+        with open(args.trace, "w") as tf:
+            for record in trace_records:
+                tf.write(f"{json.dumps(record)}\n")
+
+        if len(trace_records) > 0:
+            print(get_trace_summary(trace_records))
@@ -0,0 +1,122 @@
+import mmap
+import os
+import struct
+import sys
+
+# Startup Snapshot <<<
+# The pre indexes of a segment (the first tokens of the index files of
+# every field type and of the idf files, and the first doc ids of the
+# title files) and the offsets of the lines of its index files, packed in
+# SNAPSHOT_FILE, which the searcher maps instead of parsing the text
+# files. The file is
+#   {magic}{number of sections}{section}{section}...{data}
+# where a section is {name}{offset}{count}{width}: the name padded to 24
+# bytes and the numbers as 8 byte little endian integers. The data of a
+# section is `count` items of `width` bytes, each either a key (padded
+# with null bytes, in sorted order) or an 8 byte little endian integer,
+# and starts at a multiple of 8 bytes.
+
+SNAPSHOT_FILE = "snapshot.bin"
+SNAPSHOT_MAGIC = b"WSNAP001"
+
+HEADER = struct.Struct("<8sQ")
+SECTION = struct.Struct("<24sQQQ")
+NUMBER_WIDTH = 8
+
+
+def encode_keys(keys):
+
+    keys = [key.encode() for key in keys]
+    width = max(map(len, keys), default=1)
+    return len(keys), width, b"".join(key.ljust(width, b"\0") for key in keys)
+
+
+def encode_numbers(nums):
+    return len(nums), NUMBER_WIDTH, struct.pack(f"<{len(nums)}Q", *nums)
+
+
+def write_snapshot(file_name, sections):
+    """
+    Writes the sections, a dict of their names to the
+    `(count, width, data)` of `encode_keys` or `encode_numbers`
+    """
+
+    data_offset = HEADER.size + SECTION.size * len(sections)
+    table, data = [], bytearray()
+    for name, (count, width, section_data) in sections.items():
+        data += bytes(-(data_offset + len(data)) % 8)
+        table.append(SECTION.pack(name.encode(), data_offset + len(data), count, width))
+        data += section_data
+
+    with open(file_name, "wb") as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, len(sections)))
+        f.write(b"".join(table))
+        f.write(data)
+
+
+def read_snapshot(file_name):
+    """
+    Maps the snapshot, returns a dict of the names of its sections to
+    their `(data, count, width)`, or None if there is no snapshot (or
+    it cannot be read in place, on a big endian machine)
+    """
+
+    if sys.byteorder == "big" or not os.path.exists(file_name):
+        return None
+
+    with open(file_name, "rb") as f:
+        snapshot_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, section_count = HEADER.unpack_from(snapshot_map)
+    if magic != SNAPSHOT_MAGIC:
+        return None
+
+    sections = {}
+    for name, offset, count, width in SECTION.iter_unpack(
+        snapshot_map[HEADER.size : HEADER.size + SECTION.size * section_count]
+    ):
+        data = memoryview(snapshot_map)[offset : offset + count * width]
+        sections[str(name.rstrip(b"\0"), "ascii")] = (data, count, width)
+    return sections
+
+
+class SnapshotKeys:
+    """
+    The sorted keys of a section, decoded only when accessed, so that
+    they are searched with `bisect` without being loaded
+    """
+
+    def __init__(self, data, count, width):
+
+        self.data = data
+        self.count = count
+        self.width = width
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, indx):
+
+        if not 0 <= indx < self.count:
+            raise IndexError("snapshot key index out of range")
+
+        start = indx * self.width
+        return str(self.data[start : start + self.width], "utf-8").rstrip("\0")
+
+
+def get_snapshot_keys(snapshot, name):
+
+    if snapshot is None or name not in snapshot:
+        return None
+    return SnapshotKeys(*snapshot[name])
+
+
+def get_snapshot_numbers(snapshot, name):
+
+    if snapshot is None or name not in snapshot:
+        return None
+    data, _, _ = snapshot[name]
+    return data.cast("Q")
+
+
+# >>>
@@ -0,0 +1,73 @@
+"""
+Checks the tokens that `tokenize` splits a text into.
+
+    $ python3 tests/test_tokenizer.py
+    $ python3 -m pytest tests
+"""
+
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+)
+
+from tokenizer import ENTITIES, SYMBOLS, tokenize  # noqa: E402
+
+
+def test_whitespace():
+
+    assert tokenize("") == []
+    assert tokenize(" \t\n ") == []
+    assert tokenize("one two\tthree\nfour\r\nfive") == [
+        "one",
+        "two",
+        "three",
+        "four",
+        "five",
+    ]
+
+    # The separators that str.split splits at, but bytes.split does not
+    assert tokenize("a\x1cb\x1dc\x1ed\x1fe") == ["a", "b", "c", "d", "e"]
+
+
+def test_symbols():
+
+    for symbol in SYMBOLS:
+        assert tokenize(f"left{symbol}right") == ["left", "right"], symbol
+
+    assert tokenize("[[category:living people]]") == ["category", "living", "people"]
+    assert tokenize("{{cite web|url=http://a.org}}") == [
+        "cite",
+        "web",
+        "url",
+        "http",
+        "a",
+        "org",
+    ]
+
+
+def test_entities():
+
+    for entity in ENTITIES:
+        assert tokenize(f"left{entity}right") == ["left", "right"], entity
+
+    # The names of the entities do not end up as tokens
+    assert tokenize("&lt;ref&gt;source&lt;/ref&gt;") == ["ref", "source", "ref"]
+    assert tokenize("fish &amp; chips") == ["fish", "chips"]
+    assert tokenize("amp lt") == ["amp", "lt"]
+
+
+def test_non_ascii():
+
+    assert tokenize("café naïve") == ["caf", "nave"]
+    assert tokenize("1990—1995") == ["19901995"]
+    assert tokenize("東京 tokyo") == ["tokyo"]
+
+
+if __name__ == "__main__":
+
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+    print("All tokenizer checks passed.")